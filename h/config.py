@@ -53,6 +53,20 @@ def configure(environ=None, settings=None):  # pylint: disable=too-many-statemen
         type_=asbool,
         default=True,
     )
+    # The backend of the search results cache ("memory", or the dotted name of
+    # a factory for a shared backend), how long (in seconds) results are
+    # cached for, how many the "memory" backend keeps and how long (in seconds)
+    # after an invalidation searches aren't cached for. See `h.search.cache`.
+    settings_manager.set("h.search.cache", "SEARCH_CACHE")
+    settings_manager.set("h.search.cache_ttl", "SEARCH_CACHE_TTL", type_=int)
+    settings_manager.set("h.search.cache_size", "SEARCH_CACHE_SIZE", type_=int)
+    settings_manager.set("h.search.cache_settle", "SEARCH_CACHE_SETTLE", type_=int)
+    # Whether searches match annotations in world-readable groups by a flag in
+    # the index, rather than by listing every world-readable group. Only turn
+    # this on once every annotation has been reindexed with the flag.
+    settings_manager.set(
+        "h.search.world_readable_flag", "SEARCH_WORLD_READABLE_FLAG", type_=asbool
+    )
     settings_manager.set("mail.default_sender", "MAIL_DEFAULT_SENDER")
     settings_manager.set("mail.host", "MAIL_HOST")
     settings_manager.set("mail.port", "MAIL_PORT", type_=int)
@@ -116,6 +130,56 @@ def configure(environ=None, settings=None):  # pylint: disable=too-many-statemen
 
     settings_manager.set("h.websocket_url", "WEBSOCKET_URL")
 
+    # How annotation events are routed to the streamer: "direct" (the
+    # default) sends every event to every streamer worker, and "topic" routes
+    # them by group, so each worker only receives the events it needs.
+    settings_manager.set("h.realtime.annotation_routing", "REALTIME_ANNOTATION_ROUTING")
+
+    # The maximum number of messages the streamer takes off its work queue at
+    # once. Anything over 1 enables batching of annotation events.
+    settings_manager.set("h.streamer.batch_size", "STREAMER_BATCH_SIZE", type_=int)
+
+    # How many messages can be waiting to be sent to each websocket client,
+    # and whether to "drop" messages or "close" the connection beyond that.
+    settings_manager.set(
+        "h.streamer.send_queue_size", "STREAMER_SEND_QUEUE_SIZE", type_=int
+    )
+    settings_manager.set(
+        "h.streamer.send_queue_overflow", "STREAMER_SEND_QUEUE_OVERFLOW"
+    )
+
+    # How many recent annotation events to keep for replaying to clients which
+    # reconnect, and for how long (in seconds).
+    settings_manager.set("h.streamer.replay_size", "STREAMER_REPLAY_SIZE", type_=int)
+    settings_manager.set("h.streamer.replay_ttl", "STREAMER_REPLAY_TTL", type_=int)
+
+    # How often (in seconds) the streamer reloads the set of NIPSA'd users.
+    settings_manager.set("h.streamer.nipsa_ttl", "STREAMER_NIPSA_TTL", type_=int)
+
+    # The zlib compression level for websocket clients which negotiate
+    # permessage-deflate (disabled if unset), and the smallest message which
+    # will be compressed.
+    settings_manager.set(
+        "h.streamer.deflate_level", "STREAMER_DEFLATE_LEVEL", type_=int
+    )
+    settings_manager.set(
+        "h.streamer.deflate_min_size", "STREAMER_DEFLATE_MIN_SIZE", type_=int
+    )
+
+    # How often (in seconds) the streamer pings each websocket client, and how
+    # long (in seconds) clients have to send a filter before being closed (0
+    # to never close them).
+    settings_manager.set(
+        "h.streamer.heartbeat_interval", "STREAMER_HEARTBEAT_INTERVAL", type_=int
+    )
+    settings_manager.set(
+        "h.streamer.filter_timeout", "STREAMER_FILTER_TIMEOUT", type_=int
+    )
+
+    # The watermarks (fractions of the work queue's size) at which the
+    # streamer starts to shed load. See `h.streamer.shedding`.
+    settings_manager.set("h.streamer.shed_watermarks", "STREAMER_SHED_WATERMARKS")
+
     # Debug/development settings
     settings_manager.set("debug_query", "DEBUG_QUERY")
 
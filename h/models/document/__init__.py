@@ -5,4 +5,8 @@ from h.models.document._document import (
 )
 from h.models.document._exceptions import ConcurrentUpdateError
 from h.models.document._meta import DocumentMeta, create_or_update_document_meta
-from h.models.document._uri import DocumentURI, create_or_update_document_uri
+from h.models.document._uri import (
+    EXPANDED_URIS,
+    DocumentURI,
+    create_or_update_document_uri,
+)
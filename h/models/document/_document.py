@@ -8,7 +8,11 @@ from h.db import Base, mixins
 from h.models import Annotation
 from h.models.document._exceptions import ConcurrentUpdateError
 from h.models.document._meta import create_or_update_document_meta
-from h.models.document._uri import DocumentURI, create_or_update_document_uri
+from h.models.document._uri import (
+    EXPANDED_URIS,
+    DocumentURI,
+    create_or_update_document_uri,
+)
 from h.util.uri import normalize as uri_normalize
 
 log = logging.getLogger(__name__)
@@ -162,6 +166,9 @@ def merge_documents(session, documents, updated=None):
     except sa.exc.IntegrityError as err:
         raise ConcurrentUpdateError("concurrent document merges") from err
 
+    # Every URI of the duplicates now expands to the master's URIs as well
+    EXPANDED_URIS.invalidate(session, master)
+
     return master
 
 
@@ -226,6 +233,9 @@ def update_document_metadata(  # pylint: disable=too-many-arguments
 
     document.update_web_uri()
 
+    # The document might have new URIs, which its other URIs expand to
+    EXPANDED_URIS.invalidate(session, document)
+
     for document_meta_dict in document_meta_dicts:
         create_or_update_document_meta(
             session=session,
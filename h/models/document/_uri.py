@@ -1,10 +1,14 @@
 import logging
+from collections import Counter
+from time import monotonic
 
+import newrelic.agent
 import sqlalchemy as sa
 from sqlalchemy.ext.hybrid import hybrid_property
 
 from h.db import Base, mixins
 from h.models.document._exceptions import ConcurrentUpdateError
+from h.util.cache import MemoryBackend
 from h.util.uri import normalize as uri_normalize
 
 log = logging.getLogger(__name__)
@@ -138,3 +142,121 @@ def create_or_update_document_uri(  # pylint: disable=redefined-builtin,too-many
         session.flush()
     except sa.exc.IntegrityError as err:
         raise ConcurrentUpdateError("concurrent document uri updates") from err
+
+
+class ExpandedURICache:
+    """
+    A per-process cache of the URIs of the document each normalized URI is of.
+
+    `h.storage.expand_uri()` looks these up for every search for a URI and for
+    every annotation event in the streamer, but they only change when
+    `update_document_metadata()` or `merge_documents()` change a document.
+    Those invalidate every URI of the documents they change in this process
+    once their transaction has ended, and other processes see the change once
+    their entries expire.
+
+    Until the transaction has committed other requests still read the URIs
+    from before the change, so those which read them before an invalidation
+    and set them after it are ignored (see `generation`).
+
+    Hits and misses are recorded in New Relic for the current transaction (if
+    there is one), and counted for processes which report them periodically
+    (like the streamer, see `h.streamer.metrics`).
+    """
+
+    METRIC_PREFIX = "Custom/Storage/ExpandURI/Cache/"
+
+    # The keys in `Session.info` of whether the cache is listening for the
+    # end of the session's transactions, and of the URIs to invalidate then
+    _LISTENING_KEY = "h.expanded_uris.listening"
+    _PENDING_KEY = "h.expanded_uris.pending"
+
+    def __init__(self, maxsize=4096, ttl=60, clock=monotonic):
+        """
+        Create a new expanded URI cache.
+
+        :param maxsize: the most URIs to keep, dropping the least recently
+            used first
+        :param ttl: how long (in seconds) to keep each URI for
+        """
+        self.ttl = ttl
+        self._backend = MemoryBackend(maxsize=maxsize, clock=clock)
+
+        # The hits and misses since they were last reported, by name
+        self.counts = Counter()
+
+        # How many times URIs have been invalidated. Read this before looking
+        # up URIs to cache, and pass it to `set()`
+        self.generation = 0
+
+    def get(self, uri_normalized):
+        """
+        Get the URIs of the document `uri_normalized` is of.
+
+        :returns: a list of `(type, uri, uri_normalized)` of the document's
+            DocumentURIs (or an empty list if there isn't a document), or
+            `None` if they aren't cached
+        """
+        type_uris = self._backend.get(uri_normalized)
+
+        name = "Hits" if type_uris is not None else "Misses"
+        self.counts[name] += 1
+        newrelic.agent.record_custom_metric(self.METRIC_PREFIX + name, 1)
+
+        return type_uris
+
+    def set(self, uri_normalized, type_uris, generation=None):
+        """
+        Cache the URIs of the document `uri_normalized` is of.
+
+        :param generation: the `generation` from before the URIs were looked
+            up, if any. They aren't cached if URIs have been invalidated since.
+        """
+        if generation is not None and generation != self.generation:
+            return
+
+        self._backend.set(uri_normalized, [tuple(row) for row in type_uris], self.ttl)
+
+    def invalidate(self, session, document):
+        """
+        Invalidate every URI of `document`, now and when the transaction ends.
+
+        They're invalidated straight away so the rest of the transaction sees
+        the change, and again at the end as, whether it's committed or rolled
+        back, any URIs cached in the meantime might be wrong afterwards.
+        """
+        uris = {document_uri.uri_normalized for document_uri in document.document_uris}
+        self._invalidate(uris)
+
+        if not session.info.get(self._LISTENING_KEY):
+            sa.event.listen(session, "after_transaction_end", self._transaction_ended)
+            session.info[self._LISTENING_KEY] = True
+
+        session.info.setdefault(self._PENDING_KEY, set()).update(uris)
+
+    def _transaction_ended(self, session, transaction):
+        # Only the end of the top-level transaction counts
+        if transaction.parent is not None:
+            return
+
+        uris = session.info.pop(self._PENDING_KEY, None)
+        if uris:
+            self._invalidate(uris)
+
+    def _invalidate(self, uris):
+        self.generation += 1
+        for uri_normalized in uris:
+            self._backend.delete(uri_normalized)
+
+    def clear(self):
+        self._backend.clear()
+
+    def report(self):
+        """Return the hits and misses since the last report and reset them."""
+        counts = {name: self.counts[name] for name in ("Hits", "Misses")}
+        self.counts.clear()
+
+        return counts
+
+
+EXPANDED_URIS = ExpandedURICache()
@@ -13,6 +13,10 @@ FEATURES = {
     ),
     "client_display_names": "Render display names instead of user names in the client",
     "notebook_launch": "Allow access to notebook feature",
+    "search_prefetch_replies": (
+        "Search for annotations and their replies in one request to Elasticsearch "
+        "(leaves out replies on a different URI to their thread)"
+    ),
 }
 
 # Once a feature has been fully deployed, we remove the flag from the codebase.
@@ -1,3 +1,4 @@
+from h.models.group import ReadableBy
 from h.presenters.annotation_base import AnnotationBasePresenter
 from h.presenters.document_searchindex import DocumentSearchIndexPresenter
 from h.util.datetime import utc_iso8601
@@ -29,6 +30,7 @@ class AnnotationSearchIndexPresenter(AnnotationBasePresenter):
             "tags": tags,
             "tags_raw": tags,
             "group": self.annotation.groupid,
+            "group_world_readable": self._group_world_readable(),
             "shared": self.annotation.shared,
             "target": self.target,
             "document": docpresenter.asdict(),
@@ -45,6 +47,12 @@ class AnnotationSearchIndexPresenter(AnnotationBasePresenter):
 
         return result
 
+    def _group_world_readable(self):
+        # Whether anyone can read the annotation's group, so searches don't
+        # have to list every world-readable group to find public annotations
+        group = self.annotation.group
+        return group is not None and group.readable_by == ReadableBy.world
+
     def _add_hidden(self, result):
         # Mark an annotation as hidden if it and all of it's children have been
         # moderated and hidden.
@@ -1,6 +1,7 @@
 import base64
 import random
 import struct
+import time
 
 import kombu
 from kombu.exceptions import LimitExceeded, OperationalError
@@ -59,6 +60,64 @@ class Consumer(ConsumerMixin):
         return base64.urlsafe_b64encode(data).strip(b"=")
 
 
+class TopicConsumer(Consumer):
+    """
+    A realtime consumer of the topic exchange, with routing keys which change.
+
+    Rather than one fixed routing key, this is bound to whatever keys
+    `routing_keys()` returns at the time. The bindings are updated between
+    reading messages, on the consumer's own channel.
+
+    :param connection: a `kombu.Connection`
+    :param routing_keys: a function returning the set of routing keys to bind,
+        which should return the same set object until the keys change
+    :param handler: the function which gets called when a messages arrives
+    """
+
+    def __init__(self, connection, routing_keys, handler):
+        super().__init__(connection, "topic", handler)
+        self.routing_keys = routing_keys
+        self.exchange = get_topic_exchange()
+
+        self._queue = None
+        self._bound = frozenset()
+
+    def get_consumers(
+        self, consumer_factory, channel
+    ):  # pylint: disable=arguments-renamed
+        self._bound = self.routing_keys()
+        queue = kombu.Queue(
+            self.generate_queue_name(),
+            durable=False,
+            auto_delete=True,
+            bindings=[
+                kombu.binding(self.exchange, routing_key=key) for key in self._bound
+            ],
+        )
+        consumer = consumer_factory(queues=[queue], callbacks=[self.handle_message])
+
+        # The consumer's copy of the queue is bound to the channel
+        self._queue = consumer.queues[0]
+
+        return [consumer]
+
+    def on_iteration(self):
+        """Bring the queue's bindings up to date, between reading messages."""
+        wanted = self.routing_keys()
+
+        # This is called between every message, so don't compare the keys
+        # when `routing_keys()` has returned the same set again
+        if wanted is self._bound:
+            return
+
+        for key in wanted - self._bound:
+            self._queue.bind_to(self.exchange, routing_key=key)
+        for key in self._bound - wanted:
+            self._queue.unbind_from(self.exchange, routing_key=key)
+
+        self._bound = wanted
+
+
 class Publisher:
     """
     A realtime publisher for publishing messages to all subscribers.
@@ -70,16 +129,30 @@ class Publisher:
     """
 
     def __init__(self, request):
-        self.connection = get_connection(request.registry.settings, fail_fast=True)
+        settings = request.registry.settings
+
+        self.connection = get_connection(settings, fail_fast=True)
         self.exchange = get_exchange()
+        self.topic_routing = settings.get("h.realtime.annotation_routing") == "topic"
 
     def publish_annotation(self, payload):
         """
         Publish an annotation message with the routing key 'annotation'.
 
+        If the `h.realtime.annotation_routing` setting is "topic", the message
+        is published to the topic exchange instead, with a routing key for the
+        annotation's group. See `annotation_routing_key()`.
+
         :raise RealtimeMessageQueueError: When we cannot queue the message
         """
-        self._publish("annotation", payload)
+        if self.topic_routing:
+            self._publish(
+                annotation_routing_key(payload.get("group")),
+                payload,
+                exchange=get_topic_exchange(),
+            )
+        else:
+            self._publish("annotation", payload)
 
     def publish_user(self, payload):
         """
@@ -89,15 +162,21 @@ class Publisher:
         """
         self._publish("user", payload)
 
-    def _publish(self, routing_key, payload):
+    def _publish(self, routing_key, payload, exchange=None):
+        # Stamp messages so that subscribers can tell how long they took to
+        # arrive. This is wall clock time, as monotonic clocks can't be
+        # compared between machines.
+        payload = dict(payload, published_at=time.time())
+        exchange = exchange or self.exchange
+
         try:  # pylint: disable=too-many-try-statements
             with producer_pool[self.connection].acquire(
                 block=True, timeout=1
             ) as producer:
                 producer.publish(
                     payload,
-                    exchange=self.exchange,
-                    declare=[self.exchange],
+                    exchange=exchange,
+                    declare=[exchange],
                     routing_key=routing_key,
                     retry=True,
                     # This is the retry for the producer, the connection
@@ -119,6 +198,34 @@ def get_exchange():
     )
 
 
+def get_topic_exchange():
+    """
+    Get a configured `kombu.Exchange` for routing annotation messages by group.
+
+    This is used instead of `get_exchange()` for annotation messages when the
+    `h.realtime.annotation_routing` setting is "topic".
+    """
+
+    return kombu.Exchange(
+        "realtime-topic", type="topic", durable=False, delivery_mode="transient"
+    )
+
+
+# The routing key on the topic exchange which matches every annotation message
+ALL_ANNOTATIONS = "annotation.#"
+
+# The routing key for annotation messages which don't say what group they're in
+UNKNOWN_GROUP = "annotation.unknown"
+
+
+def annotation_routing_key(groupid):
+    """Get the topic exchange routing key for an annotation in a group."""
+    if groupid is None:
+        return UNKNOWN_GROUP
+
+    return f"annotation.group.{groupid}"
+
+
 def get_connection(settings, fail_fast=False):
     """
     Return a `kombu.Connection` based on the application's settings.
@@ -6,7 +6,7 @@ from dateutil.parser import parse
 from pyramid import i18n
 
 from h.schemas.base import JSONSchema, ValidationError
-from h.search.query import LIMIT_DEFAULT, LIMIT_MAX, OFFSET_MAX
+from h.search.query import LIMIT_DEFAULT, LIMIT_MAX, OFFSET_MAX, decode_cursor
 from h.search.util import wildcard_uri_is_valid
 from h.util import document_claims
 
@@ -283,6 +283,19 @@ class SearchParamsSchema(colander.Schema):
         missing=False,
         description="Return a separate set of annotations and their replies.",
     )
+    _reply_cursors = colander.SchemaNode(
+        colander.Boolean(),
+        missing=False,
+        description=(
+            "With _separate_replies, return only the latest few replies to each "
+            "annotation, with cursors for the rest."
+        ),
+    )
+    _profile = colander.SchemaNode(
+        colander.Boolean(),
+        missing=False,
+        description="Return a breakdown of where the time went (staff only).",
+    )
     sort = colander.SchemaNode(
         colander.String(),
         validator=colander.OneOf(["created", "updated", "group", "id", "user"]),
@@ -298,6 +311,14 @@ class SearchParamsSchema(colander.Schema):
                     epoch. This is used for iteration through large collections
                     of results.""",
     )
+    cursor = colander.SchemaNode(
+        colander.String(),
+        missing=colander.drop,
+        description="""Returns results after the last annotation of the page
+                    of results which returned this cursor, in the same order
+                    (overriding sort and order). This is the best way to
+                    iterate through large collections of results.""",
+    )
     limit = colander.SchemaNode(
         colander.Integer(),
         validator=colander.Range(min=0, max=LIMIT_MAX),
@@ -430,6 +451,16 @@ class SearchParamsSchema(colander.Schema):
             # offset must be set to 0 if search_after is specified.
             cstruct["offset"] = 0
 
+        cursor = cstruct.get("cursor", None)
+        if cursor:
+            try:
+                decode_cursor(cursor)
+            except ValueError as err:
+                raise colander.Invalid(node, "cursor is not a valid cursor") from err
+
+            # offset must be set to 0 if cursor is specified.
+            cstruct["offset"] = 0
+
     @staticmethod
     def _date_is_parsable(value):
         """Return True if date is parsable and False otherwise."""
@@ -1,3 +1,4 @@
+from h.search.cache import get_cache
 from h.search.client import get_client
 from h.search.config import init
 from h.search.core import Search
@@ -43,3 +44,7 @@ def includeme(config):
     # reread the settings.
     config.registry["es.client"] = get_client(settings)
     config.add_request_method(lambda r: r.registry["es.client"], name="es", reify=True)
+
+    # The search results cache, which is `None` unless it's enabled. See
+    # `h.search.cache`.
+    config.registry["search.cache"] = get_cache(settings)
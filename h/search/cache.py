@@ -0,0 +1,251 @@
+"""
+An opt-in cache of search results.
+
+Many clients on the same popular page send identical searches, so the results
+of a `Search` can be cached, keyed on:
+
+ * The search params, in a canonical order
+ * Who is searching, and the set of groups they can read (which together
+   decide which private, NIPSA'd and hidden annotations they can see)
+
+Entries expire after a TTL, and are invalidated when annotations are indexed
+(see `h.services.search_index`). Rather than finding and deleting entries,
+each cached search is tagged with the URIs it searches (or, without any, the
+groups it searches, or otherwise "all") and every tag has a random generation
+token which is part of the key. Indexing an annotation replaces the tokens of
+its annotation's URIs and group (and "all"), so every search which might have
+matched it misses from then on, and the stale entries age out of the backend.
+This works with any backend which can get and set values.
+
+Elasticsearch only makes indexed annotations searchable once it refreshes the
+index, so searches with tags invalidated in the last few seconds (the
+"settle" time) aren't cached at all: they could still be missing the change.
+
+The "memory" backend is in each process, so an invalidation only reaches the
+process which indexed the annotation, and other processes keep serving their
+results until they expire. To keep users from missing their own changes, it
+only caches the searches of logged out users.
+
+Changes which don't index annotations (like a user being NIPSA'd) are only
+seen once entries expire.
+"""
+
+import hashlib
+import json
+import uuid
+from time import time
+
+import newrelic.agent
+from pyramid.path import DottedNameResolver
+
+from h.search.util import add_default_scheme
+from h.util import uri
+from h.util.cache import MemoryBackend
+
+# How long (in seconds) search results are cached for, and how many the
+# in-process backend keeps. These can be overridden by the
+# `h.search.cache_ttl` and `h.search.cache_size` settings.
+DEFAULT_TTL = 60
+DEFAULT_SIZE = 1024
+
+# How long (in seconds) after an invalidation searches aren't cached for. This
+# is a few times Elasticsearch's default refresh interval of one second, and
+# can be overridden by the `h.search.cache_settle` setting.
+DEFAULT_SETTLE = 5
+
+# The tag of searches which aren't for any particular URIs or groups
+ALL = "all"
+
+
+class SearchCache:
+    """A cache of `SearchResult`s, in a backend."""
+
+    def __init__(  # pylint:disable=too-many-arguments
+        self,
+        backend,
+        ttl=DEFAULT_TTL,
+        settle=DEFAULT_SETTLE,
+        anonymous_only=False,
+        clock=time,
+    ):
+        """
+        Create a new search cache.
+
+        :param backend: The backend to keep results in
+        :param ttl: How long (in seconds) results are cached for
+        :param settle: How long (in seconds) after an invalidation searches
+            with the invalidated tags aren't cached for
+        :param anonymous_only: Whether to only cache the searches of logged
+            out users
+        :param clock: A function returning the wall clock time, which is
+            shared by every process using a shared backend
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self.settle = settle
+        self.anonymous_only = anonymous_only
+        self._clock = clock
+
+    def entry_key(self, key, tags):
+        """
+        Get the key a search's result is cached under.
+
+        This includes the current generation of each of the search's tags, so
+        it should be worked out once, before searching, and used to both get
+        and set the result. That way a result found before an invalidation is
+        set under the old generation, where it will never be got.
+
+        :param key: The search's key, from `search_key()`
+        :param tags: The search's tags, from `search_tags()`
+        :returns: The key, or `None` if the search shouldn't be cached as one
+            of its tags was invalidated within the settle time
+        """
+        generations = []
+        for tag in sorted(tags):
+            generation = self.backend.get(self._generation_key(tag))
+            if generation is None:
+                # Start a new generation if the old one was lost (or there
+                # wasn't one), so entries from before can't come back. It
+                # could have been lost to a recent invalidation, so it has
+                # to settle like any other
+                generation = self._new_generation(tag)
+            token, created = generation
+
+            if self._clock() - created < self.settle:
+                return None
+
+            generations.append(token)
+
+        return "search:" + _digest([key, generations])
+
+    def get(self, entry_key):
+        """
+        Get the cached result of a search.
+
+        :param entry_key: The search's entry key, from `entry_key()`
+        :returns: The `SearchResult`, or `None` if it isn't cached
+        """
+        result = self.backend.get(entry_key)
+
+        hit = result is not None
+        newrelic.agent.record_custom_metric(
+            "Custom/Search/Cache/" + ("Hits" if hit else "Misses"), 1
+        )
+
+        return result
+
+    def set(self, entry_key, result):
+        """Cache the result of a search."""
+        self.backend.set(entry_key, result, self.ttl)
+
+    def invalidate(self, tags):
+        """Invalidate every cached search with any of `tags`."""
+        for tag in tags:
+            self._new_generation(tag)
+
+    def _new_generation(self, tag):
+        generation = [uuid.uuid4().hex, self._clock()]
+        self.backend.set(self._generation_key(tag), generation)
+        return generation
+
+    @staticmethod
+    def _generation_key(tag):
+        return "search-generation:" + tag
+
+
+def search_key(
+    params, separate_replies, userid, readable_groupids, reply_cursors=False
+):
+    """
+    Get the cache key of a search.
+
+    :param params: The search params
+    :type params: webob.multidict.MultiDict
+    :param separate_replies: The `separate_replies` option of the search
+    :param userid: The userid of the user searching, if any
+    :param readable_groupids: The ids of the groups the user can read
+    :param reply_cursors: The `reply_cursors` option of the search
+    """
+    return _digest(
+        [
+            sorted([key, str(value)] for key, value in params.items()),
+            bool(separate_replies),
+            userid,
+            sorted(readable_groupids),
+            bool(reply_cursors),
+        ]
+    )
+
+
+def search_tags(params):
+    """Get the invalidation tags of a search with `params`."""
+    uris = params.getall("uri") + params.getall("url")
+    # Wildcard searches could match annotations on any URI
+    wildcard = "wildcard_uri" in params or any(
+        "*" in value or "_" in value for value in uris
+    )
+
+    if uris and not wildcard:
+        return {_uri_tag(uri.normalize(add_default_scheme(value))) for value in uris}
+
+    if "group" in params:
+        return {_group_tag(groupid) for groupid in params.getall("group")}
+
+    return {ALL}
+
+
+def annotation_tags(annotation, normalized_uris):
+    """
+    Get the tags of the searches which might match `annotation`.
+
+    :param annotation: The annotation which has changed
+    :param normalized_uris: The normalized URIs of `annotation`'s document
+    """
+    tags = {ALL, _group_tag(annotation.groupid)}
+    tags.update(_uri_tag(value) for value in normalized_uris)
+
+    return tags
+
+
+def _uri_tag(normalized_uri):
+    return "uri:" + normalized_uri
+
+
+def _group_tag(groupid):
+    return "group:" + groupid
+
+
+def _digest(value):
+    return hashlib.sha1(
+        json.dumps(value, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+
+def get_cache(settings):
+    """
+    Get the search cache configured by `settings`.
+
+    :returns: A `SearchCache`, or `None` if caching isn't enabled
+    """
+    backend = settings.get("h.search.cache")
+    if not backend:
+        return None
+
+    # Invalidations only reach the process they're made in with the "memory"
+    # backend, so it's only used for the searches of logged out users
+    anonymous_only = backend == "memory"
+
+    if backend == "memory":
+        backend = MemoryBackend(
+            maxsize=int(settings.get("h.search.cache_size", DEFAULT_SIZE))
+        )
+    else:
+        # The dotted name of a factory which takes the settings
+        backend = DottedNameResolver().resolve(backend)(settings)
+
+    return SearchCache(
+        backend,
+        ttl=int(settings.get("h.search.cache_ttl", DEFAULT_TTL)),
+        settle=int(settings.get("h.search.cache_settle", DEFAULT_SETTLE)),
+        anonymous_only=anonymous_only,
+    )
@@ -28,6 +28,7 @@ ANNOTATION_MAPPING = {
         "deleted": {"type": "boolean"},
         "document": {"enabled": False},  # not indexed
         "group": {"type": "keyword"},
+        "group_world_readable": {"type": "boolean"},
         "id": {"type": "keyword"},
         "nipsa": {"type": "boolean"},
         "quote": {"type": "text", "analyzer": "uni_normalizer"},
@@ -1,18 +1,31 @@
 import logging
 from collections import namedtuple
+from contextlib import nullcontext
 
 import elasticsearch_dsl
 from webob.multidict import MultiDict
 
 from h.search import query
+from h.search.cache import search_key, search_tags
 from h.util import metrics
 
 log = logging.getLogger(__name__)
 
 SearchResult = namedtuple(
-    "SearchResult", ["total", "annotation_ids", "reply_ids", "aggregations"]
+    "SearchResult",
+    ["total", "annotation_ids", "reply_ids", "aggregations", "cursor", "reply_cursors"],
+    # The cursor for the next page of annotations, if there might be one, and
+    # the cursors for the rest of the replies to each annotation with more
+    # replies than were returned
+    defaults=[None, None],
 )
 
+# The most replies returned for all of the annotations together in
+# `separate_replies` searches, and with `reply_cursors`, for each annotation.
+# The total is enough for a reply to every annotation on a page.
+REPLIES_MAX = query.LIMIT_MAX
+REPLIES_PER_THREAD = 10
+
 
 class Search:
     """
@@ -26,23 +39,59 @@ class Search:
         resulting annotations will only include top-level annotations, not replies.
     :type separate_replies: bool
 
+    :param reply_cursors: Whether to return only the latest few replies to
+        each annotation, with cursors for the rest of the replies to any
+        annotations with more (see `SearchResult`). Otherwise up to 200
+        replies are returned in all. Only used with `separate_replies`.
+    :type reply_cursors: bool
+
     :param separate_wildcard_uri_keys: If True, wildcard searches are only performed
         on wildcard_uri's, and exact match searches are performed on uri/url parameters.
         If False, uri/url parameters are expected to contain both wildcard and exact
         matches.
     :type separate_wildcard_uri_keys: bool
+
+    :param cache: Whether to use the search cache (if it's enabled by the
+        `h.search.cache` setting) for the results of this search. See
+        `h.search.cache`.
+    :type cache: bool
+
+    :param prefetch_replies: Whether to search for the replies in the same
+        request to Elasticsearch as the annotations, where possible. Only
+        used with `separate_replies` and `reply_cursors`. Replies on a
+        different URI to their thread are left out (see
+        `_run_prefetching()`).
+    :type prefetch_replies: bool
+
+    :param profile: A profile to record how long each step of the search
+        takes in, which also turns on Elasticsearch's profiling. Profiled
+        searches aren't cached.
+    :type profile: h.search.profile.SearchProfile
     """
 
-    def __init__(
+    def __init__(  # pylint:disable=too-many-arguments
         self,
         request,
         separate_replies=False,
         separate_wildcard_uri_keys=True,
-        _replies_limit=200,
+        cache=False,
+        prefetch_replies=False,
+        profile=None,
+        reply_cursors=False,
+        _replies_limit=REPLIES_PER_THREAD,
+        _replies_max=REPLIES_MAX,
     ):
         self.es = request.es
         self.separate_replies = separate_replies
+        self.reply_cursors = reply_cursors
+        self.prefetch_replies = prefetch_replies
         self._replies_limit = _replies_limit
+        self._replies_max = _replies_max
+        self._request = request
+        self._profile = profile
+        self._cache = (
+            request.registry.get("search.cache") if cache and profile is None else None
+        )
         # Order matters! The KeyValueMatcher must be run last,
         # after all other modifiers have popped off the params.
         self._modifiers = [
@@ -73,15 +122,31 @@ class Search:
         :rtype: SearchResult
         """
         metrics.record_search_query_params(params, self.separate_replies)
-        total, annotation_ids, aggregations = self._search_annotations(params)
-        reply_ids = self._search_replies(annotation_ids)
 
-        return SearchResult(total, annotation_ids, reply_ids, aggregations)
+        if self._cache is None or (
+            self._cache.anonymous_only and self._request.authenticated_userid
+        ):
+            return self._run(params)
+
+        # The modifiers pop the params, so the key is worked out first (and
+        # only once, see `SearchCache.entry_key()`)
+        entry_key = self._cache.entry_key(self._cache_key(params), search_tags(params))
+        if entry_key is None:
+            return self._run(params)
+
+        result = self._cache.get(entry_key)
+        if result is None:
+            result = self._run(params)
+            self._cache.set(entry_key, result)
+
+        return result
 
     def clear(self):
         """Clear search modifiers, aggregators, and matchers."""
         self._modifiers = [query.Sorter()]
         self._aggregations = []
+        # Customised searches aren't cached, as the key doesn't cover them
+        self._cache = None
 
     def append_modifier(self, modifier):
         """Append a search modifier, matcher, etc to the search query."""
@@ -89,49 +154,250 @@ class Search:
         # since the KeyValueFilter must always be run after all the other
         # modifiers.
         self._modifiers.insert(0, modifier)
+        self._cache = None
 
     def append_aggregation(self, aggregation):
         """Append an aggregation to the search query."""
         self._aggregations.append(aggregation)
+        self._cache = None
+
+    def _run(self, params):
+        if (
+            self.separate_replies
+            and self.reply_cursors
+            and self.prefetch_replies
+            and self._can_prefetch(params)
+        ):
+            return self._run_prefetching(params)
+
+        search = self._annotations_search(params)
+        total, annotation_ids, aggregations, cursor = self._parse_annotations(
+            search, self._execute("annotations", search)
+        )
+        reply_ids, reply_cursors = self._search_replies(annotation_ids)
+
+        return SearchResult(
+            total, annotation_ids, reply_ids, aggregations, cursor, reply_cursors
+        )
+
+    def _run_prefetching(self, params):
+        """
+        Search for the annotations and their replies in one request.
+
+        Which replies to get depends on which annotations are on the page, so
+        can't usually be searched for until the page has been. But replies are
+        in the same group as their thread, and are created on the same URI, so
+        when searching for annotations on particular URIs the replies to them
+        are among the replies on those URIs: these are searched for alongside
+        the annotations with a multi-search. Only if there are too many threads
+        with replies for one aggregation are the replies to the annotations
+        which missed out searched for afterwards.
+
+        Unlike the search made without prefetching, this leaves out replies
+        whose URI doesn't match the search, like those made through an API
+        client with a different URI to the annotation they reply to. Checking
+        every annotation without any replies found for it would cost the
+        request this saves.
+        """
+        # The modifiers pop the params, so the replies are searched for with
+        # a copy of those which decide the document and group
+        replies_params = MultiDict(
+            (key, value)
+            for key, value in params.items()
+            if key in ("group", "uri", "url", "wildcard_uri")
+        )
+        replies_params["limit"] = 0
+        aggregation = query.RepliesAggregation(
+            None, self._replies_limit, size=query.LIMIT_MAX
+        )
+        replies_search = self._build_search(
+            [query.ReplyFilter()] + self._modifiers, [aggregation], replies_params
+        )
+
+        search = self._annotations_search(params)
+        with self._step("execute/annotations+replies"):
+            response, replies_response = (
+                elasticsearch_dsl.MultiSearch(using=self.es.conn, index=self.es.index)
+                .add(search)
+                .add(replies_search)
+                .execute()
+            )
+        if self._profile is not None:
+            self._profile.add_response("annotations", response)
+            self._profile.add_response("replies", replies_response)
+
+        total, annotation_ids, aggregations, cursor = self._parse_annotations(
+            search, response
+        )
+        reply_ids, reply_cursors = self._search_replies(
+            annotation_ids, prefetched=(aggregation, replies_response.aggregations)
+        )
+
+        return SearchResult(
+            total, annotation_ids, reply_ids, aggregations, cursor, reply_cursors
+        )
+
+    @staticmethod
+    def _can_prefetch(params):
+        return any(key in params for key in ("uri", "url", "wildcard_uri"))
+
+    def _cache_key(self, params):
+        # Which annotations a user can see depends on who they are (for their
+        # own private, hidden and NIPSA'd annotations) and which groups they
+        # can read. This is worked out the same way as in `GroupFilter`.
+        group_ids = [params["group"]] if "group" in params else None
+        readable_groupids = self._request.find_service(
+            name="group"
+        ).groupids_readable_by(self._request.user, group_ids)
+
+        return search_key(
+            params,
+            self.separate_replies,
+            self._request.authenticated_userid,
+            readable_groupids,
+            reply_cursors=self.separate_replies and self.reply_cursors,
+        )
 
-    def _search(self, modifiers, aggregations, params):
+    def _search(self, modifiers, aggregations, params, name="search"):
         """Apply the modifiers, aggregations, and executes the search."""
+        return self._execute(name, self._build_search(modifiers, aggregations, params))
+
+    def _build_search(self, modifiers, aggregations, params):
+        """Apply the modifiers and aggregations to a new search."""
         # Don't return any fields, just the metadata so set _source=False.
         search = elasticsearch_dsl.Search(
             using=self.es.conn, index=self.es.index
         ).source(False)
+        if self._profile is not None:
+            search = search.extra(profile=True)
 
+        # Some modifiers look things up in the DB, so each is a step
         for agg in aggregations:
-            agg(search, params)
+            with self._step("build/" + type(agg).__name__):
+                agg(search, params)
         for qual in modifiers:
-            search = qual(search, params)
+            with self._step("build/" + type(qual).__name__):
+                search = qual(search, params)
+
+        return search
+
+    def _execute(self, name, search):
+        with self._step("execute/" + name):
+            response = search.execute()
+
+        if self._profile is not None:
+            self._profile.add_response(name, response)
+
+        return response
+
+    def _step(self, name):
+        if self._profile is None:
+            return nullcontext()
 
-        return search.execute()
+        return self._profile.step(name)
 
-    def _search_annotations(self, params):
+    def _annotations_search(self, params):
         # If separate_replies is True, don't return any replies to annotations.
         modifiers = self._modifiers
         if self.separate_replies:
             modifiers = [query.TopLevelAnnotationsFilter()] + modifiers
 
-        response = self._search(modifiers, self._aggregations, params)
+        return self._build_search(modifiers, self._aggregations, params)
 
+    def _parse_annotations(self, search, response):
         total = response["hits"]["total"]
-        annotation_ids = [hit["_id"] for hit in response["hits"]["hits"]]
+        hits = response["hits"]["hits"]
+        annotation_ids = [hit["_id"] for hit in hits]
         aggregations = self._parse_aggregation_results(response.aggregations)
-        return (total, annotation_ids, aggregations)
+        cursor = query.cursor_for(search, hits[-1]) if hits else None
+        return (total, annotation_ids, aggregations, cursor)
+
+    def _search_replies(self, annotation_ids, prefetched=None):
+        """
+        Get the replies to `annotation_ids`.
+
+        :param prefetched: The `RepliesAggregation` of a search for replies
+            which has already been made, and its aggregation results
+        """
+        if not self.separate_replies or not annotation_ids:
+            return [], {}
+
+        if not self.reply_cursors:
+            return self._search_all_replies(annotation_ids), {}
+
+        threads, missing = {}, annotation_ids
+        if prefetched is not None:
+            aggregation, results = prefetched
+            threads = {
+                annotation_id: thread
+                for annotation_id, thread in aggregation.parse_result(results).items()
+                if annotation_id in annotation_ids
+            }
+            # If the aggregation has a bucket for every thread, the
+            # annotations without one don't have any replies on these URIs
+            missing = (
+                []
+                if aggregation.is_complete(results)
+                else [id_ for id_ in annotation_ids if id_ not in threads]
+            )
+
+        if missing:
+            # The only difference between a search for annotations and a
+            # search for replies to annotations is the RepliesMatcher and the
+            # params passed to the modifiers. Rather than the replies
+            # themselves, this gets the latest replies to each annotation from
+            # an aggregation, so huge threads can't crowd out the others.
+            aggregation = query.RepliesAggregation(missing, self._replies_limit)
+            response = self._search(
+                [query.RepliesMatcher(missing)] + self._modifiers,
+                [aggregation],
+                MultiDict({"limit": 0}),
+                name="replies",
+            )
+            threads.update(aggregation.parse_result(response.aggregations))
+
+        # Take the replies a thread at a time, newest first and in page order,
+        # so that if there are too many in all every thread keeps its newest
+        threads = {id_: threads[id_] for id_ in annotation_ids if id_ in threads}
+        replies, taken = {}, dict.fromkeys(threads, 0)
+        for rank in range(self._replies_limit):
+            for annotation_id, (_, hits) in threads.items():
+                if rank < len(hits) and len(replies) < self._replies_max:
+                    replies[hits[rank]["_id"]] = tuple(hits[rank]["sort"])
+                    taken[annotation_id] += 1
+
+        reply_cursors = {}
+        for annotation_id, (total, hits) in threads.items():
+            # The rest of the replies can be paged through with a search for
+            # `references=annotation_id` from this cursor
+            count = taken[annotation_id]
+            if total > count:
+                reply_cursors[annotation_id] = self._reply_cursor(hits, count)
+
+        reply_ids = sorted(replies, key=replies.get, reverse=True)
+        return reply_ids, reply_cursors
+
+    @staticmethod
+    def _reply_cursor(hits, count):
+        """Get the cursor for the replies after the first `count` of `hits`."""
+        if count:
+            after = list(hits[count - 1]["sort"])
+        else:
+            # None of the thread's replies fit, so start a millisecond after
+            # the newest one, which is before all of them in this order
+            after = [hits[0]["sort"][0] + 1, ""]
 
-    def _search_replies(self, annotation_ids):
-        if not self.separate_replies:
-            return []
+        return query.encode_cursor("updated", "desc", after)
 
+    def _search_all_replies(self, annotation_ids):
         # The only difference between a search for annotations and a search for
         # replies to annotations is the RepliesMatcher and the params passed to
         # the modifiers.
         response = self._search(
             [query.RepliesMatcher(annotation_ids)] + self._modifiers,
             [],  # Aggregations aren't used in replies.
-            MultiDict({"limit": self._replies_limit}),
+            MultiDict({"limit": self._replies_max}),
+            name="replies",
         )
 
         if len(response["hits"]["hits"]) < response["hits"]["total"]:
@@ -139,7 +405,7 @@ class Search:
                 "The number of reply annotations exceeded the page size "
                 "of the Elasticsearch query. We currently don't handle "
                 "this, our search API doesn't support pagination of the "
-                "reply set."
+                "reply set without reply cursors."
             )
 
         return [hit["_id"] for hit in response["hits"]["hits"]]
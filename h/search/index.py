@@ -130,6 +130,9 @@ def _eager_loaded_annotations(session):
         subqueryload(models.Annotation.document).subqueryload(models.Document.meta),
         subqueryload(models.Annotation.moderation),
         subqueryload(models.Annotation.thread).load_only("id"),
+        # The group is joined on its pubid, so each would be loaded with its
+        # own query, rather than from the identity map
+        subqueryload(models.Annotation.group),
     )
 
 
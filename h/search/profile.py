@@ -0,0 +1,88 @@
+"""
+A breakdown of where the time goes in a search.
+
+Staff can add `_profile` to a search API request to get one of these back with
+the results (see `h.views.api.annotations.search`). Each step is timed and
+has the SQL statements run during it counted, so it's possible to tell if a
+slow search is down to:
+
+ * DB lookups while building the query, like the groups a user can read in
+   `GroupFilter` or the equivalent URIs in `UriCombinedWildcardFilter`
+ * Elasticsearch itself, which returns its own profile of each search
+ * Presenting the annotations which were found
+"""
+
+from contextlib import contextmanager
+from time import perf_counter
+
+import sqlalchemy as sa
+
+
+class SearchProfile:
+    """The steps of a search, and the Elasticsearch profile of each query."""
+
+    def __init__(self, session, clock=perf_counter):
+        """
+        Create a new search profile.
+
+        :param session: the DB session to count the SQL statements of
+        :param clock: a function returning the time in seconds
+        """
+        self._session = session
+        self._clock = clock
+        self._start = clock()
+
+        self.steps = []
+        self.searches = []
+
+    @contextmanager
+    def step(self, name):
+        """Time the wrapped block, and count the SQL statements it runs."""
+        statements = []
+
+        def count(*_args):
+            statements.append(None)
+
+        connection = self._session.connection()
+        sa.event.listen(connection, "before_cursor_execute", count)
+        start = self._clock()
+        try:
+            yield
+        finally:
+            elapsed = self._clock() - start
+            sa.event.remove(connection, "before_cursor_execute", count)
+
+            self.steps.append(
+                {
+                    "name": name,
+                    "time_ms": elapsed * 1000,
+                    "sql_statements": len(statements),
+                }
+            )
+
+    def add_response(self, name, response):
+        """
+        Record the Elasticsearch profile of a search.
+
+        :param name: what the search was for, like "annotations"
+        :param response: the `elasticsearch_dsl` response of a search made
+            with profiling turned on
+        """
+        response = response.to_dict()
+
+        self.searches.append(
+            {
+                "name": name,
+                "took_ms": response.get("took"),
+                "profile": response.get("profile"),
+            }
+        )
+
+    def asdict(self):
+        return {
+            # Including the time between steps, since the profile was created
+            "total_ms": (self._clock() - self._start) * 1000,
+            "sql_statements": sum(step["sql_statements"] for step in self.steps),
+            "steps": self.steps,
+            "elasticsearch": self.searches,
+        }
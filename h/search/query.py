@@ -1,11 +1,16 @@
+import base64
+import binascii
+import json
 from datetime import datetime as dt
 
 from dateutil import tz
 from dateutil.parser import parse
 from elasticsearch_dsl import Q
 from elasticsearch_dsl.query import SimpleQueryString
+from pyramid.settings import asbool
 
 from h import storage
+from h.schemas import ValidationError
 from h.search.util import add_default_scheme, wildcard_uri_is_valid
 from h.util import uri
 
@@ -15,6 +20,11 @@ LIMIT_MAX = 200
 OFFSET_MAX = 9800
 DEFAULT_DATE = dt(1970, 1, 1, 0, 0, 0, 0).replace(tzinfo=tz.tzutc())
 
+# The fields of the index to sort on, where they aren't the sort param
+SORT_FIELDS = {"user": "user_raw"}
+# The sort params which can be carried on from with a cursor
+CURSOR_SORTS = ("created", "updated", "group", "id", "user")
+
 
 def popall(multidict, key):
     """Pop and return all values of the key in multidict."""
@@ -82,24 +92,39 @@ class Limiter:
 
 class Sorter:
     """
-    Sorts and returns annotations after search_after.
+    Sorts and returns annotations after search_after or a cursor.
 
     Sorts annotations by sort (the key to sort by)
     and the order (the order in which to sort by).
 
     Returns annotations after search_after. search_after
     must be the value of the annotation's sort field.
+
+    Alternatively, returns annotations after cursor, which is the opaque
+    value from `cursor_for()` for the last annotation of the previous page.
+    A cursor carries the sort and order of the search it came from, which
+    override sort and order.
+
+    :raise ValidationError: If the cursor isn't a valid cursor
     """
 
     def __call__(self, search, params):
         sort_by = params.pop("sort", "updated")
-        # Sorting must be done on non-analyzed fields.
-        if sort_by == "user":
-            sort_by = "user_raw"
+        order = params.pop("order", "desc")
 
         # Since search_after depends on the field that the annotations are
         # being sorted by, it is set here rather than in a separate class.
         search_after = params.pop("search_after", None)
+        cursor = params.pop("cursor", None)
+        if cursor:
+            try:
+                sort_by, order, after = decode_cursor(cursor)
+            except ValueError as err:
+                raise ValidationError("cursor: cursor is not a valid cursor") from err
+
+            search = search.extra(search_after=after)
+            search_after = None
+
         if search_after:
             if sort_by in ["updated", "created"]:
                 search_after = self._parse_date(search_after)
@@ -107,10 +132,11 @@ class Sorter:
         if search_after:
             search = search.extra(search_after=[search_after])
 
-        return search.sort(
+        sort = [
             {
-                sort_by: {
-                    "order": params.pop("order", "desc"),
+                # Sorting must be done on non-analyzed fields.
+                SORT_FIELDS.get(sort_by, sort_by): {
+                    "order": order,
                     # `unmapped_type` causes unknown fields specified as arguments to
                     # `sort` behave as if all documents contained empty values of the
                     # given type. Without this, specifying eg. `sort=foobar` throws
@@ -121,7 +147,15 @@ class Sorter:
                     "unmapped_type": "boolean",
                 }
             }
-        )
+        ]
+
+        # Break ties by id, so every annotation has its own place in the order
+        # for a cursor to carry on from. search_after only has a value for
+        # the first field, so searches using it don't.
+        if sort_by != "id" and not search_after:
+            sort.append({"id": {"order": order}})
+
+        return search.sort(*sort)
 
     @staticmethod
     def _parse_date(str_value):
@@ -154,6 +188,68 @@ class Sorter:
         return None
 
 
+def encode_cursor(sort_by, order, after):
+    """
+    Encode where a search is up to as an opaque cursor.
+
+    :param sort_by: The sort param of the search
+    :param order: The order param of the search
+    :param after: The sort values of the last annotation returned
+    """
+    value = json.dumps([sort_by, order, after], separators=(",", ":"))
+
+    return base64.urlsafe_b64encode(value.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    Decode a cursor from `encode_cursor()`.
+
+    :returns: The sort, order and sort values of the cursor
+    :raise ValueError: If `cursor` isn't a valid cursor
+    """
+    try:
+        sort_by, order, after = json.loads(
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        )
+    except (binascii.Error, TypeError, ValueError) as err:
+        raise ValueError("Invalid cursor") from err
+
+    if (
+        sort_by not in CURSOR_SORTS
+        or order not in ("asc", "desc")
+        or not isinstance(after, list)
+        or len(after) != (1 if sort_by == "id" else 2)
+        or not all(isinstance(value, (str, int, float)) for value in after)
+    ):
+        raise ValueError("Invalid cursor")
+
+    return sort_by, order, after
+
+
+def cursor_for(search, hit):
+    """
+    Get the cursor for the results of `search` after `hit`.
+
+    :param search: The search, sorted by `Sorter`
+    :type search: elasticsearch_dsl.Search
+    :param hit: One of the hits of `search`
+    :returns: The cursor, or `None` if the search can't be carried on from
+        `hit` with one
+    """
+    sort = search.to_dict().get("sort", [])
+    after = list(hit["sort"]) if "sort" in hit else []
+    if not sort or len(after) != len(sort) or None in after:
+        return None
+
+    ((field, options),) = sort[0].items()
+    sort_by = {value: key for key, value in SORT_FIELDS.items()}.get(field, field)
+    if sort_by not in CURSOR_SORTS or len(after) != (1 if sort_by == "id" else 2):
+        return None
+
+    return encode_cursor(sort_by, options["order"], after)
+
+
 class TopLevelAnnotationsFilter:
     """Matches top-level annotations only, filters out replies."""
 
@@ -161,6 +257,13 @@ class TopLevelAnnotationsFilter:
         return search.exclude("exists", field="references")
 
 
+class ReplyFilter:
+    """Matches replies only, filters out top-level annotations."""
+
+    def __call__(self, search, _):
+        return search.filter("exists", field="references")
+
+
 class AuthorityFilter:
     """Match annotations created by users belonging to a specific authority."""
 
@@ -203,17 +306,31 @@ class GroupFilter:
 
     This excludes annotations from groups that the user is not authorized to
     read or which are explicitly excluded by the search query.
+
+    With the `h.search.world_readable_flag` setting, annotations in
+    world-readable groups are matched by the `group_world_readable` flag they
+    are indexed with, rather than by listing every world-readable group.
     """
 
     def __init__(self, request):
         self.user = request.user
         self.group_service = request.find_service(name="group")
+        self.world_readable_flag = asbool(
+            request.registry.settings.get("h.search.world_readable_flag")
+        )
 
     def __call__(self, search, params):
         group_ids = None
         if "group" in params:
             # Remove parameter if passed, preventing it being passed to default query
             group_ids = [params.pop("group")]
+
+        if self.world_readable_flag and group_ids is None:
+            member_groups = self.group_service.member_groupids_readable_by(self.user)
+            return search.filter(
+                Q("term", group_world_readable=True) | Q("terms", group=member_groups)
+            )
+
         groups = self.group_service.groupids_readable_by(self.user, group_ids)
 
         return search.filter("terms", group=groups)
@@ -402,6 +519,56 @@ class RepliesMatcher:
         )
 
 
+class RepliesAggregation:
+    """
+    Aggregate the replies to each of the given annotations.
+
+    Only the `limit` most recently updated replies to each annotation are
+    returned, along with how many replies it has in all.
+
+    Without `ids`, the replies to any annotation are aggregated, for up to
+    `size` annotations with the most replies.
+    """
+
+    def __init__(self, ids, limit, size=None):
+        self.annotation_ids = ids
+        self.limit = limit
+        self.size = len(ids) if ids is not None else size
+        self.name = "replies"
+
+    def __call__(self, search, _):
+        # Replies to replies reference the top-level annotation as well, so
+        # there's a bucket for each thread
+        terms = {"field": "references", "size": self.size}
+        if self.annotation_ids is not None:
+            terms["include"] = self.annotation_ids
+
+        search.aggs.bucket(self.name, "terms", **terms).metric(
+            "latest",
+            "top_hits",
+            size=self.limit,
+            sort=[{"updated": {"order": "desc"}}, {"id": {"order": "desc"}}],
+            _source=False,
+        )
+
+    def parse_result(self, result):
+        """
+        Get the replies to each annotation.
+
+        :returns: A dict of annotation ids to the total number of replies to
+            that annotation and a list of the returned reply hits, most
+            recently updated first
+        """
+        return {
+            b["key"]: (b["doc_count"], list(b["latest"]["hits"]["hits"]))
+            for b in result[self.name]["buckets"]
+        }
+
+    def is_complete(self, result):
+        """Get whether every annotation with replies has a bucket in `result`."""
+        return not result[self.name]["sum_other_doc_count"]
+
+
 class TagsAggregation:
     def __init__(self, limit=10):
         self.limit = limit
@@ -14,6 +14,7 @@ from zope.sqlalchemy import mark_changed
 
 from h.models import Group, GroupMembership, User, UserIdentity
 from h.models.group import PRIVATE_GROUP_TYPE_FLAGS
+from h.services.group import ReadableGroupsCache
 
 
 class DBAction:
@@ -120,6 +121,11 @@ class GroupUpsertAction(DBAction):
         for value in values:
             value.update(static_values)
 
+        # The cached readable groups don't need invalidating: new groups are
+        # members-only and have no members yet, and existing ones only have
+        # their names updated. Adding members invalidates them (see
+        # `GroupMembershipCreateAction`)
+
         stmt = insert(Group).values(values)
         stmt = stmt.on_conflict_do_update(
             index_elements=["authority", "authority_provided_id"],
@@ -160,6 +166,17 @@ class GroupMembershipCreateAction(DBAction):
                                   or group that does not exist
     """
 
+    def __init__(self, db, readable_cache=None):
+        """
+        Initialize GroupMembershipCreateAction.
+
+        :param db: DB session object
+        :param readable_cache: The `ReadableGroupsCache` to invalidate the
+                               groups of new members in
+        """
+        super().__init__(db)
+        self.readable_cache = readable_cache or ReadableGroupsCache(None)
+
     def execute(  # pylint: disable=arguments-differ
         self, batch, on_duplicate="continue", **_
     ):
@@ -205,6 +222,10 @@ class GroupMembershipCreateAction(DBAction):
 
             raise
 
+        self.readable_cache.invalidate(
+            user_ids=sorted({value["user_id"] for value in values})
+        )
+
         return [Report(id_) for (id_,) in membership_rows]
 
 
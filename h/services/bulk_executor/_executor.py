@@ -16,12 +16,14 @@ from h.services.bulk_executor._actions import (
 class BulkExecutor(Executor):
     """Executor of command objects which will modify the database in bulk."""
 
-    def __init__(self, db, authority):
+    def __init__(self, db, authority, readable_cache=None):
         """
         Initialize BulkExecutor.
 
         :param db: DB session object
         :param authority: Restrict all request to this authority
+        :param readable_cache: The `ReadableGroupsCache` to invalidate when
+                               adding users to groups
         """
         self.db = db
         self.authority = authority
@@ -32,7 +34,7 @@ class BulkExecutor(Executor):
             (
                 CommandType.CREATE,
                 DataType.GROUP_MEMBERSHIP,
-            ): GroupMembershipCreateAction(self.db),
+            ): GroupMembershipCreateAction(self.db, readable_cache=readable_cache),
         }
 
         self.effective_user_id = None
@@ -1,4 +1,6 @@
 from h.models import Annotation
+from h.models.group import ReadableBy
+from h.services.group import readable_groups_cache
 
 
 class DeletePublicGroupError(Exception):
@@ -20,6 +22,11 @@ class DeleteGroupService:
         self._delete_annotations(group)
         self.request.db.delete(group)
 
+        readable_groups_cache(self.request).invalidate(
+            user_ids=[member.id for member in group.members],
+            world=group.readable_by == ReadableBy.world,
+        )
+
     def _delete_annotations(self, group):
         if group.pubid == "__world__":
             raise DeletePublicGroupError("Public group can not be deleted")
@@ -1,3 +1,5 @@
+import uuid
+
 import sqlalchemy as sa
 
 from h.models import Group, User
@@ -5,17 +7,135 @@ from h.models.group import ReadableBy
 from h.util import group as group_util
 
 
+class ReadableGroupsCache:
+    """
+    A cache of the pubids of the groups users can read.
+
+    The world-readable groups, and the members-only groups each user is a
+    member of, are kept in the backend of the search cache (see
+    `h.search.cache`), so this is only enabled along with it. Entries are
+    invalidated by the services which change them once their transaction has
+    committed. Like cached searches, the key of each entry includes a
+    generation token which is read before the groups are queried, so groups
+    read before a change was committed are never cached under the generation
+    after it.
+
+    When the search cache only caches logged out users' searches (because
+    its backend is in each process, and invalidations don't reach the
+    others) only the world-readable groups are cached, and only briefly.
+    """
+
+    # The key of the world-readable groups, and the prefix of the key of each
+    # user's members-only groups
+    WORLD_KEY = "readable-groups:world"
+    USER_KEY = "readable-groups:user:"
+
+    # How long (in seconds) the world-readable groups are cached for when
+    # invalidations don't reach every process
+    PROCESS_TTL = 10
+
+    def __init__(self, search_cache, tm=None):
+        """
+        Create a new readable groups cache.
+
+        :param search_cache: the `h.search.cache.SearchCache`, or `None` if
+            search results aren't cached
+        :param tm: the transaction manager, so that entries are invalidated
+            once its current transaction has committed, or `None` to
+            invalidate them straight away
+        """
+        self._search_cache = search_cache
+        self._tm = tm
+
+    def entry_key(self, key):
+        """
+        Get the key the groups for `key` are cached under.
+
+        This should be worked out before the groups are queried, and used to
+        both get and set them.
+
+        :returns: The key, or `None` if the groups for `key` aren't cached
+        """
+        if self._search_cache is None:
+            return None
+
+        if self._search_cache.anonymous_only and key != self.WORLD_KEY:
+            return None
+
+        generation = self._search_cache.backend.get(self._generation_key(key))
+        if generation is None:
+            generation = self._new_generation(key)
+
+        return key + ":" + generation
+
+    def get(self, entry_key):
+        """Get the cached pubids, or `None` if they aren't cached."""
+        if entry_key is None:
+            return None
+
+        return self._search_cache.backend.get(entry_key)
+
+    def set(self, entry_key, pubids):
+        if entry_key is None:
+            return
+
+        if self._search_cache.anonymous_only:
+            ttl = self.PROCESS_TTL
+        else:
+            ttl = self._search_cache.ttl
+
+        self._search_cache.backend.set(entry_key, pubids, ttl)
+
+    def invalidate(self, user_ids=(), world=False):
+        """
+        Invalidate the cached groups of the users with `user_ids`.
+
+        This happens once the current transaction has committed, if there's a
+        transaction manager.
+
+        :param user_ids: the ids (not userids) of the users
+        :param world: whether to invalidate the world-readable groups as well
+        """
+        if self._search_cache is None:
+            return
+
+        keys = [self.USER_KEY + str(user_id) for user_id in user_ids]
+        if world:
+            keys.append(self.WORLD_KEY)
+
+        def new_generations(committed=True):
+            if committed:
+                for key in keys:
+                    self._new_generation(key)
+
+        if self._tm is None:
+            new_generations()
+        else:
+            self._tm.get().addAfterCommitHook(new_generations)
+
+    def _new_generation(self, key):
+        generation = uuid.uuid4().hex
+        self._search_cache.backend.set(self._generation_key(key), generation)
+        return generation
+
+    @staticmethod
+    def _generation_key(key):
+        return key + ":generation"
+
+
 class GroupService:
-    def __init__(self, session, user_fetcher):
+    def __init__(self, session, user_fetcher, readable_cache=None):
         """
         Create a new groups service.
 
         :param session: the SQLAlchemy session object
         :param user_fetcher: a callable for fetching users by userid
-        :param publish: a callable for publishing events
+        :param readable_cache: the `ReadableGroupsCache` to cache which groups
+            users can read in, if any
         """
         self.session = session
         self.user_fetcher = user_fetcher
+        self.readable_cache = readable_cache or ReadableGroupsCache(None)
 
     def fetch(self, pubid_or_groupid):
         """
@@ -90,22 +210,65 @@ class GroupService:
 
         :type user: `h.models.user.User`
         """
+        if not group_ids:
+            return self.world_readable_groupids() + self.member_groupids_readable_by(
+                user
+            )
+
         readable = Group.readable_by == ReadableBy.world
 
         if user is not None:
-            readable_member = sa.and_(
-                Group.readable_by == ReadableBy.members,
-                Group.members.any(User.id == user.id),
-            )
-            readable = sa.or_(readable, readable_member)
+            readable = sa.or_(readable, self._readable_member(user))
 
-        if group_ids:
-            readable = sa.and_(Group.pubid.in_(group_ids), readable)
+        readable = sa.and_(Group.pubid.in_(group_ids), readable)
 
         return [
             record.pubid for record in self.session.query(Group.pubid).filter(readable)
         ]
 
+    def world_readable_groupids(self):
+        """Return a list of pubids of the groups anyone can read."""
+        return self._cached_groupids(
+            ReadableGroupsCache.WORLD_KEY, Group.readable_by == ReadableBy.world
+        )
+
+    def member_groupids_readable_by(self, user):
+        """
+        Return a list of pubids of the members-only groups the user can read.
+
+        If the passed-in user is ``None``, this returns an empty list.
+
+        :type user: `h.models.user.User` or None
+        """
+        if user is None:
+            return []
+
+        return self._cached_groupids(
+            ReadableGroupsCache.USER_KEY + str(user.id), self._readable_member(user)
+        )
+
+    def _cached_groupids(self, key, criterion):
+        # The entry key is worked out before querying the groups, so a change
+        # committed in between invalidates what's read
+        entry_key = self.readable_cache.entry_key(key)
+        pubids = self.readable_cache.get(entry_key)
+
+        if pubids is None:
+            pubids = [
+                record.pubid
+                for record in self.session.query(Group.pubid).filter(criterion)
+            ]
+            self.readable_cache.set(entry_key, pubids)
+
+        return pubids
+
+    @staticmethod
+    def _readable_member(user):
+        return sa.and_(
+            Group.readable_by == ReadableBy.members,
+            Group.members.any(User.id == user.id),
+        )
+
     def groupids_created_by(self, user):
         """
         Return a list of pubids which the user created.
@@ -125,4 +288,17 @@ class GroupService:
 def groups_factory(_context, request):
     """Return a GroupService instance for the passed context and request."""
     user_service = request.find_service(name="user")
-    return GroupService(session=request.db, user_fetcher=user_service.fetch)
+    return GroupService(
+        session=request.db,
+        user_fetcher=user_service.fetch,
+        readable_cache=readable_groups_cache(request),
+    )
+
+
+def readable_groups_cache(request):
+    """Return the `ReadableGroupsCache` for the passed request."""
+    search_cache = request.registry.get("search.cache")
+    if search_cache is None:
+        return ReadableGroupsCache(None)
+
+    return ReadableGroupsCache(search_cache, tm=request.tm)
@@ -6,21 +6,26 @@ from h.models.group import (
     OPEN_GROUP_TYPE_FLAGS,
     PRIVATE_GROUP_TYPE_FLAGS,
     RESTRICTED_GROUP_TYPE_FLAGS,
+    ReadableBy,
 )
+from h.services.group import ReadableGroupsCache, readable_groups_cache
 
 
 class GroupCreateService:
-    def __init__(self, db, user_fetcher, publish):
+    def __init__(self, db, user_fetcher, publish, readable_cache=None):
         """
         Create a new GroupCreateService.
 
         :param db: the SQLAlchemy session object
         :param user_fetcher: a callable for fetching users by userid
         :param publish: a callable for publishing events
+        :param readable_cache: the `ReadableGroupsCache` to invalidate when
+            groups are created, if any
         """
         self.db = db
         self.user_fetcher = user_fetcher
         self.publish = publish
+        self.readable_cache = readable_cache or ReadableGroupsCache(None)
 
     def create_private_group(self, name, userid, **kwargs):
         """
@@ -140,6 +145,11 @@ class GroupCreateService:
 
             self.publish("group-join", group.pubid, group.creator.userid)
 
+        self.readable_cache.invalidate(
+            user_ids=[creator.id] if add_creator_as_member else [],
+            world=group.readable_by == ReadableBy.world,
+        )
+
         return group
 
     @staticmethod
@@ -159,6 +169,7 @@ def group_create_factory(_context, request):
         db=request.db,
         user_fetcher=user_service.fetch,
         publish=partial(_publish, request),
+        readable_cache=readable_groups_cache(request),
     )
 
 
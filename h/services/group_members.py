@@ -1,22 +1,26 @@
 from functools import partial
 
 from h import session
+from h.services.group import ReadableGroupsCache, readable_groups_cache
 
 
 class GroupMembersService:
     """A service for manipulating group membership."""
 
-    def __init__(self, db, user_fetcher, publish):
+    def __init__(self, db, user_fetcher, publish, readable_cache=None):
         """
         Create a new GroupMembersService.
 
         :param db: the SQLAlchemy db object
         :param user_fetcher: a callable for fetching users by userid
         :param publish: a callable for publishing events
+        :param readable_cache: the `ReadableGroupsCache` to invalidate when
+            users join or leave groups, if any
         """
         self.db = db
         self.user_fetcher = user_fetcher
         self.publish = publish
+        self.readable_cache = readable_cache or ReadableGroupsCache(None)
 
     def add_members(self, group, userids):
         """
@@ -61,6 +65,7 @@ class GroupMembersService:
             return
 
         group.members.append(user)
+        self.readable_cache.invalidate(user_ids=[user.id])
 
         self.publish("group-join", group.pubid, userid)
 
@@ -72,6 +77,7 @@ class GroupMembersService:
             return
 
         group.members.remove(user)
+        self.readable_cache.invalidate(user_ids=[user.id])
 
         self.publish("group-leave", group.pubid, userid)
 
@@ -83,6 +89,7 @@ def group_members_factory(_context, request):
         db=request.db,
         user_fetcher=user_service.fetch,
         publish=partial(_publish, request),
+        readable_cache=readable_groups_cache(request),
     )
 
 
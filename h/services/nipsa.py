@@ -1,12 +1,18 @@
+from functools import partial
+
+from h_pyramid_sentry import report_exception
+
+from h.exceptions import RealtimeMessageQueueError
 from h.models import User
 
 
 class NipsaService:
     """A service which provides access to the state of "not-in-public-site-areas" (NIPSA) flags on userids."""
 
-    def __init__(self, session, get_search_index):
+    def __init__(self, session, get_search_index, publish):
         self.session = session
         self._get_search_index = get_search_index
+        self._publish = publish
 
         # Cache of all userids which have been flagged.
         self._flagged_userids = None
@@ -48,12 +54,14 @@ class NipsaService:
 
         Add the given user's ID to the list of NIPSA'd user IDs. If the user
         is already NIPSA'd then nothing will happen (but an "add_nipsa"
-        message for the user will still be published to the queue).
+        message for the user will still be published to the queue once the
+        transaction commits).
         """
         user.nipsa = True
         if self._flagged_userids is not None:
             self._flagged_userids.add(user.userid)
         self._reindex_users_annotations(user, tag="NipsaService.flag")
+        self._publish(user.userid, True)
 
     def unflag(self, user):
         """
@@ -61,12 +69,13 @@ class NipsaService:
 
         If the user isn't NIPSA'd then nothing will happen (but a
         "remove_nipsa" message for the user will still be published to the
-        queue).
+        queue once the transaction commits).
         """
         user.nipsa = False
         if self._flagged_userids is not None:
             self._flagged_userids.remove(user.userid)
         self._reindex_users_annotations(user, tag="NipsaService.unflag")
+        self._publish(user.userid, False)
 
     def clear(self):
         """Unload the cache of flagged userids, if populated."""
@@ -92,4 +101,23 @@ def nipsa_factory(_context, request):
     def get_search_index():
         return request.find_service(name="search_index")
 
-    return NipsaService(request.db, get_search_index)
+    return NipsaService(request.db, get_search_index, partial(_publish, request))
+
+
+def _publish(request, userid, nipsa):
+    # Let the streamer know once the change has been committed, so that it
+    # doesn't reload the flagged users before the change is visible to it. It
+    # reloads them every so often anyway, so we don't fail the change if we
+    # can't tell it.
+    def publish(committed=True):
+        if not committed:
+            return
+
+        try:
+            request.realtime.publish_user(
+                {"type": "nipsa-change", "userid": userid, "nipsa": nipsa}
+            )
+        except RealtimeMessageQueueError as err:
+            report_exception(err)
+
+    request.tm.get().addAfterCommitHook(publish)
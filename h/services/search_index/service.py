@@ -2,6 +2,7 @@ from h_pyramid_sentry import report_exception
 
 from h import storage
 from h.presenters import AnnotationSearchIndexPresenter
+from h.search.cache import annotation_tags
 from h.tasks import indexer
 
 
@@ -46,6 +47,7 @@ class SearchIndexService:
             return
 
         self.add_annotation(annotation)
+        self._invalidate_search_cache(annotation_id)
 
         if annotation.is_reply:
             self.add_annotation_by_id(annotation.thread_root_id)
@@ -111,6 +113,7 @@ class SearchIndexService:
         """
 
         self._index_annotation_body(annotation_id, {"deleted": True}, refresh=refresh)
+        self._invalidate_search_cache(annotation_id)
 
     def handle_annotation_event(self, event):
         """
@@ -144,6 +147,29 @@ class SearchIndexService:
         """Process `limit` sync_annotation jobs from the job queue."""
         return self._queue.sync(limit)
 
+    def _invalidate_search_cache(self, annotation_id):
+        """
+        Invalidate the cached searches which might match an annotation.
+
+        This is done once the annotation has been indexed (whether that's
+        straight after it changed or later by a Celery task), so that searches
+        cached before then are never served afterwards.
+        """
+        search_cache = self._request.registry.get("search.cache")
+        if search_cache is None:
+            return
+
+        annotation = storage.fetch_annotation(self._db, annotation_id)
+        if annotation is None:
+            return
+
+        search_cache.invalidate(
+            annotation_tags(
+                annotation,
+                storage.expand_uri(self._db, annotation.target_uri, normalized=True),
+            )
+        )
+
     def _index_annotation_body(self, annotation_id, body, refresh, target_index=None):
         self._es.conn.index(
             index=self._es.index if target_index is None else target_index,
@@ -21,7 +21,7 @@ from pyramid import i18n
 
 from h import models, schemas
 from h.db import types
-from h.models.document import update_document_metadata
+from h.models.document import EXPANDED_URIS, update_document_metadata
 from h.security import Permission
 from h.traversal.group import GroupContext
 from h.util.group_scope import url_in_scope
@@ -71,6 +71,9 @@ def fetch_ordered_annotations(session, ids, query_processor=None):
     :returns: the annotation, if found, or None.
     :rtype: h.models.Annotation, NoneType
     """
+    # Skip ids which aren't valid UUIDs, like `fetch_annotation()` does,
+    # rather than failing to find any of the annotations
+    ids = [id_ for id_ in ids if _is_valid_id(id_)]
     if not ids:
         return []
 
@@ -84,6 +87,15 @@ def fetch_ordered_annotations(session, ids, query_processor=None):
     return anns
 
 
+def _is_valid_id(id_):
+    try:
+        types.URLSafeUUID.url_safe_to_hex(id_)
+    except types.InvalidUUID:
+        return False
+
+    return True
+
+
 def create_annotation(request, data):
     """
     Create an annotation from already-validated data.
@@ -202,7 +214,8 @@ def expand_uri(session, uri, normalized=False):
 
     This function determines whether we already have "document" records for the
     passed URI, and if so returns the set of all URIs which we currently
-    believe refer to the same document.
+    believe refer to the same document. The URIs of each document are cached
+    in each process (see `h.models.document.ExpandedURICache`).
 
     :param session: Database session
     :param uri: URI associated with the document
@@ -213,22 +226,26 @@ def expand_uri(session, uri, normalized=False):
 
     normalized_uri = normalize_uri(uri)
 
-    document_id = (
-        session.query(models.DocumentURI.document_id)
-        .filter(models.DocumentURI.uri_normalized == normalized_uri)
-        .limit(1)
-        .scalar_subquery()
-    )
+    type_uris = EXPANDED_URIS.get(normalized_uri)
+    if type_uris is None:
+        generation = EXPANDED_URIS.generation
+        document_id = (
+            session.query(models.DocumentURI.document_id)
+            .filter(models.DocumentURI.uri_normalized == normalized_uri)
+            .limit(1)
+            .scalar_subquery()
+        )
 
-    type_uris = list(
-        session.query(
-            # Using the specific fields we want prevents object creation
-            # which significantly speeds this method up (knocks ~40% off)
-            models.DocumentURI.type,
-            models.DocumentURI.uri,
-            models.DocumentURI.uri_normalized,
-        ).filter(models.DocumentURI.document_id == document_id)
-    )
+        type_uris = list(
+            session.query(
+                # Using the specific fields we want prevents object creation
+                # which significantly speeds this method up (knocks ~40% off)
+                models.DocumentURI.type,
+                models.DocumentURI.uri,
+                models.DocumentURI.uri_normalized,
+            ).filter(models.DocumentURI.document_id == document_id)
+        )
+        EXPANDED_URIS.set(normalized_uri, type_uris, generation)
 
     if not type_uris:
         return [normalized_uri if normalized else uri]
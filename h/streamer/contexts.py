@@ -1,11 +1,68 @@
 from contextlib import contextmanager
 
 from pyramid.scripting import prepare
+from pyramid.threadlocal import RequestContext
+from pyramid_services import get_services
+from zope.interface import Interface
+
+# The key the reusable request is kept under in the registry
+_REQUEST_KEY = "h.streamer.request"
+
+# Services which hold no state from one message to the next, and so can be
+# shared by all of them. Services which cache anything from the DB (like the
+# `user` service) must not be shared, or they would go stale.
+SHARED_SERVICES = ("links",)
 
 
 @contextmanager
-def request_context(registry):
-    """Convert a registry into a fake, but working Pyramid request."""
+def request_context(registry, session):
+    """
+    Convert a registry into a fake, but working Pyramid request.
+
+    Building a request with `pyramid.scripting.prepare()` is comparatively
+    slow, so the same request is reused every time this is called with the
+    same registry. Anything which could leak from one message to the next is
+    reset each time: the request's services are recreated (apart from those
+    in `SHARED_SERVICES`) and `request.db` is set to `session`.
+
+    As the request is shared, this must not be used by more than one greenlet
+    at a time. The streamer only uses it from the work queue greenlet.
+
+    :param registry: The Pyramid registry to create the request with
+    :param session: The DB session for the request to use
+    """
+    request = registry.get(_REQUEST_KEY)
+    if request is None:
+        request = registry[_REQUEST_KEY] = _make_request(registry)
+
+    _reset(request, session)
+
+    with RequestContext(request):
+        yield request
 
+
+def _make_request(registry):
     with prepare(registry=registry) as env:
-        yield env["request"]
+        request = env["request"]
+
+    request.shared_services = {}
+    return request
+
+
+def _reset(request, session):
+    request.db = session
+
+    # Start each message with a fresh set of services, apart from the ones
+    # which are safe to share
+    request.services = get_services(request)
+    for name in SHARED_SERVICES:
+        service = request.shared_services.get(name)
+        if service is not None:
+            request.services.set(service, Interface, context=request.context, name=name)
+            continue
+
+        try:
+            request.shared_services[name] = request.find_service(name=name)
+        except LookupError:
+            # The service isn't registered, so there's nothing to share
+            pass
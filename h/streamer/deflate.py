@@ -0,0 +1,203 @@
+"""
+Support for the permessage-deflate websocket extension (:rfc:`7692`).
+
+ws4py doesn't implement any websocket extensions, so this module provides the
+pieces we need: negotiating the extension during the handshake, compressing
+outgoing messages and inflating incoming ones before ws4py parses them.
+
+We always ask clients to accept ``server_no_context_takeover``. That means
+each message we send is compressed on its own, rather than with reference to
+the messages sent before it on the same connection, so a compressed message
+can be built once and sent to every client which negotiated the extension.
+"""
+
+import struct
+import zlib
+
+from ws4py.framing import OPCODE_CONTINUATION, OPCODE_TEXT, Frame
+
+EXTENSION = "permessage-deflate"
+
+# The extension response we send to clients which offer permessage-deflate
+RESPONSE = f"{EXTENSION}; server_no_context_takeover"
+
+# The parameters in a client's offer which we can agree to. See
+# `negotiate()` for the values we accept for `server_max_window_bits`.
+_ACCEPTED_PARAMS = {
+    "client_max_window_bits",
+    "client_no_context_takeover",
+    "server_max_window_bits",
+    "server_no_context_takeover",
+}
+
+# The bytes which end every message compressed with a sync flush. These are
+# removed before sending and restored before inflating (RFC 7692 section 7.2)
+_TAIL = b"\x00\x00\xff\xff"
+
+# The biggest frame (in bytes, as sent) we'll buffer, and the biggest message
+# (in bytes, once inflated) we'll inflate. Clients only send small JSON
+# messages, and without these a small compressed frame could inflate to
+# hundreds of megabytes.
+MAX_FRAME_SIZE = 1024 * 1024
+MAX_MESSAGE_SIZE = 1024 * 1024
+
+
+class MessageTooBig(Exception):
+    """A client sent a frame or message bigger than we'll buffer or inflate."""
+
+
+def negotiate(offers):
+    """
+    Agree to permessage-deflate if it is in the client's extension offers.
+
+    :param offers: The value of the client's ``Sec-WebSocket-Extensions``
+        handshake header, or `None`
+    :return: The ``Sec-WebSocket-Extensions`` header value to respond with, or
+        `None` if the client didn't offer anything we can accept
+    """
+    for offer in (offers or "").split(","):
+        name, *params = [part.strip() for part in offer.split(";")]
+        if name != EXTENSION:
+            continue
+
+        params = dict(
+            (key.strip(), value.strip().strip('"'))
+            for key, _, value in (param.partition("=") for param in params)
+        )
+        if not _ACCEPTED_PARAMS.issuperset(params):
+            continue
+
+        # We always compress with the largest window, so can't agree to a
+        # client asking for a smaller one
+        if params.get("server_max_window_bits", "15") != "15":
+            continue
+
+        return RESPONSE
+
+    return None
+
+
+def deflate(data, level):
+    """Get the compressed payload of a message frame for `data`."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    payload = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    return payload[: -len(_TAIL)]
+
+
+def deflate_frame(data, level):
+    """Build an unmasked, compressed text frame for `data`."""
+    return Frame(opcode=OPCODE_TEXT, body=deflate(data, level), fin=1, rsv1=1).build()
+
+
+class Inflater:
+    """
+    Inflates compressed frames received on a single connection.
+
+    Bytes read from the socket are passed to `frames()`, which yields
+    complete frames with any compressed payload inflated, ready to be parsed
+    by ws4py as normal. Incomplete frames are buffered until the rest of
+    their bytes arrive.
+    """
+
+    def __init__(
+        self, max_frame_size=MAX_FRAME_SIZE, max_message_size=MAX_MESSAGE_SIZE
+    ):
+        self._buffer = b""
+        self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._max_frame_size = max_frame_size
+        self._max_message_size = max_message_size
+
+        # Whether the frames being received belong to a compressed message.
+        # Only the first frame of a fragmented message is marked as compressed
+        self._inflating = False
+        # How many bytes the message being received has inflated to so far
+        self._inflated = 0
+
+    def frames(self, data):
+        """
+        Yield each complete frame available after receiving `data`.
+
+        :raises MessageTooBig: if a frame or the message it's part of is
+            bigger than the limits
+        """
+        self._buffer += data
+
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                return
+
+            yield frame
+
+    def _next_frame(self):
+        buffer = self._buffer
+        if len(buffer) < 2:
+            return None
+
+        fin, rsv1, opcode = buffer[0] >> 7, (buffer[0] >> 6) & 1, buffer[0] & 0xF
+        masked, length = buffer[1] >> 7, buffer[1] & 0x7F
+
+        offset = 2
+        if length >= 126:
+            size, format_ = (2, "!H") if length == 126 else (8, "!Q")
+            if len(buffer) < offset + size:
+                return None
+            (length,) = struct.unpack(format_, buffer[offset : offset + size])
+            offset += size
+
+        if length > self._max_frame_size:
+            raise MessageTooBig(f"Frame of {length} bytes is too big")
+
+        masking_key = None
+        if masked:
+            masking_key = buffer[offset : offset + 4]
+            offset += 4
+
+        if len(buffer) < offset + length:
+            return None
+
+        frame, self._buffer = buffer[: offset + length], buffer[offset + length :]
+
+        if opcode >= 0x8:
+            # Control frames can arrive between the frames of a fragmented
+            # message, but are never compressed themselves
+            return frame
+
+        if opcode == OPCODE_CONTINUATION:
+            compressed = self._inflating
+        else:
+            compressed = self._inflating = bool(rsv1)
+
+        if fin:
+            self._inflating = False
+
+        if not compressed:
+            return frame
+
+        return self._inflate(frame[offset:], opcode, fin, masking_key)
+
+    def _inflate(self, payload, opcode, fin, masking_key):
+        if masking_key:
+            payload = bytes(Frame(masking_key=masking_key).unmask(payload))
+
+        # The end of a compressed message has its tail removed by the client
+        if fin:
+            payload += _TAIL
+
+        # Inflate no more than one byte over the limit, and leave the rest of
+        # the payload uninflated, to tell if the message is too big
+        body = self._decompressor.decompress(
+            payload, self._max_message_size - self._inflated + 1
+        )
+        self._inflated += len(body)
+        if (
+            self._inflated > self._max_message_size
+            or self._decompressor.unconsumed_tail
+        ):
+            raise MessageTooBig("Message inflates to too many bytes")
+
+        if fin:
+            self._inflated = 0
+
+        return Frame(opcode=opcode, body=body, masking_key=masking_key, fin=fin).build()
@@ -1,4 +1,8 @@
-from h import storage
+import sys
+import weakref
+from urllib.parse import urlsplit
+
+from h import realtime, storage
 from h.util.uri import normalize as normalize_uri
 
 FILTER_SCHEMA = {
@@ -16,7 +20,10 @@ FILTER_SCHEMA = {
             "type": "array",
             "items": {
                 "field": {"type": "string", "format": "json-pointer"},
-                "operator": {"type": "string", "enum": ["equals", "one_of"]},
+                "operator": {
+                    "type": "string",
+                    "enum": ["equals", "one_of", "prefix"],
+                },
                 "value": "object",
             },
         },
@@ -25,24 +32,147 @@ FILTER_SCHEMA = {
 }
 
 
+class FilterRows(frozenset):
+    """
+    The `(field, value)` rows of a socket's filter.
+
+    Many sockets watch the same few popular documents with identical filters,
+    so these are interned and shared between sockets, like
+    `h.streamer.websocket.PrincipalSet`. See `intern_rows()`.
+    """
+
+
+# Interned filter rows. These are weakly held so that each set disappears along
+# with the last socket using it
+_FILTER_ROWS = weakref.WeakValueDictionary()
+
+
+def intern_rows(rows):
+    """Get the shared `FilterRows` for an iterable of `(field, value)` rows."""
+    key = frozenset(
+        (field, sys.intern(value) if isinstance(value, str) else value)
+        for field, value in rows
+    )
+
+    filter_rows = _FILTER_ROWS.get(key)
+    if filter_rows is None:
+        filter_rows = _FILTER_ROWS[key] = FilterRows(key)
+
+    return filter_rows
+
+
+class PrefixTrie:
+    """
+    A set of strings, which can find the ones which are prefixes of a string.
+
+    Finding the prefixes takes time proportional to the length of the string
+    being matched, however many strings are in the set.
+    """
+
+    # The key which marks the end of a string in a node, as no character is
+    # ever `None`
+    _END = None
+
+    def __init__(self):
+        self._root = {}
+
+    def add(self, string):
+        node = self._root
+        for char in string:
+            node = node.setdefault(char, {})
+
+        node[self._END] = string
+
+    def remove(self, string):
+        node = self._root
+        path = []
+        for char in string:
+            path.append((node, char))
+            node = node.get(char)
+            if node is None:
+                return
+
+        node.pop(self._END, None)
+
+        # Prune the nodes which no longer lead to any string
+        for parent, char in reversed(path):
+            if parent[char]:
+                break
+            del parent[char]
+
+    def prefixes_of(self, string):
+        """Yield each string in the set which `string` starts with."""
+        node = self._root
+        for char in string:
+            node = node.get(char)
+            if node is None:
+                return
+
+            prefix = node.get(self._END)
+            if prefix is not None:
+                yield prefix
+
+
+def normalize_uri_prefix(prefix):
+    """
+    Normalize a URI prefix as we normalize URIs.
+
+    A trailing slash is kept, as `https://example.com/docs/` shouldn't match
+    `https://example.com/docs-old`.
+
+    :return: The normalized prefix, or `None` if it isn't an absolute URI
+        with a host, as anything shorter would match too many documents
+    """
+    try:
+        normalized = normalize_uri(prefix)
+        parts = urlsplit(normalized)
+        host = parts.hostname
+    except ValueError:
+        return None
+
+    if not parts.scheme or not host:
+        return None
+
+    if prefix.endswith("/") and not normalized.endswith("/"):
+        normalized += "/"
+
+    return normalized
+
+
 class SocketFilter:
     KNOWN_FIELDS = {"/id", "/group", "/uri", "/references"}
 
+    # The field of the rows for `prefix` clauses on `/uri`
+    URI_PREFIX = "/uri prefix"
+
+    # Inverted index of `(field, value)` to the sockets subscribed to it. This
+    # is maintained by `set_filter()` and `remove_filter()` so that matching
+    # an annotation is a handful of lookups rather than a scan of every socket
+    _index = {}
+
+    # Every URI prefix in the index, so an annotation's URIs can be matched
+    # against all of them at once
+    _uri_prefixes = PrefixTrie()
+
+    # The groups in the index, and the number of rows in the index for any
+    # other field, to tell which events the sockets want (see `routing_keys()`)
+    _groups = set()
+    _other_rows = 0
+    _routing_keys = None
+
     @classmethod
-    def matching(cls, sockets, annotation, session):
+    def matching(cls, annotation, session):
         """
         Find sockets with matching filters for the given annotation.
 
         For this to work, the sockets must have first had `set_filter()` called
         on them.
 
-        :param sockets: Iterable of sockets to check
         :param annotation: Annotation to match
         :param session: DB session
 
         :return: A generator of matching socket objects
         """
-
         values = {
             "/id": [annotation.id],
             "/group": [annotation.groupid],
@@ -54,30 +184,147 @@ class SocketFilter:
             "/references": set(annotation.references),
         }
 
-        for socket in sockets:
-            # Some sockets might not yet have the filter applied (or had a non
-            # parsable filter etc.)
-            if not hasattr(socket, "filter_rows"):
-                continue
+        # Gather the sockets up front, as sockets can be closed (and removed
+        # from the index) while the caller is iterating over the results
+        sockets = set()
+        for row in cls._rows_for_values(values):
+            subscribers = cls._index.get(row)
+            if subscribers:
+                sockets.update(subscribers)
 
-            # Iterate over the filter_rows added by `set_filter()`
-            for field, value in socket.filter_rows:
-                try:  # pylint: disable=too-many-try-statements
-                    if value in values[field]:
-                        yield socket
-                        break
-                except KeyError:
-                    continue
+        yield from sockets
+
+    @classmethod
+    def might_match(cls, payload):
+        """
+        Check whether any socket could match an annotation event.
+
+        This uses the routing keys published with the event (see
+        `h.subscribers.publish_annotation_event`) so it can be called before
+        loading anything from the DB. Events without routing keys might always
+        match.
+
+        :param payload: Annotation event payload from `h.realtime`
+        """
+        try:
+            values = {
+                "/id": [payload["annotation_id"]],
+                "/group": [payload["group"]],
+                "/uri": payload["uris"],
+                "/references": payload["references"],
+            }
+        except KeyError:
+            return True
+
+        return any(row in cls._index for row in cls._rows_for_values(values))
 
     @classmethod
     def set_filter(cls, socket, filter_):
         """
         Add filtering information to a socket for use with `matching()`.
 
+        Any filter previously set on the socket is replaced.
+
         :param socket: Socket to add filtering information too
         :param filter_: Filter JSON to process
         """
-        socket.filter_rows = tuple(cls._rows_for(filter_))
+        cls.remove_filter(socket)
+
+        socket.filter_rows = intern_rows(cls._rows_for(filter_))
+
+        for row in socket.filter_rows:
+            subscribers = cls._index.get(row)
+            if subscribers is None:
+                subscribers = cls._index[row] = weakref.WeakSet()
+                cls._row_added(row)
+
+            subscribers.add(socket)
+
+    @classmethod
+    def remove_filter(cls, socket):
+        """
+        Remove any filtering information from a socket.
+
+        :param socket: Socket to remove from the index
+        """
+        for row in getattr(socket, "filter_rows", ()):
+            subscribers = cls._index.get(row)
+            if subscribers is None:
+                continue
+
+            subscribers.discard(socket)
+            if not subscribers:
+                del cls._index[row]
+                cls._row_removed(row)
+
+        socket.filter_rows = ()
+
+    @classmethod
+    def routing_keys(cls):
+        """
+        Get the realtime routing keys for the annotation events sockets want.
+
+        This is used to bind the streamer's queue on the topic exchange (see
+        `h.realtime.TopicConsumer`). If every socket only watches groups, just
+        those groups' events are needed. Otherwise, any event might match.
+
+        The same set is returned until the keys change, so callers can cheaply
+        tell whether they have.
+
+        :rtype: frozenset
+        """
+        if cls._routing_keys is None:
+            if cls._other_rows:
+                keys = [realtime.ALL_ANNOTATIONS]
+            else:
+                keys = [realtime.annotation_routing_key(group) for group in cls._groups]
+
+            cls._routing_keys = frozenset([realtime.UNKNOWN_GROUP, *keys])
+
+        return cls._routing_keys
+
+    @classmethod
+    def _row_added(cls, row):
+        """Update the other indexes for a row which has just been indexed."""
+        field, value = row
+
+        if field == "/group":
+            cls._groups.add(value)
+            cls._routing_keys = None
+            return
+
+        cls._other_rows += 1
+        if cls._other_rows == 1:
+            cls._routing_keys = None
+        if field == cls.URI_PREFIX:
+            cls._uri_prefixes.add(value)
+
+    @classmethod
+    def _row_removed(cls, row):
+        """Update the other indexes for a row which has just been unindexed."""
+        field, value = row
+
+        if field == "/group":
+            cls._groups.discard(value)
+            cls._routing_keys = None
+            return
+
+        cls._other_rows -= 1
+        if not cls._other_rows:
+            cls._routing_keys = None
+        if field == cls.URI_PREFIX:
+            cls._uri_prefixes.remove(value)
+
+    @classmethod
+    def _rows_for_values(cls, values):
+        """Convert a dict of field to values to field value pairs."""
+        for field, field_values in values.items():
+            for value in field_values:
+                yield field, value
+
+                if field == "/uri":
+                    for prefix in cls._uri_prefixes.prefixes_of(value):
+                        yield cls.URI_PREFIX, prefix
 
     @classmethod
     def _rows_for(cls, filter_):
@@ -89,8 +336,24 @@ class SocketFilter:
 
             values = clause["value"]
 
-            # Normalize to an iterable of distinct values
-            values = set(values) if isinstance(values, list) else [values]
+            # Normalize to a set of distinct values. The fields we match are
+            # all strings, so anything else (which might not even be hashable)
+            # could never match and is dropped
+            if not isinstance(values, list):
+                values = [values]
+            values = {value for value in values if isinstance(value, str)}
+
+            if clause.get("operator") == "prefix":
+                # Only URIs can be matched by prefix
+                if field != "/uri":
+                    continue
+
+                for value in values:
+                    prefix = normalize_uri_prefix(value)
+                    if prefix:
+                        yield cls.URI_PREFIX, prefix
+
+                continue
 
             for value in values:
                 if field == "/uri":
@@ -0,0 +1,125 @@
+"""
+Heartbeats for websocket connections, from one timer per worker.
+
+Rather than have ws4py run a heartbeat timer for every connection, every
+connection is scheduled on a single hashed timing wheel. Each tick of the
+wheel handles the connections which are due in one batch: pinging the live
+ones, closing the ones which have stopped responding and closing the ones
+which connected but never sent a filter.
+"""
+
+import logging
+from math import ceil
+from time import monotonic
+
+import gevent
+
+log = logging.getLogger(__name__)
+
+# How often (in seconds) each connection is sent a ping, and how long after
+# connecting (in seconds) a connection which hasn't sent a filter is closed.
+# These can be overridden by the `h.streamer.heartbeat_interval` and
+# `h.streamer.filter_timeout` settings.
+DEFAULT_INTERVAL = 30
+DEFAULT_FILTER_TIMEOUT = 300
+
+# Connections we haven't received anything from in this many heartbeat
+# intervals (including any pongs to our pings) are considered dead
+MISSED_HEARTBEATS = 2
+
+
+class TimingWheel:
+    """
+    A hashed timing wheel.
+
+    Items are scheduled into one of a fixed number of slots, each `tick`
+    seconds apart, and `advance()` is called every tick to collect the items
+    which are due. Scheduling and collecting an item are constant time, no
+    matter how many items there are. Items scheduled more than a full turn of
+    the wheel ahead wait for as many turns as they need.
+    """
+
+    def __init__(self, tick=1.0, size=64):
+        self.tick = tick
+
+        # Lists of `(turns, item)` to wait for, in each slot
+        self._slots = [[] for _ in range(size)]
+        self._position = 0
+
+    def schedule(self, item, delay):
+        """Schedule `item` to be returned by `advance()` in `delay` seconds."""
+        ticks = max(1, ceil(delay / self.tick))
+        size = len(self._slots)
+
+        self._slots[(self._position + ticks) % size].append(((ticks - 1) // size, item))
+
+    def advance(self):
+        """Move the wheel on one tick, and return the items which are due."""
+        self._position = (self._position + 1) % len(self._slots)
+
+        due, waiting = [], []
+        for turns, item in self._slots[self._position]:
+            if turns:
+                waiting.append((turns - 1, item))
+            else:
+                due.append(item)
+
+        self._slots[self._position] = waiting
+
+        return due
+
+
+class Heartbeats:
+    """The heartbeats of every websocket connection to this worker."""
+
+    def __init__(
+        self, interval=DEFAULT_INTERVAL, filter_timeout=DEFAULT_FILTER_TIMEOUT
+    ):
+        self.interval = interval
+        self.filter_timeout = filter_timeout
+        self.wheel = TimingWheel()
+
+    def add(self, socket):
+        """Start sending heartbeats to a newly opened `WebSocket`."""
+        self.wheel.schedule(socket, self.interval)
+
+    def beat(self):
+        """Handle the connections which are due a heartbeat."""
+        now = monotonic()
+
+        for socket in self.wheel.advance():
+            # Closed connections are dropped from the wheel here, rather than
+            # looked for when they close
+            if socket.terminated:
+                continue
+
+            if now - socket.last_received > self.interval * MISSED_HEARTBEATS:
+                log.info("Closing connection to a client which stopped responding")
+                socket.abort()
+                continue
+
+            if (
+                self.filter_timeout
+                and not socket.filter_received
+                and now - socket.connected_at > self.filter_timeout
+            ):
+                # If the client doesn't finish closing by the next heartbeat
+                # this is called again, which drops the connection
+                socket.close_queued(reason="No filter received")
+            else:
+                socket.heartbeat()
+
+            self.wheel.schedule(socket, self.interval)
+
+    def run(self):
+        """Handle the connections which are due a heartbeat every tick, forever."""
+        next_tick = monotonic()
+
+        while True:
+            next_tick += self.wheel.tick
+            gevent.sleep(max(0, next_tick - monotonic()))
+
+            self.beat()
+
+
+HEARTBEATS = Heartbeats()
@@ -0,0 +1,414 @@
+"""
+A load test for the streamer.
+
+This runs the streamer's real work queue processing (see
+`h.streamer.streamer.process_work_queue`), socket filtering and message
+handling in-process, against thousands of simulated websocket connections,
+while injecting annotation and user events at a fixed rate. It reports the
+throughput, latency and memory per connection, so the capacity of a streamer
+worker can be measured without production traffic.
+
+The connections watch documents chosen with a Zipf distribution, so a few
+popular documents have many watchers and most have few or none, as in
+production. Events are published for annotations on documents chosen the same
+way.
+
+The test needs a Postgres DB set up with ``hypothesis init`` (the development
+DB from ``make services`` will do). It creates the documents and annotations
+it sends events about, and deletes them again afterwards. Run it with::
+
+    python -m h.streamer.loadtest --connections 5000 --rate 200 --duration 30
+"""
+
+import json
+import logging
+import random
+import tracemalloc
+from itertools import count
+from time import monotonic, time
+
+import click
+import gevent
+import psycogreen.gevent
+from gevent.queue import Full
+from pyramid.security import Authenticated, Everyone
+
+from h import models
+from h.config import configure
+from h.streamer import db, messages, metrics, streamer, websocket
+from h.streamer.filter import SocketFilter
+from h.util.uri import normalize as normalize_uri
+
+DEFAULT_DATABASE_URL = "postgresql://postgres@localhost/postgres"
+
+# Every annotation the test creates has this tag, so they're easy to find
+TAG = "streamer-loadtest"
+
+
+class Stats:
+    """Counts of what the simulated connections were sent, and how quickly."""
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+        # From each event being published to its notification being written
+        # to a connection's socket, in seconds
+        self.delivery = metrics.Histogram()
+
+        # The publication time of recent notification frames. The same frame
+        # is sent to every connection, so we only need to parse it once
+        self._cursors = {}
+
+    def sent(self, data):
+        self.frames += 1
+        self.bytes += len(data)
+
+        try:
+            cursor = self._cursors[data]
+        except KeyError:
+            if len(self._cursors) > 1024:
+                self._cursors.clear()
+            cursor = self._cursors[data] = _cursor(data)
+
+        if cursor is not None:
+            self.delivery.record(time() - cursor)
+
+
+class FakeSocket:
+    """A stand-in for a client's TCP socket, which records what it's sent."""
+
+    def __init__(self, stats):
+        self._stats = stats
+
+    def sendall(self, data):
+        self._stats.sent(data)
+
+    def shutdown(self, _how):
+        pass
+
+    def close(self):
+        pass
+
+
+def _cursor(data):
+    """Get the cursor from an unmasked, uncompressed notification frame."""
+    length = data[1] & 0x7F
+    offset = 2
+    if length == 126:
+        offset = 4
+    elif length == 127:
+        offset = 10
+
+    try:
+        payload = json.loads(data[offset:])
+    except ValueError:  # pragma: no cover
+        return None
+
+    return payload.get("cursor")
+
+
+def _zipf_weights(size, exponent=1.0):
+    return [1 / (rank ** exponent) for rank in range(1, size + 1)]
+
+
+def _make_registry(settings):
+    """Configure the parts of the streamer app that handling messages needs."""
+    config = configure(settings=settings)
+
+    config.include("pyramid_services")
+    config.include("h.auth")
+    config.include("h.authz")
+    config.include("h.db")
+    config.include("h.services")
+    config.include("h.links")
+
+    config.add_route("annotation", "/a/{id}", static=True)
+    config.add_route("api.annotation", "/api/annotations/{id}", static=True)
+
+    config.commit()
+    return config.registry
+
+
+def _create_annotations(session, documents, annotations_per_document):
+    """Create annotations to send events about, grouped by document URI."""
+    group = session.query(models.Group).filter_by(pubid="__world__").one_or_none()
+    if group is None:
+        raise click.ClickException("No world group: run `hypothesis init` first")
+
+    annotations = {}
+    for number in range(documents):
+        uri = f"https://example.com/{TAG}/{number}"
+        document = models.Document(
+            document_uris=[models.DocumentURI(claimant=uri, uri=uri, type="self-claim")]
+        )
+        annotations[uri] = [
+            models.Annotation(
+                userid=f"acct:user{number % 100}@example.com",
+                groupid=group.pubid,
+                shared=True,
+                target_uri=uri,
+                text="Load test annotation",
+                tags=[TAG],
+                document=document,
+            )
+            for _ in range(annotations_per_document)
+        ]
+        session.add_all(annotations[uri])
+
+    session.flush()
+    annotation_ids = {
+        uri: [annotation.id for annotation in annotations_]
+        for uri, annotations_ in annotations.items()
+    }
+    session.commit()
+
+    return annotation_ids
+
+
+def _delete_annotations(session, annotation_ids):
+    document_ids = {
+        document_id
+        for (document_id,) in session.query(models.Annotation.document_id).filter(
+            models.Annotation.id.in_(annotation_ids)
+        )
+    }
+
+    session.query(models.Annotation).filter(
+        models.Annotation.id.in_(annotation_ids)
+    ).delete(synchronize_session=False)
+    session.query(models.DocumentURI).filter(
+        models.DocumentURI.document_id.in_(document_ids)
+    ).delete(synchronize_session=False)
+    session.query(models.Document).filter(models.Document.id.in_(document_ids)).delete(
+        synchronize_session=False
+    )
+    session.commit()
+
+
+def _connect(uris, weights, stats, work_queue, connections, authenticated_share):
+    """Open simulated connections, each watching one of `uris`."""
+    sockets = []
+
+    for number, uri in enumerate(random.choices(uris, weights, k=connections)):
+        userid = None
+        principals = [Everyone]
+        if random.random() < authenticated_share:
+            userid = f"acct:user{number % 1000}@example.com"
+            principals = [Everyone, Authenticated, userid, "group:__world__"]
+
+        socket = websocket.WebSocket(
+            FakeSocket(stats),
+            environ={
+                "h.ws.authenticated_userid": userid,
+                "h.ws.effective_principals": principals,
+                "h.ws.streamer_work_queue": work_queue,
+            },
+        )
+        socket.client_id = f"client{number}"
+        socket.opened()
+
+        # The filter the client sends for a page with annotations on it
+        SocketFilter.set_filter(
+            socket,
+            {
+                "match_policy": "include_any",
+                "clauses": [{"field": "/uri", "operator": "one_of", "value": [uri]}],
+                "actions": {"create": True, "update": True, "delete": True},
+            },
+        )
+
+        sockets.append(socket)
+
+    # Let the sender greenlets start
+    gevent.sleep(0)
+
+    return sockets
+
+
+def _publish_events(  # pylint:disable=too-many-arguments
+    work_queue, annotations, weights, sockets, rate, duration, user_event_share
+):
+    """Put events on the work queue at `rate` per second for `duration` seconds."""
+    uris = list(annotations)
+    userids = [
+        socket.authenticated_userid for socket in sockets if socket.authenticated_userid
+    ]
+    published = dropped = 0
+
+    start = monotonic()
+    for number in count():
+        due = start + number / rate
+        if due > start + duration:
+            break
+
+        gevent.sleep(max(0, due - monotonic()))
+
+        if userids and random.random() < user_event_share:
+            topic = streamer.USER_TOPIC
+            payload = {
+                "type": "group-join",
+                "userid": random.choice(userids),
+                "session_model": {},
+            }
+        else:
+            topic = streamer.ANNOTATION_TOPIC
+            uri = random.choices(uris, weights)[0]
+            payload = {
+                "action": random.choice(("create", "update", "update", "delete")),
+                "annotation_id": random.choice(annotations[uri]),
+                "src_client_id": None,
+                "group": "__world__",
+                # As `h.subscribers.publish_annotation_event` does
+                "uris": [normalize_uri(uri)],
+                "references": [],
+            }
+
+        # As `h.realtime.Publisher` does
+        payload["published_at"] = time()
+
+        try:
+            work_queue.put_nowait(messages.Message(topic=topic, payload=payload))
+            published += 1
+        except Full:
+            dropped += 1
+
+    return published, dropped
+
+
+def _drain(work_queue, sockets, timeout):
+    """Wait for everything queued to be sent, for up to `timeout` seconds."""
+    deadline = monotonic() + timeout
+
+    while monotonic() < deadline:
+        if work_queue.empty() and not any(
+            socket.send_queue_depth for socket in sockets
+        ):
+            return True
+        gevent.sleep(0.01)
+
+    return False
+
+
+def _report(  # pylint:disable=too-many-arguments
+    stats, published, dropped, elapsed, drained, memory, connections
+):
+    click.echo(f"Events published: {published} ({published / elapsed:.1f}/s)")
+    click.echo(f"Events dropped (work queue full): {dropped}")
+    click.echo(f"Frames sent: {stats.frames} ({stats.frames / elapsed:.1f}/s)")
+    click.echo(f"Bytes sent: {stats.bytes} ({stats.bytes / elapsed:.1f}/s)")
+    click.echo(
+        f"Send queue overflows: {dict(websocket.WebSocket.send_queue_overflows)}"
+    )
+    if not drained:
+        click.echo("Warning: timed out waiting for the queues to drain")
+
+    click.echo(f"Memory per connection: {memory / connections:.0f} bytes")
+
+    click.echo("Latency (ms):")
+    report = metrics.latency_report()
+    report["Delivery"] = {"count": stats.delivery.count}
+    if stats.delivery.count:
+        report["Delivery"]["max"] = stats.delivery.max * 1000
+        for percentile, value in stats.delivery.percentiles().items():
+            report["Delivery"][percentile] = value * 1000
+
+    for name, stage in report.items():
+        values = ", ".join(
+            f"{key}={value:.2f}" if isinstance(value, float) else f"{key}={value}"
+            for key, value in stage.items()
+        )
+        click.echo(f"  {name}: {values}")
+
+
+@click.command()
+@click.option(
+    "--database-url",
+    envvar="DATABASE_URL",
+    default=DEFAULT_DATABASE_URL,
+    help="The Postgres DB to use",
+)
+@click.option("--connections", default=1000, help="Simulated connections to open")
+@click.option("--documents", default=1000, help="Documents for them to watch")
+@click.option("--annotations-per-document", default=5)
+@click.option("--rate", default=100.0, help="Events to publish per second")
+@click.option("--duration", default=10.0, help="How long to publish for, in seconds")
+@click.option("--authenticated-share", default=0.3, help="Share of logged in users")
+@click.option("--user-event-share", default=0.05, help="Share of user events")
+@click.option("--batch-size", default=1, help="See h.streamer.batch_size")
+def loadtest(  # pylint:disable=too-many-arguments,too-many-locals
+    database_url,
+    connections,
+    documents,
+    annotations_per_document,
+    rate,
+    duration,
+    authenticated_share,
+    user_event_share,
+    batch_size,
+):
+    """Measure the capacity of the streamer with simulated connections."""
+    logging.basicConfig(level=logging.WARNING)
+
+    # As `h.streamer.Worker` does, so DB queries don't block other greenlets
+    psycogreen.gevent.patch_psycopg()
+
+    registry = _make_registry(
+        {
+            "es.url": "http://localhost:9200",
+            "h.app_url": "http://localhost:5000",
+            "h.authority": "example.com",
+            "h.streamer.batch_size": batch_size,
+            "secret_key": "notverysecretafterall",
+            "sqlalchemy.url": database_url,
+        }
+    )
+    session = db.get_session(registry.settings)
+
+    click.echo(f"Creating {documents * annotations_per_document} annotations...")
+    annotations = _create_annotations(session, documents, annotations_per_document)
+    uris = list(annotations)
+    weights = _zipf_weights(len(uris))
+
+    try:
+        stats = Stats()
+        work_queue = streamer.WORK_QUEUE
+
+        click.echo(f"Opening {connections} connections...")
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        sockets = _connect(
+            uris, weights, stats, work_queue, connections, authenticated_share
+        )
+        memory = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+        # Only report what happens during the test
+        for histogram in metrics.LATENCY_HISTOGRAMS.values():
+            histogram.report()
+
+        worker = gevent.spawn(streamer.process_work_queue, registry, work_queue)
+
+        click.echo(f"Publishing {rate} events/s for {duration}s...")
+        start = monotonic()
+        published, dropped = _publish_events(
+            work_queue, annotations, weights, sockets, rate, duration, user_event_share
+        )
+        drained = _drain(work_queue, sockets, timeout=60)
+        elapsed = monotonic() - start
+
+        worker.kill()
+        for socket in sockets:
+            socket.close_connection()
+            socket.closed(1000)
+
+        _report(stats, published, dropped, elapsed, drained, memory, connections)
+
+    finally:
+        _delete_annotations(
+            session, [id_ for ids in annotations.values() for id_ in ids]
+        )
+
+
+if __name__ == "__main__":  # pragma: no cover
+    loadtest()  # pylint:disable=no-value-for-parameter
@@ -1,14 +1,15 @@
 import logging
 from collections import namedtuple
 from itertools import chain
+from time import time
 
 from gevent.queue import Full
 from pyramid.security import principals_allowed_by_permission
 
 from h import presenters, realtime, storage
-from h.realtime import Consumer
+from h.realtime import Consumer, TopicConsumer
 from h.security import Permission
-from h.streamer import websocket
+from h.streamer import metrics, nipsa, replay, shedding, websocket
 from h.streamer.contexts import request_context
 from h.streamer.filter import SocketFilter
 from h.traversal import AnnotationContext
@@ -20,27 +21,61 @@ log = logging.getLogger(__name__)
 Message = namedtuple("Message", ["topic", "payload"])
 
 
-def process_messages(settings, routing_key, work_queue, raise_error=True):
+def process_messages(  # pylint:disable=too-many-arguments
+    settings,
+    routing_key,
+    work_queue,
+    raise_error=True,
+    routing_keys=None,
+    replay_buffer=None,
+):
     """
     Configure, start, and monitor a realtime consumer for the specified routing key.
 
     This sets up a :py:class:`h.realtime.Consumer` to route messages from
     `routing_key` to the passed `work_queue`, and starts it. The consumer
     should never return. If it does, this function will raise an exception.
+
+    If `routing_keys` is given, a :py:class:`h.realtime.TopicConsumer` bound
+    to the keys it returns is used instead, and its messages are queued as if
+    they came from `routing_key`.
+
+    If `replay_buffer` is given, the `h.streamer.replay.EventBuffer` is told
+    about any messages which are dropped, as it won't see them.
     """
 
+    def _dropped(payload):
+        shedding.SHEDDER.record("dropped")
+        if replay_buffer is not None:
+            replay_buffer.skip(payload)
+
     def _handler(payload):
+        # As a last resort when overloaded, drop annotation events rather
+        # than waiting to queue them
+        if (
+            routing_key == "annotation"
+            and shedding.SHEDDER.level() >= shedding.Level.DROP
+        ):
+            _dropped(payload)
+            return
+
         message = Message(topic=routing_key, payload=payload)
         try:
             work_queue.put(message, timeout=0.1)
         except Full:
+            _dropped(payload)
             log.warning(
                 "Streamer work queue full! Unable to queue message from "
                 "h.realtime having waited 0.1s: giving up."
             )
 
     conn = realtime.get_connection(settings)
-    consumer = Consumer(connection=conn, routing_key=routing_key, handler=_handler)
+    if routing_keys is None:
+        consumer = Consumer(connection=conn, routing_key=routing_key, handler=_handler)
+    else:
+        consumer = TopicConsumer(
+            connection=conn, routing_keys=routing_keys, handler=_handler
+        )
     consumer.run()
 
     if raise_error:
@@ -65,70 +100,335 @@ def handle_message(message, registry, session, topic_handlers):
             "Don't know how to handle message from topic: " "{}".format(message.topic)
         ) from err
 
-    # N.B. We iterate over a non-weak list of instances because there's nothing
-    # to stop connections being added or dropped during iteration, and if that
-    # happens Python will throw a "Set changed size during iteration" error.
-    sockets = list(websocket.WebSocket.instances)
+    # Annotation events are only sent to the sockets `SocketFilter` finds, so
+    # only user events need every socket. N.B. We iterate over a non-weak list
+    # of instances because there's nothing to stop connections being added or
+    # dropped during iteration, and if that happens Python will throw a "Set
+    # changed size during iteration" error.
+    sockets = []
+    if message.topic == "user":
+        sockets = list(websocket.WebSocket.instances)
 
-    # The `prepare` function sets the active registry which is an implicit
+    # The request context sets the active registry which is an implicit
     # dependency of some of the authorization logic used to look up annotation
     # and group permissions.
-    with request_context(registry) as request:
+    with request_context(registry, session) as request:
         handler(message.payload, sockets, request, session)
 
 
+def is_unwatched(message):
+    """
+    Return whether no connected socket could be interested in `message`.
+
+    This is checked using only the routing keys carried by the message, so
+    that we can skip opening a transaction and loading the annotation for the
+    majority of events, which are for documents nobody is watching.
+    """
+    if message.topic != "annotation":
+        return False
+
+    return not SocketFilter.might_match(message.payload)
+
+
 def handle_user_event(message, sockets, _request, _session):
+    # Users being NIPSA'd or un-NIPSA'd don't concern any clients, but do
+    # change what we send them
+    if message["type"] == "nipsa-change":
+        nipsa.FLAGGED_USERS.update(message["userid"], message["nipsa"])
+        return
+
     # for session state change events, the full session model
     # is included so that clients can update themselves without
     # further API requests
 
-    reply = None
+    frame = None
 
     for socket in sockets:
         if socket.authenticated_userid != message["userid"]:
             continue
 
-        if reply is None:
-            reply = {
-                "type": "session-change",
-                "action": message["type"],
-                "model": message["session_model"],
-            }
+        if frame is None:
+            frame = websocket.json_frame(
+                {
+                    "type": "session-change",
+                    "action": message["type"],
+                    "model": message["session_model"],
+                }
+            )
 
-        socket.send_json(reply)
+        socket.send_frame(frame)
 
 
-def handle_annotation_event(message, sockets, request, session):
+def handle_annotation_event(message, _sockets, request, session):
     id_ = message["annotation_id"]
-    annotation = storage.fetch_annotation(session, id_)
+    with metrics.LATENCY_DB_FETCH.time():
+        annotation = storage.fetch_annotation(session, id_)
 
     if annotation is None:
         log.warning("received annotation event for missing annotation: %s", id_)
         return
 
-    # Find connected clients which are interested in this annotation.
-    matching_sockets = SocketFilter.matching(sockets, annotation, session)
+    _send_annotation_event(message, annotation, request, session)
 
-    try:
-        # Check to see if the generator has any items
-        first_socket = next(matching_sockets)
-    except StopIteration:
-        # Nothing matched
-        return
+
+def coalesce_annotation_events(events):
+    """
+    Merge annotation event messages for the same annotation.
+
+    Only the most recent event for each annotation is kept, as it supersedes
+    the others: clients treat creates and updates alike, and a delete should
+    win over anything before it.
+
+    :param events: Iterable of annotation event `Message` objects
+    :return: A list of messages, with one per annotation
+    """
+    latest = {}
+    for event in events:
+        latest[event.payload["annotation_id"]] = event
+
+    return list(latest.values())
+
+
+def handle_annotation_events(
+    events, registry, session, sockets=None, by_document=False
+):
+    """
+    Process a batch of annotation event messages.
+
+    All of the annotations are loaded with a single query, in the caller's
+    transaction, before any notifications are sent.
+
+    :param events: Annotation event `Message` objects to process
+    :param registry: Pyramid registry to build a request context from
+    :param session: DB session
+    :param sockets: Only notify these sockets, rather than all which match
+    :param by_document: Merge the notifications for events with the same
+        action on the same document, so each socket is sent one for them all.
+        This can't be combined with `sockets`
+    """
+    with metrics.LATENCY_DB_FETCH.time():
+        annotations = {
+            annotation.id: annotation
+            for annotation in storage.fetch_ordered_annotations(
+                session, [event.payload["annotation_id"] for event in events]
+            )
+        }
+
+    # Lists of `(payload, annotation)` to notify sockets about together
+    notifications = {}
+    for event in events:
+        id_ = event.payload["annotation_id"]
+        annotation = annotations.get(id_)
+
+        if annotation is None:
+            log.warning("received annotation event for missing annotation: %s", id_)
+            continue
+
+        key = (annotation.document_id, event.payload["action"]) if by_document else id_
+        notifications.setdefault(key, []).append((event.payload, annotation))
+
+    with request_context(registry, session) as request:
+        for notification in notifications.values():
+            if len(notification) == 1:
+                ((payload, annotation),) = notification
+                _send_annotation_event(
+                    payload, annotation, request, session, sockets=sockets
+                )
+            else:
+                shedding.SHEDDER.record("coalesced", len(notification) - 1)
+                _send_document_events(notification, request, session)
+
+
+def replay_annotation_events(replay_, events, registry, session):
+    """
+    Send a client the annotation events it missed.
+
+    The events are sent through the usual filtering and permission checks,
+    with one notification per annotation, reflecting its current state.
+
+    :param replay_: The `h.streamer.replay.Replay` requested by the client
+    :param events: The `h.streamer.replay.EventBuffer` of recent events
+    :param registry: Pyramid registry to build a request context from
+    :param session: DB session
+    """
+    missed, complete = events.since(replay_.since)
+    missed = coalesce_annotation_events(missed)
+
+    if missed:
+        handle_annotation_events(
+            missed, registry, session, sockets={replay_.message.socket}
+        )
+
+    # Tell the client whether it needs to search for anything we didn't have
+    replay_.message.reply({"type": "replay", "complete": complete})
+
+
+def _send_annotation_event(  # pylint:disable=too-many-arguments
+    message, annotation, request, session, sockets=None
+):
+    with metrics.LATENCY_FILTER_MATCHING.time():
+        # Find connected clients which are interested in this annotation.
+        matching_sockets = SocketFilter.matching(annotation, session)
+        if sockets is not None:
+            matching_sockets = (
+                socket for socket in matching_sockets if socket in sockets
+            )
+
+        try:
+            # Check to see if the generator has any items
+            first_socket = next(matching_sockets)
+        except StopIteration:
+            # Nothing matched
+            return
 
     # Create a generator which has the first socket back again
     matching_sockets = chain(  # pylint: disable=redefined-variable-type
         (first_socket,), matching_sockets
     )
 
-    read_principals = principals_allowed_by_permission(
-        AnnotationContext(annotation), Permission.Annotation.READ_REALTIME_UPDATES
+    # Events for particular sockets (replays, and events which were put aside
+    # already) are never put aside
+    if sockets is None:
+        matching_sockets = _defer_anonymous(message, matching_sockets)
+        if not matching_sockets:
+            return
+
+    read_principals = frozenset(
+        principals_allowed_by_permission(
+            AnnotationContext(annotation), Permission.Annotation.READ_REALTIME_UPDATES
+        )
     )
-    reply = _generate_annotation_event(request, message, annotation)
+    with metrics.LATENCY_PRESENTATION.time():
+        reply = _generate_annotation_event(request, message, annotation)
+
+    with metrics.LATENCY_SEND.time():
+        _send_to_sockets(
+            message, annotation, request, matching_sockets, read_principals, reply
+        )
+
+    # Messages published by older versions of h aren't timestamped, and
+    # replayed events are always late
+    if "published_at" in message and sockets is None:
+        metrics.LATENCY_TOTAL.record(time() - message["published_at"])
+
+
+def _send_document_events(notification, request, session):
+    """
+    Send one notification for several annotation events on the same document.
+
+    Each socket is sent one frame, with all of the annotations it can read.
+    Sockets which can read the same annotations share the same frame.
+
+    :param notification: List of `(payload, annotation)` for events with the
+        same action
+    """
+    action = notification[0][0]["action"]
+
+    # The indexes in `notification` of the annotations each socket can read
+    readable = {}
+    replies = []
+
+    for index, (message, annotation) in enumerate(notification):
+        with metrics.LATENCY_FILTER_MATCHING.time():
+            matching_sockets = _defer_anonymous(
+                message, SocketFilter.matching(annotation, session)
+            )
+            if not matching_sockets:
+                replies.append(None)
+                continue
+
+        read_principals = frozenset(
+            principals_allowed_by_permission(
+                AnnotationContext(annotation),
+                Permission.Annotation.READ_REALTIME_UPDATES,
+            )
+        )
+        with metrics.LATENCY_PRESENTATION.time():
+            replies.append(_generate_annotation_event(request, message, annotation))
+
+        for socket in _recipients(
+            message, annotation, request, matching_sockets, read_principals
+        ):
+            readable.setdefault(socket, []).append(index)
+
+    with metrics.LATENCY_SEND.time():
+        frames = {}
+        for socket, indexes in readable.items():
+            indexes = tuple(indexes)
+            frame = frames.get(indexes)
+            if frame is None:
+                frame = frames[indexes] = websocket.json_frame(
+                    _merge_annotation_events(
+                        action, [replies[index] for index in indexes]
+                    )
+                )
+
+            socket.send_frame(frame)
+
+    for message, _ in notification:
+        if "published_at" in message:
+            metrics.LATENCY_TOTAL.record(time() - message["published_at"])
+
+
+def _merge_annotation_events(action, events):
+    """Merge annotation notifications with the same action into one."""
+    merged = {
+        "type": "annotation-notification",
+        "options": {"action": action},
+        "payload": [payload for event in events for payload in event["payload"]],
+    }
+
+    # Clients which reconnect should get anything after the latest of them
+    cursors = [event["cursor"] for event in events if "cursor" in event]
+    if cursors:
+        merged["cursor"] = max(cursors)
+
+    return merged
 
-    annotator_nipsad = request.find_service(name="nipsa").is_flagged(annotation.userid)
 
-    for socket in matching_sockets:
+def _defer_anonymous(message, sockets):
+    """
+    Put aside the notification of anonymous sockets, if shedding load.
+
+    The event is kept to send to anonymous sockets later, once the work queue
+    has drained. See `h.streamer.shedding`.
+
+    :return: A list of the sockets to notify now
+    """
+    sockets = list(sockets)
+
+    if shedding.SHEDDER.level() < shedding.Level.DEFER:
+        return sockets
+
+    authenticated = [socket for socket in sockets if socket.authenticated_userid]
+    if len(authenticated) < len(sockets):
+        shedding.SHEDDER.defer(Message(topic="annotation", payload=message))
+
+    return authenticated
+
+
+def _send_to_sockets(  # pylint:disable=too-many-arguments
+    message, annotation, request, sockets, read_principals, reply
+):
+    # The reply is the same for everyone, so we serialize it at most once
+    frame = None
+
+    for socket in _recipients(message, annotation, request, sockets, read_principals):
+        if frame is None:
+            frame = websocket.json_frame(reply)
+
+        socket.send_frame(frame)
+
+
+def _recipients(message, annotation, request, sockets, read_principals):
+    """Yield the sockets which should be notified of an annotation event."""
+    annotator_nipsad = nipsa.FLAGGED_USERS.is_flagged(request, annotation.userid)
+
+    # Whether sockets can read this annotation, by their (interned) principal
+    # set. Most sockets share a few sets, so we only need to check each once
+    can_read = {}
+
+    for socket in sockets:
         # Don't send notifications back to the person who sent them
         if message["src_client_id"] == socket.client_id:
             continue
@@ -138,10 +438,13 @@ def handle_annotation_event(message, sockets, request, session):
             continue
 
         # Check whether client is authorized to read this annotation.
-        if not set(read_principals).intersection(socket.effective_principals):
-            continue
+        principals = socket.effective_principals
+        allowed = can_read.get(principals)
+        if allowed is None:
+            allowed = can_read[principals] = not read_principals.isdisjoint(principals)
 
-        socket.send_json(reply)
+        if allowed:
+            yield socket
 
 
 def _generate_annotation_event(request, message, annotation):
@@ -164,8 +467,15 @@ def _generate_annotation_event(request, message, annotation):
             user_service=request.find_service(name="user"),
         ).asdict()
 
-    return {
+    event = {
         "type": "annotation-notification",
         "options": {"action": message["action"]},
         "payload": [payload],
     }
+
+    # Clients can send this back to replay events they missed after it
+    cursor = replay.cursor(message)
+    if cursor is not None:
+        event["cursor"] = cursor
+
+    return event
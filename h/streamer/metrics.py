@@ -1,8 +1,14 @@
+from collections import Counter
+from contextlib import contextmanager
+from math import ceil, log2
+from time import monotonic
+
 import gevent
 import importlib_resources
 import newrelic.agent
 
-from h.streamer import db
+from h.models.document import EXPANDED_URIS
+from h.streamer import db, shedding
 from h.streamer.websocket import WebSocket
 from h.streamer.worker import WSGIServer
 
@@ -10,6 +16,131 @@ PREFIX = "Custom/WebSocket"
 METRICS_INTERVAL = 60
 
 
+class Summary:
+    """
+    A running summary of values, reset each time it is reported.
+
+    This is reported in New Relic's own format for summary metrics, so the
+    count, average, min and max are all available in the dashboard.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.sum_of_squares = 0
+
+    def record(self, value):
+        self.count += 1
+        self.total += value
+        self.sum_of_squares += value * value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def report(self):
+        """Return the summary as a New Relic metric value and reset it."""
+        report = {
+            "count": self.count,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max,
+            "sum_of_squares": self.sum_of_squares,
+        }
+        self.__init__()
+
+        return report
+
+
+class Histogram(Summary):
+    """
+    A running summary which also gives percentiles of the values recorded.
+
+    Values are counted in buckets which grow exponentially, so the memory
+    used doesn't depend on how many values are recorded. Percentiles are
+    accurate to within one bucket: about 19%.
+    """
+
+    PERCENTILES = (50, 95, 99)
+
+    # The buckets are powers of 2 ** (1 / _BUCKETS_PER_DOUBLING)
+    _BUCKETS_PER_DOUBLING = 4
+
+    # Values this small or smaller (including negative values from clock skew)
+    # all go in the first bucket
+    _MIN_VALUE = 1e-6
+
+    def __init__(self):
+        super().__init__()
+        self.buckets = Counter()
+
+    def record(self, value):
+        super().record(value)
+
+        bucket = ceil(log2(max(value, self._MIN_VALUE)) * self._BUCKETS_PER_DOUBLING)
+        self.buckets[bucket] += 1
+
+    @contextmanager
+    def time(self):
+        """Record how long the wrapped block takes to run, in seconds."""
+        start = monotonic()
+        try:
+            yield
+        finally:
+            self.record(monotonic() - start)
+
+    def percentile(self, percent):
+        """Get the upper bound of the `percent`th percentile of the values."""
+        if not self.count:
+            return None
+
+        threshold = self.count * percent / 100
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= threshold:
+                break
+
+        # pylint:disable=undefined-loop-variable
+        return min(2 ** (bucket / self._BUCKETS_PER_DOUBLING), self.max)
+
+    def percentiles(self):
+        return {f"p{percent}": self.percentile(percent) for percent in self.PERCENTILES}
+
+
+# The number of messages taken from the work queue in each batch, and how long
+# it took to process each batch (in seconds). These are only recorded when
+# batching is enabled (see `h.streamer.streamer.process_work_queue`).
+WORK_QUEUE_BATCH_SIZE = Summary()
+WORK_QUEUE_DRAIN_TIME = Summary()
+
+# How long (in seconds) each stage of sending an annotation event to clients
+# takes, from the event being published (see `h.realtime.Publisher`) to the
+# notification being queued to send to each socket:
+#
+#  * QueueWait - from publishing to being taken off the work queue
+#  * DBFetch - loading annotations from the DB
+#  * FilterMatching - finding the sockets which are interested in an event
+#  * Presentation - building the notification
+#  * Send - checking permissions and queuing the notification for each socket
+#  * Total - from publishing to the notification being queued for everyone
+LATENCY_QUEUE_WAIT = Histogram()
+LATENCY_DB_FETCH = Histogram()
+LATENCY_FILTER_MATCHING = Histogram()
+LATENCY_PRESENTATION = Histogram()
+LATENCY_SEND = Histogram()
+LATENCY_TOTAL = Histogram()
+
+LATENCY_HISTOGRAMS = {
+    "QueueWait": LATENCY_QUEUE_WAIT,
+    "DBFetch": LATENCY_DB_FETCH,
+    "FilterMatching": LATENCY_FILTER_MATCHING,
+    "Presentation": LATENCY_PRESENTATION,
+    "Send": LATENCY_SEND,
+    "Total": LATENCY_TOTAL,
+}
+
+
 def websocket_metrics(queue):
     """
     Report metrics about the websocket service to New Relic.
@@ -29,6 +160,42 @@ def websocket_metrics(queue):
     yield f"{PREFIX}/Connections/Anonymous", connections_anonymous
 
     yield f"{PREFIX}/WorkQueueSize", queue.qsize()
+    for name, lane in queue.lanes.items():
+        yield f"{PREFIX}/WorkQueue/{name.title()}/Depth", lane.qsize()
+
+    send_queue_depth = Summary()
+    for ws in WebSocket.instances:
+        send_queue_depth.record(ws.send_queue_depth)
+    if send_queue_depth.count:
+        yield f"{PREFIX}/SendQueue/Depth", send_queue_depth.report()
+
+    overflows = WebSocket.send_queue_overflows
+    yield f"{PREFIX}/SendQueue/Dropped", overflows.pop("drop", 0)
+    yield f"{PREFIX}/SendQueue/Evicted", overflows.pop("close", 0)
+
+    yield f"{PREFIX}/Shedding/Level", int(shedding.SHEDDER.level())
+    decisions = shedding.SHEDDER.decisions
+    for decision in ("deferred", "coalesced", "dropped", "refused"):
+        yield f"{PREFIX}/Shedding/{decision.title()}", decisions.pop(decision, 0)
+
+    for name, summary in (
+        ("WorkQueue/BatchSize", WORK_QUEUE_BATCH_SIZE),
+        ("WorkQueue/DrainTime", WORK_QUEUE_DRAIN_TIME),
+    ):
+        # Don't report anything at all, rather than a summary of nothing
+        if summary.count:
+            yield f"{PREFIX}/{name}", summary.report()
+
+    for name, histogram in LATENCY_HISTOGRAMS.items():
+        if histogram.count:
+            for percentile, value in histogram.percentiles().items():
+                yield f"{PREFIX}/Latency/{name}/{percentile}", value
+
+            yield f"{PREFIX}/Latency/{name}", histogram.report()
+
+    # How often annotation events found their URIs in the expanded URI cache
+    for name, count in EXPANDED_URIS.report().items():
+        yield f"{PREFIX}/ExpandURICache/{name}", count
 
     # There really only should be one server per instance
     for server in WSGIServer.instances:
@@ -42,6 +209,27 @@ def websocket_metrics(queue):
         yield f"{PREFIX}/Worker/Pool/Used", pool.size - free
 
 
+def latency_report():
+    """
+    Get the latency percentiles recorded since they were last sent to New Relic.
+
+    :return: A dict of the count, max and percentiles of each stage in
+        milliseconds
+    """
+    report = {}
+
+    for name, histogram in LATENCY_HISTOGRAMS.items():
+        stage = {"count": histogram.count}
+        if histogram.count:
+            stage["max"] = histogram.max * 1000
+            for percentile, value in histogram.percentiles().items():
+                stage[percentile] = value * 1000
+
+        report[name] = stage
+
+    return report
+
+
 NEW_RELIC_CONFIG_REF = importlib_resources.files("h.streamer") / "conf/newrelic.ini"
 
 
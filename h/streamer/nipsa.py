@@ -0,0 +1,62 @@
+"""
+A process-wide cache of which users are NIPSA'd, for the streamer.
+
+Every annotation event needs to know whether its author is NIPSA'd, and each
+event is handled with a new request (and so a new `NipsaService`), so the
+cache in the service doesn't help us. Instead we keep the set of flagged
+userids for the life of the process, reloading it every so often.
+
+`NipsaService.flag()` and `NipsaService.unflag()` publish a message on the
+`user` realtime topic, so changes are normally picked up straight away. See
+`h.streamer.messages.handle_user_event()`.
+"""
+
+from time import monotonic
+
+# How often (in seconds) to reload the flagged users by default. This can be
+# overridden by the `h.streamer.nipsa_ttl` setting.
+DEFAULT_TTL = 300
+
+
+class FlaggedUsers:
+    """The set of NIPSA'd userids, loaded on demand and reloaded on a TTL."""
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+
+        self._userids = None
+        self._loaded_at = None
+
+    def is_flagged(self, request, userid):
+        """
+        Return whether the given userid is flagged as NIPSA.
+
+        :param request: Request to find the `nipsa` service with, if the
+            flagged users need (re)loading
+        :param userid: The userid to check
+        """
+        if self._userids is None or monotonic() - self._loaded_at > self.ttl:
+            self._userids = set(
+                request.find_service(name="nipsa").fetch_all_flagged_userids()
+            )
+            self._loaded_at = monotonic()
+
+        return userid in self._userids
+
+    def update(self, userid, nipsa):
+        """Record a change to a user's NIPSA flag."""
+        if self._userids is None:
+            return
+
+        if nipsa:
+            self._userids.add(userid)
+        else:
+            self._userids.discard(userid)
+
+    def clear(self):
+        """Unload the flagged users, so they are reloaded when next needed."""
+        self._userids = None
+
+
+# The flagged users for this process
+FLAGGED_USERS = FlaggedUsers()
@@ -0,0 +1,114 @@
+"""
+Replaying recent annotation events to clients which reconnect.
+
+Each streamer worker keeps the annotation events it has received recently,
+so a client which reconnects can send the cursor of the last notification it
+received (as `since` in its filter message) and be sent what it missed,
+rather than re-running a search to find out.
+
+Cursors are the times events were published, by whichever process published
+them, so clocks which disagree can publish events out of order. To allow for
+that, replays start a little before the client's cursor, which means clients
+can be sent events they already have, and should ignore any they've already
+seen by annotation id.
+"""
+
+from collections import deque, namedtuple
+from time import time
+
+# The default number of events to keep, and for how long (in seconds). These
+# can be overridden by the `h.streamer.replay_size` and `h.streamer.replay_ttl`
+# settings.
+DEFAULT_SIZE = 4096
+DEFAULT_TTL = 300
+
+# How far apart (in seconds) the clocks of the processes publishing events
+# may be. Replays start this long before the client's cursor to allow for it
+DEFAULT_SKEW = 2
+
+
+# A request from a client to replay the events it missed. `message` is the
+# `h.streamer.websocket.Message` it was requested with, and `since` the cursor
+# of the last event the client received
+Replay = namedtuple("Replay", ["message", "since"])
+
+
+def cursor(payload):
+    """
+    Get the cursor for an annotation event payload.
+
+    This is the time the event was published, which is the same for every
+    worker, so clients can reconnect to any of them. See
+    `h.realtime.Publisher`.
+    """
+    return payload.get("published_at")
+
+
+class EventBuffer:
+    """A bounded, time-limited buffer of recent annotation events."""
+
+    def __init__(self, size=DEFAULT_SIZE, ttl=DEFAULT_TTL, skew=DEFAULT_SKEW):
+        self.size = size
+        self.ttl = ttl
+        self.skew = skew
+
+        # Whether only some events are received, as with topic routing (see
+        # `h.realtime.TopicConsumer`). Replays are then never complete, as we
+        # can't tell if we were receiving the events a client wants for all of
+        # the time it was away
+        self.partial = False
+
+        # Tuples of (cursor, time received, message), oldest first
+        self._events = deque()
+
+        # All events after this cursor are in the buffer
+        self._complete_since = time()
+
+    def append(self, message):
+        """Add an annotation event `Message` to the buffer."""
+        received = time()
+
+        # Events published by older versions of h don't have a cursor, so we
+        # make do with when we received them
+        self._events.append((cursor(message.payload) or received, received, message))
+
+        while len(self._events) > self.size:
+            self._evict()
+
+        self._expire(received)
+
+    def skip(self, payload):
+        """
+        Record that an annotation event won't be added to the buffer.
+
+        This is for events which are dropped before they're buffered, which
+        makes replays from before them incomplete.
+        """
+        self._complete_since = max(self._complete_since, cursor(payload) or time())
+
+    def since(self, since):
+        """
+        Get the events after cursor `since`, allowing for clock skew.
+
+        This includes events up to `skew` seconds before `since`, which the
+        client may already have.
+
+        :return: A tuple of the event messages, oldest first, and whether they
+            are complete. The events are incomplete if some after `since` have
+            already been removed from the buffer, or were never added to it,
+            or if the buffer is `partial`.
+        """
+        self._expire(time())
+
+        since -= self.skew
+        events = [message for cursor_, _, message in self._events if cursor_ > since]
+
+        return events, not self.partial and since >= self._complete_since
+
+    def _expire(self, now):
+        while self._events and self._events[0][1] < now - self.ttl:
+            self._evict()
+
+    def _evict(self):
+        cursor_, _, _ = self._events.popleft()
+        self._complete_since = max(self._complete_since, cursor_)
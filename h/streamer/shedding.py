@@ -0,0 +1,126 @@
+"""
+Graded load shedding for the streamer.
+
+As the events lane of the work queue fills up, the streamer sheds load in
+steps, each one more drastic than the last:
+
+ * DEFER - notifications for anonymous sockets are put aside, and sent once
+   the queue has drained (anonymous users only see public annotations, so
+   are the least likely to notice a delay)
+ * COALESCE - events are taken off the queue in large batches, and the
+   notifications for annotations on the same document are merged
+ * DROP - new annotation events are dropped rather than queued
+ * OFFLINE - new websocket connections are refused, with the same response
+   as the `KILL_SWITCH_WEBSOCKET` kill switch (see
+   `h.streamer.kill_switch_views`)
+
+Each level starts when the lane is at or above its watermark: a fraction of
+the lane's maximum size. Every decision made is counted, and reported to New
+Relic with the level by `h.streamer.metrics`.
+"""
+
+from collections import Counter, deque
+from enum import IntEnum
+
+
+class Level(IntEnum):
+    NORMAL = 0
+    DEFER = 1
+    COALESCE = 2
+    DROP = 3
+    OFFLINE = 4
+
+
+# The default watermarks for the DEFER, COALESCE, DROP and OFFLINE levels. A
+# watermark of `None` disables its level. These can be overridden by the
+# `h.streamer.shed_watermarks` setting.
+DEFAULT_WATERMARKS = (0.5, 0.75, 0.9, None)
+
+# The most events to put aside for anonymous sockets. Beyond this, the oldest
+# are dropped.
+DEFAULT_DEFERRED_SIZE = 4096
+
+# How many events to take off the queue at once at the COALESCE level
+COALESCE_BATCH_SIZE = 256
+
+
+def parse_watermarks(value):
+    """
+    Parse the `h.streamer.shed_watermarks` setting.
+
+    :param value: Up to four fractions separated by spaces or commas, for the
+        DEFER, COALESCE, DROP and OFFLINE levels in turn. Any which are left
+        out (or are "off") disable their level.
+    :raise ValueError: If `value` can't be parsed
+    """
+    watermarks = [
+        None if watermark == "off" else float(watermark)
+        for watermark in value.replace(",", " ").split()
+    ]
+    if len(watermarks) > len(DEFAULT_WATERMARKS):
+        raise ValueError(f"Too many watermarks: {value!r}")
+
+    return tuple(watermarks + [None] * (len(DEFAULT_WATERMARKS) - len(watermarks)))
+
+
+class LoadShedder:
+    """
+    Decides how much load to shed, from how full a queue is.
+
+    :param lane: The `gevent.queue.Queue` to watch. Without one, the level is
+        always NORMAL
+    :param watermarks: The watermarks of the levels above NORMAL
+    :param deferred_size: The most events to put aside for anonymous sockets
+    """
+
+    def __init__(
+        self,
+        lane=None,
+        watermarks=DEFAULT_WATERMARKS,
+        deferred_size=DEFAULT_DEFERRED_SIZE,
+    ):
+        self.lane = lane
+        self.watermarks = watermarks
+
+        # How many times each decision has been made since they were last
+        # reported, by name
+        self.decisions = Counter()
+
+        # Annotation event `Message`s put aside for anonymous sockets
+        self.deferred = deque(maxlen=deferred_size)
+
+    def level(self):
+        """Get the current level of load shedding."""
+        if self.lane is None or not self.lane.maxsize:
+            return Level.NORMAL
+
+        fill = self.lane.qsize() / self.lane.maxsize
+
+        level = Level.NORMAL
+        for candidate, watermark in zip(list(Level)[1:], self.watermarks):
+            if watermark is not None and fill >= watermark:
+                level = candidate
+
+        return level
+
+    def record(self, decision, count=1):
+        """Count a load shedding decision, like "dropped"."""
+        self.decisions[decision] += count
+
+    def defer(self, message):
+        """Put aside an annotation event `Message` for anonymous sockets."""
+        if len(self.deferred) == self.deferred.maxlen:
+            self.record("dropped")
+
+        self.deferred.append(message)
+        self.record("deferred")
+
+    def take_deferred(self):
+        """Get the events put aside for anonymous sockets, oldest first."""
+        deferred = list(self.deferred)
+        self.deferred.clear()
+
+        return deferred
+
+
+SHEDDER = LoadShedder()
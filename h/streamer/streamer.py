@@ -1,22 +1,56 @@
 import logging
 import os
 import sys
+from time import monotonic, time
 
 import gevent
+from gevent.queue import Empty
 from pyramid.events import ApplicationCreated, subscriber
 
-from h.streamer import db, messages, websocket
+from h.streamer import (
+    db,
+    heartbeat,
+    messages,
+    metrics,
+    nipsa,
+    replay,
+    shedding,
+    websocket,
+    workqueue,
+)
+from h.streamer.filter import SocketFilter
 from h.streamer.metrics import metrics_process
 
 log = logging.getLogger(__name__)
 
+# Lanes of the work queue: control messages from client websockets (like
+# `filter` and `ping`), and everything else (events from the message queues
+# and replays), which need the DB.
+CONTROL_LANE = "control"
+EVENT_LANE = "events"
+
+
+def _lane_for(msg):
+    return CONTROL_LANE if isinstance(msg, websocket.Message) else EVENT_LANE
+
+
 # Queue of messages to process, from both client websockets and message queues
 # to which the streamer is subscribed.
 #
-# The maxsize ensures that memory used by this queue is bounded. Producers
+# The maxsizes ensure that memory used by this queue is bounded. Producers
 # writing to the queue must consider their behaviour when the queue is full,
 # using .put(...) with a timeout or .put_nowait(...) as appropriate.
-WORK_QUEUE = gevent.queue.Queue(maxsize=4096)
+#
+# Control messages are cheap to handle, so they are taken eight at a time to
+# each event. That keeps new clients from waiting behind the fan-out of
+# events, without letting a flood of client messages starve the events.
+WORK_QUEUE = workqueue.WorkQueue(
+    [
+        workqueue.Lane(name=CONTROL_LANE, maxsize=1024, weight=8),
+        workqueue.Lane(name=EVENT_LANE, maxsize=4096, weight=1),
+    ],
+    lane_for=_lane_for,
+)
 
 # Message queues that the streamer processes messages from
 ANNOTATION_TOPIC = "annotation"
@@ -28,6 +62,10 @@ TOPIC_HANDLERS = {
 }
 
 
+# Recent annotation events, for replaying to clients which reconnect
+REPLAY_BUFFER = replay.EventBuffer()
+
+
 class UnknownMessageType(Exception):
     """Raised if a message in the work queue if of an unknown type."""
 
@@ -44,12 +82,40 @@ def start(event):
     registry = event.app.registry
     settings = registry.settings
 
+    heartbeat.HEARTBEATS.interval = int(
+        settings.get("h.streamer.heartbeat_interval", heartbeat.DEFAULT_INTERVAL)
+    )
+    heartbeat.HEARTBEATS.filter_timeout = int(
+        settings.get("h.streamer.filter_timeout", heartbeat.DEFAULT_FILTER_TIMEOUT)
+    )
+
+    # Shed load as the events lane fills up
+    shedding.SHEDDER.lane = WORK_QUEUE.lanes[EVENT_LANE]
+    if settings.get("h.streamer.shed_watermarks"):
+        shedding.SHEDDER.watermarks = shedding.parse_watermarks(
+            settings["h.streamer.shed_watermarks"]
+        )
+
+    # With topic routing, only receive the annotation events sockets want
+    routing_keys = None
+    if settings.get("h.realtime.annotation_routing") == "topic":
+        routing_keys = SocketFilter.routing_keys
+
     greenlets = [
         # Start greenlets to process messages from RabbitMQ
-        gevent.spawn(messages.process_messages, settings, ANNOTATION_TOPIC, WORK_QUEUE),
+        gevent.spawn(
+            messages.process_messages,
+            settings,
+            ANNOTATION_TOPIC,
+            WORK_QUEUE,
+            routing_keys=routing_keys,
+            replay_buffer=REPLAY_BUFFER,
+        ),
         gevent.spawn(messages.process_messages, settings, USER_TOPIC, WORK_QUEUE),
         # And one to process the queued work
         gevent.spawn(process_work_queue, registry, WORK_QUEUE),
+        # And one to send heartbeats to the websockets
+        gevent.spawn(heartbeat.HEARTBEATS.run),
     ]
 
     if not os.environ.get("KILL_SWITCH_WEBSOCKET_METRICS"):
@@ -70,18 +136,153 @@ def process_work_queue(registry, queue):
     dispatching them as appropriate. The handling of each message is wrapped in
     code that ensures the database session is appropriately committed and
     closed between messages.
+
+    If the `h.streamer.batch_size` setting is more than 1, messages are instead
+    taken off the queue in batches. See `process_batch()`. They are also taken
+    in (larger) batches when shedding load, whatever the setting. See
+    `h.streamer.shedding`.
     """
 
-    session = db.get_session(registry.settings)
+    settings = registry.settings
+    session = db.get_session(settings)
+    batch_size = int(settings.get("h.streamer.batch_size", 1))
+
+    REPLAY_BUFFER.size = int(
+        settings.get("h.streamer.replay_size", replay.DEFAULT_SIZE)
+    )
+    REPLAY_BUFFER.ttl = int(settings.get("h.streamer.replay_ttl", replay.DEFAULT_TTL))
+    REPLAY_BUFFER.partial = settings.get("h.realtime.annotation_routing") == "topic"
+    nipsa.FLAGGED_USERS.ttl = int(
+        settings.get("h.streamer.nipsa_ttl", nipsa.DEFAULT_TTL)
+    )
 
     for msg in queue:
+        if shedding.SHEDDER.level() >= shedding.Level.COALESCE:
+            batch = _batch(queue, msg, max(batch_size, shedding.COALESCE_BATCH_SIZE))
+            process_batch(registry, session, batch, by_document=True)
+        elif batch_size > 1:
+            process_batch(registry, session, _batch(queue, msg, batch_size))
+        else:
+            _process_message(registry, session, msg)
+
+        # Catch anonymous sockets up on anything put aside for them, once the
+        # queue has drained
+        if (
+            shedding.SHEDDER.deferred
+            and shedding.SHEDDER.level() == shedding.Level.NORMAL
+        ):
+            send_deferred(registry, session)
+
+
+def process_batch(registry, session, batch, by_document=False):
+    """
+    Process a batch of messages from the work queue.
+
+    Messages are processed in the order they arrived. Each run of adjacent
+    annotation events is handled together: repeated events for the same
+    annotation are merged, and all of their annotations are loaded with one
+    query in one transaction, before notifications are sent. Other messages
+    are processed one by one as usual.
+
+    If `by_document` is true, the notifications for events on the same
+    document are merged too. See `messages.handle_annotation_events()`.
+    """
+    start = monotonic()
+
+    annotation_events = []
+    for msg in batch:
+        if isinstance(msg, messages.Message) and msg.topic == ANNOTATION_TOPIC:
+            _record_queue_wait(msg)
+            REPLAY_BUFFER.append(msg)
+            annotation_events.append(msg)
+        else:
+            # Handle the annotation events before this message, so that it
+            # isn't processed ahead of them
+            _process_annotation_events(
+                registry, session, annotation_events, by_document
+            )
+            annotation_events = []
+            _process_message(registry, session, msg)
+
+    _process_annotation_events(registry, session, annotation_events, by_document)
+
+    metrics.WORK_QUEUE_BATCH_SIZE.record(len(batch))
+    metrics.WORK_QUEUE_DRAIN_TIME.record(monotonic() - start)
+
+
+def send_deferred(registry, session):
+    """Send anonymous sockets the events put aside for them while shedding load."""
+    events = messages.coalesce_annotation_events(shedding.SHEDDER.take_deferred())
+    sockets = {
+        socket
+        for socket in websocket.WebSocket.instances
+        if not socket.authenticated_userid
+    }
+    if not sockets:
+        return
+
+    with db.read_only_transaction(session):
+        messages.handle_annotation_events(events, registry, session, sockets=sockets)
+
+
+def _process_annotation_events(registry, session, events, by_document):
+    events = [
+        msg
+        for msg in messages.coalesce_annotation_events(events)
+        if not messages.is_unwatched(msg)
+    ]
+    if events:
         with db.read_only_transaction(session):
-            if isinstance(msg, messages.Message):
-                messages.handle_message(msg, registry, session, TOPIC_HANDLERS)
-            elif isinstance(msg, websocket.Message):
-                websocket.handle_message(msg, session)
-            else:
-                raise UnknownMessageType(repr(msg))
+            messages.handle_annotation_events(
+                events, registry, session, by_document=by_document
+            )
+
+
+def _batch(queue, msg, batch_size):
+    """Get a list of `msg` and up to `batch_size - 1` more messages, without waiting."""
+    batch = [msg]
+
+    while len(batch) < batch_size:
+        try:
+            batch.append(queue.get_nowait())
+        except Empty:
+            break
+
+    return batch
+
+
+def _process_message(registry, session, msg):
+    if isinstance(msg, websocket.Message):
+        # Client control messages never need the DB
+        websocket.handle_message(msg)
+        return
+
+    if isinstance(msg, messages.Message):
+        _record_queue_wait(msg)
+
+        # Keep every event, as clients which reconnect aren't watching yet
+        if msg.topic == ANNOTATION_TOPIC:
+            REPLAY_BUFFER.append(msg)
+
+        if messages.is_unwatched(msg):
+            # Nobody can be interested in this, so don't touch the DB
+            return
+
+    with db.read_only_transaction(session):
+        if isinstance(msg, messages.Message):
+            messages.handle_message(msg, registry, session, TOPIC_HANDLERS)
+        elif isinstance(msg, replay.Replay):
+            messages.replay_annotation_events(msg, REPLAY_BUFFER, registry, session)
+        else:
+            raise UnknownMessageType(repr(msg))
+
+
+def _record_queue_wait(msg):
+    published_at = msg.payload.get("published_at")
+
+    # Messages published by older versions of h aren't timestamped
+    if published_at is not None:
+        metrics.LATENCY_QUEUE_WAIT.record(time() - published_at)
 
 
 def supervise(greenlets):
@@ -1,23 +1,84 @@
+from pyramid.httpexceptions import HTTPNotFound
 from pyramid.view import forbidden_view_config, notfound_view_config, view_config
 from ws4py.exc import HandshakeError
 from ws4py.server.wsgiutils import WebSocketWSGIApplication
 
-from h.streamer import streamer, websocket
+from h.streamer import (
+    deflate,
+    kill_switch_views,
+    metrics,
+    shedding,
+    streamer,
+    websocket,
+)
+
+# Addresses which can see the debug views
+LOCAL_ADDRESSES = {"127.0.0.1", "::1"}
 
 
 @view_config(route_name="ws")
 def websocket_view(request):
+    # When the worker is too overloaded to take any more connections, refuse
+    # them as the kill switch does
+    if shedding.SHEDDER.level() >= shedding.Level.OFFLINE:
+        shedding.SHEDDER.record("refused")
+        return kill_switch_views.not_found(None, request)
+
+    settings = request.registry.settings
+
     # Provide environment which the WebSocket handler can use...
     request.environ.update(
         {
             "h.ws.authenticated_userid": request.authenticated_userid,
             "h.ws.effective_principals": request.effective_principals,
             "h.ws.streamer_work_queue": streamer.WORK_QUEUE,
+            "h.ws.send_queue_size": int(
+                settings.get(
+                    "h.streamer.send_queue_size", websocket.DEFAULT_SEND_QUEUE_SIZE
+                )
+            ),
+            "h.ws.send_queue_overflow": settings.get(
+                "h.streamer.send_queue_overflow",
+                websocket.DEFAULT_SEND_QUEUE_OVERFLOW,
+            ),
         }
     )
 
+    # ws4py doesn't support websocket extensions, so we negotiate
+    # permessage-deflate ourselves when compression is enabled
+    extensions = None
+    if settings.get("h.streamer.deflate_level") is not None:
+        extensions = deflate.negotiate(request.headers.get("Sec-WebSocket-Extensions"))
+
+    if extensions:
+        request.environ.update(
+            {
+                "h.ws.deflate_level": int(settings["h.streamer.deflate_level"]),
+                "h.ws.deflate_min_size": int(
+                    settings.get(
+                        "h.streamer.deflate_min_size",
+                        websocket.DEFAULT_DEFLATE_MIN_SIZE,
+                    )
+                ),
+            }
+        )
+
     app = WebSocketWSGIApplication(handler_cls=websocket.WebSocket)
-    return request.get_response(app)
+    response = request.get_response(app)
+
+    if extensions:
+        response.headers["Sec-WebSocket-Extensions"] = extensions
+
+    return response
+
+
+@view_config(route_name="debug_latency", renderer="json")
+def debug_latency(request):
+    """Show the realtime latency percentiles, to requests from this machine only."""
+    if request.remote_addr not in LOCAL_ADDRESSES:
+        raise HTTPNotFound()
+
+    return metrics.latency_report()
 
 
 @notfound_view_config(renderer="json")
@@ -2,12 +2,18 @@ import copy
 import json
 import logging
 import weakref
-from collections import namedtuple
+from collections import Counter, namedtuple
+from time import monotonic
 
+import gevent
 import jsonschema
-from gevent.queue import Full
+from gevent.lock import Semaphore
+from gevent.queue import Full, Queue
+from ws4py.messaging import CloseControlMessage, PingControlMessage, TextMessage
+from ws4py.websocket import DEFAULT_READING_SIZE
 from ws4py.websocket import WebSocket as _WebSocket
 
+from h.streamer import deflate, heartbeat, replay
 from h.streamer.filter import FILTER_SCHEMA, SocketFilter
 
 log = logging.getLogger(__name__)
@@ -16,6 +22,24 @@ log = logging.getLogger(__name__)
 # below.
 MESSAGE_HANDLERS = {}
 
+# The number of messages which can be waiting to be sent to each client, and
+# what to do with a client which falls further behind than that: either "drop"
+# the message, or "close" the connection. These can be overridden by the
+# `h.streamer.send_queue_size` and `h.streamer.send_queue_overflow` settings.
+DEFAULT_SEND_QUEUE_SIZE = 256
+DEFAULT_SEND_QUEUE_OVERFLOW = "close"
+
+# Messages smaller than this many bytes aren't worth compressing for clients
+# which negotiated permessage-deflate. This can be overridden by the
+# `h.streamer.deflate_min_size` setting.
+DEFAULT_DEFLATE_MIN_SIZE = 1024
+
+# How many bytes to read from a socket at a time when inflating its messages
+_INFLATING_READING_SIZE = 4096
+
+# The ping we send to every client with each heartbeat
+_PING = PingControlMessage(b"").single(mask=False)
+
 
 # An incoming message from a WebSocket client.
 class Message(namedtuple("Message", ["socket", "payload"])):
@@ -36,29 +60,121 @@ class Message(namedtuple("Message", ["socket", "payload"])):
         self.socket.send_json(data)
 
 
+class PrincipalSet(frozenset):
+    """
+    A set of principals shared between all sockets with the same principals.
+
+    Most connections share a few principal sets (anonymous, world-only etc.),
+    so interning them lets us make authorization decisions once per distinct
+    set rather than once per socket. See `intern_principals()`.
+    """
+
+
+# Interned principal sets. These are weakly held so that each set disappears
+# along with the last socket using it
+_PRINCIPAL_SETS = weakref.WeakValueDictionary()
+
+
+def intern_principals(principals):
+    """Get the shared `PrincipalSet` for an iterable of principals."""
+    key = frozenset(principals)
+
+    principal_set = _PRINCIPAL_SETS.get(key)
+    if principal_set is None:
+        principal_set = _PRINCIPAL_SETS[key] = PrincipalSet(key)
+
+    return principal_set
+
+
 class WebSocket(_WebSocket):
     # All instances of WebSocket, allowing us to iterate over open websockets
     instances = weakref.WeakSet()
 
-    # Instance attributes
-    client_id = None
-    filter = None
-    query = None
+    # Counts of send queue overflows by the action taken ("drop" or "close"),
+    # since they were last reported by `h.streamer.metrics`
+    send_queue_overflows = Counter()
+
+    # There can be tens of thousands of connections to each worker, so the
+    # state we keep for each is held in slots. ws4py's `WebSocket` has no
+    # slots, so instances still have a dict for ws4py's own attributes, but
+    # keeping ours out of it roughly halves the memory of an idle connection
+    # (see `TestWebSocketMemory`). See also `intern_principals()` and
+    # `h.streamer.filter.intern_rows()`
+    __slots__ = (
+        "authenticated_userid",
+        "effective_principals",
+        "client_id",
+        "filter_rows",
+        "filter_received",
+        "connected_at",
+        "last_received",
+        "_work_queue",
+        "_send_queue",
+        "_send_queue_size",
+        "_send_queue_overflow",
+        "_sender",
+        "_write_lock",
+        "_sent_recently",
+        "_opened",
+        "_closed",
+        "_deflate_level",
+        "_deflate_min_size",
+        "_inflater",
+        "_frame_bytes_wanted",
+    )
 
     def __init__(self, sock, protocols=None, extensions=None, environ=None):
+        # We take what we need from the WSGI environ here, rather than keeping
+        # all of it for the life of the connection
         super().__init__(
             sock,
             protocols=protocols,
             extensions=extensions,
-            environ=environ,
-            heartbeat_freq=30.0,
+            environ=None,
+            # Heartbeats are sent to every connection by `heartbeat.HEARTBEATS`
+            heartbeat_freq=None,
         )
 
         self.authenticated_userid = environ["h.ws.authenticated_userid"]
-        self.effective_principals = environ["h.ws.effective_principals"]
+        self.effective_principals = intern_principals(
+            environ["h.ws.effective_principals"]
+        )
+        self.client_id = None
+        self.filter_rows = ()
+        self.filter_received = False
+        self.connected_at = self.last_received = monotonic()
 
         self._work_queue = environ["h.ws.streamer_work_queue"]
 
+        # Messages are sent from a queue by a greenlet per socket, so that a
+        # slow client can't hold up sending to everyone else. Most connections
+        # are idle most of the time, so the queue and greenlet are only started
+        # when there's something to send, and stopped again once idle
+        self._send_queue = None
+        self._send_queue_size = environ.get(
+            "h.ws.send_queue_size", DEFAULT_SEND_QUEUE_SIZE
+        )
+        self._send_queue_overflow = environ.get(
+            "h.ws.send_queue_overflow", DEFAULT_SEND_QUEUE_OVERFLOW
+        )
+        self._sender = None
+        # ws4py writes pongs and close frames itself, from whichever greenlet
+        # is running, so writes are serialized with this (see `_write()`)
+        self._write_lock = Semaphore()
+        self._sent_recently = False
+        self._opened = False
+        self._closed = False
+
+        # permessage-deflate compression, if the client negotiated it
+        self._deflate_level = environ.get("h.ws.deflate_level")
+        self._deflate_min_size = environ.get(
+            "h.ws.deflate_min_size", DEFAULT_DEFLATE_MIN_SIZE
+        )
+        self._inflater = None
+        if self._deflate_level is not None:
+            self._inflater = deflate.Inflater()
+            self._frame_bytes_wanted = DEFAULT_READING_SIZE
+
     def __new__(cls, *_args, **_kwargs):
         instance = super(WebSocket, cls).__new__(cls)
         cls.instances.add(instance)
@@ -78,15 +194,235 @@ class WebSocket(_WebSocket):
                 "WebSocket client having waited 0.1s: giving up."
             )
 
+    def process(self, data):
+        # Anything the client sends, including pongs, shows it's still there
+        self.last_received = monotonic()
+
+        if self._inflater is None or not data:
+            return super().process(data)
+
+        # ws4py can't parse compressed frames, so we inflate them first and
+        # then feed them to ws4py as many bytes at a time as it asks for
+        try:
+            for frame in self._inflater.frames(data):
+                while frame:
+                    wanted = self._frame_bytes_wanted
+                    if not super().process(frame[:wanted]):
+                        return False
+
+                    frame = frame[wanted:]
+                    self._frame_bytes_wanted = self.reading_buffer_size
+        except deflate.MessageTooBig as err:
+            # Close like ws4py does for protocol errors, with "Message Too Big"
+            log.debug("Closing connection: %s", err)
+            self.close(code=1009, reason="message too big")
+            return False
+
+        # The inflater buffers partial frames, so can take any amount
+        self.reading_buffer_size = _INFLATING_READING_SIZE
+        return True
+
+    def request_replay(self, message, since):
+        """Queue a replay of the events after `since`, requested by `message`."""
+        try:
+            self._work_queue.put(
+                replay.Replay(message=message, since=since), timeout=0.1
+            )
+        except Full:
+            log.warning(
+                "Streamer work queue full! Unable to queue replay for "
+                "WebSocket client having waited 0.1s: giving up."
+            )
+            message.reply({"type": "replay", "complete": False})
+
+    def opened(self):
+        self._opened = True
+        heartbeat.HEARTBEATS.add(self)
+
+        # Send anything queued before the handshake was complete
+        if self._send_queue is not None:
+            self._sender = gevent.spawn(self._send_queued_frames)
+
     def closed(self, code, reason=None):
         try:
             self.instances.remove(self)
         except KeyError:
             pass
 
+        SocketFilter.remove_filter(self)
+
+        self._closed = True
+        if self._sender is not None:
+            self._sender.kill(block=False)
+
+    @property
+    def send_queue_depth(self):
+        """Get the number of messages waiting to be sent to the client."""
+        if self._send_queue is None:
+            return 0
+
+        return self._send_queue.qsize()
+
     def send_json(self, payload):
-        if not self.terminated:
-            self.send(json.dumps(payload))
+        self.send_frame(json_frame(payload))
+
+    def send_frame(self, frame):
+        """
+        Queue a pre-built `Frame` from `json_frame()` to be sent to the client.
+
+        This lets us serialize a message once, no matter how many clients it
+        is sent to. If the client has too many messages waiting already, the
+        frame is dropped or the connection closed, depending on the settings.
+        """
+        if self.terminated or self.server_terminated:
+            return
+
+        deflate_level = self._deflate_level
+        if len(frame.data) < self._deflate_min_size:
+            deflate_level = None
+
+        if not self._enqueue(frame.build(deflate_level)):
+            self._send_queue_overflowed()
+            return
+
+        self._sent_recently = True
+
+    def heartbeat(self):
+        """
+        Ping the client, and free the send queue if it has been idle.
+
+        This is called every heartbeat interval by `heartbeat.HEARTBEATS`.
+        """
+        self._enqueue(_PING)
+        self._stop_sender_if_idle()
+
+    def abort(self):
+        """Drop the connection without a closing handshake."""
+        self.server_terminated = True
+        self.close_connection()
+
+    def close_queued(self, code=1000, reason=""):
+        """
+        Start the closing handshake after sending anything already queued.
+
+        Unlike `close()`, this doesn't write to the socket itself, so can't be
+        held up by a slow client. A client which doesn't answer is dropped.
+        """
+        if self.server_terminated or not self._enqueue(
+            CloseControlMessage(code=code, reason=reason).single(mask=False)
+        ):
+            self.abort()
+            return
+
+        self.server_terminated = True
+
+    def _write(self, b):
+        # A write can block partway through a frame when the client is slow to
+        # read, which mustn't let another greenlet write into the middle of it
+        with self._write_lock:
+            super()._write(b)
+
+    def _enqueue(self, data):
+        """Queue bytes to be sent, returning `False` if the queue is full."""
+        if self._closed:
+            return True
+
+        if self._send_queue is None:
+            self._send_queue = Queue(maxsize=self._send_queue_size)
+            if self._opened:
+                self._sender = gevent.spawn(self._send_queued_frames)
+
+        try:
+            self._send_queue.put_nowait(data)
+        except Full:
+            return False
+
+        return True
+
+    def _stop_sender_if_idle(self):
+        if self._sender is None:
+            return
+
+        if self._sent_recently:
+            self._sent_recently = False
+            return
+
+        # This ends the sender's iteration over the queue, once it has sent
+        # anything which is already queued
+        try:
+            self._send_queue.put_nowait(StopIteration)
+        except Full:
+            pass
+
+    def _send_queue_overflowed(self):
+        self.send_queue_overflows[self._send_queue_overflow] += 1
+
+        if self._send_queue_overflow == "close":
+            log.info("Closing connection to a client which isn't keeping up")
+
+            # We can't send a close frame to a client which isn't reading what
+            # we send, so just drop the connection
+            self.abort()
+
+    def _send_queued_frames(self):
+        queue = self._send_queue
+
+        try:
+            for frame in queue:
+                self._write(frame)
+
+            # We were asked to stop, but send anything queued since
+            while queue.qsize():
+                frame = queue.get_nowait()
+                if frame is not StopIteration:
+                    self._write(frame)
+        except (RuntimeError, OSError):
+            # The connection has gone, so we can't send anything else
+            self._closed = True
+        finally:
+            # Greenlets only switch when they block, so nothing can be queued
+            # between checking the queue above and dropping it here
+            self._send_queue = None
+            self._sender = None
+
+
+class Frame:
+    """
+    A serialized text message which can be sent to any number of sockets.
+
+    The bytes sent to each socket depend on whether it negotiated compression,
+    so each variant of the frame is built once, when it is first needed.
+    """
+
+    __slots__ = ("data", "_built")
+
+    def __init__(self, data):
+        self.data = data
+        self._built = {}
+
+    def build(self, deflate_level=None):
+        """Get the frame's bytes, compressed if `deflate_level` is given."""
+        frame = self._built.get(deflate_level)
+
+        if frame is None:
+            if deflate_level is None:
+                frame = TextMessage(self.data).single(mask=False)
+            else:
+                frame = deflate.deflate_frame(self.data, deflate_level)
+
+            self._built[deflate_level] = frame
+
+        return frame
+
+
+def json_frame(payload):
+    """
+    Serialize `payload` into a websocket text frame ready to send.
+
+    The frame is unmasked, as it is always sent from the server, and so can be
+    sent as-is to any number of sockets with `WebSocket.send_frame()`.
+    """
+    return Frame(json.dumps(payload).encode("utf-8"))
 
 
 def handle_message(message, session=None):
@@ -165,6 +501,25 @@ def handle_filter_message(message, session=None):  # pylint: disable=unused-argu
         return
 
     SocketFilter.set_filter(message.socket, filter_)
+    message.socket.filter_received = True
+
+    # Clients which reconnect can ask for the events they missed
+    since = message.payload.get("since")
+    if since is not None:
+        if not isinstance(since, (int, float)):
+            message.reply(
+                {
+                    "type": "error",
+                    "error": {
+                        "type": "invalid_data",
+                        "description": '"since" must be a number',
+                    },
+                },
+                ok=False,
+            )
+            return
+
+        message.socket.request_replay(message, since)
 
 
 MESSAGE_HANDLERS["filter"] = handle_filter_message
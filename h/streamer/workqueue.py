@@ -0,0 +1,101 @@
+"""
+A work queue with separate lanes for different kinds of work.
+
+The streamer's work queue takes both annotation and user events from the
+message queues (which are sent to every interested client, and need the DB)
+and control messages from clients, like `filter` and `ping` (which are
+cheap, and only concern the client that sent them). If these all shared one
+queue, new clients would wait behind the fan-out of every event before them,
+and when the queue filled up their messages would be dropped.
+
+Instead, each kind of work is put in its own bounded lane, and the lanes are
+served by weighted round robin: up to `weight` messages are taken from a lane
+in turn before moving on to the next lane with anything in it. So no lane can
+starve another, and a lane with a higher weight gets a bigger share of the
+worker when they are all busy.
+"""
+
+from collections import namedtuple
+
+from gevent.lock import Semaphore
+from gevent.queue import Empty, Queue
+
+Lane = namedtuple("Lane", ["name", "maxsize", "weight"])
+
+
+class WorkQueue:
+    """
+    A queue of lanes, with the same interface as `gevent.queue.Queue`.
+
+    Which lane each message is put in is decided by `lane_for(message)`, so
+    producers don't need to know about lanes at all.
+    """
+
+    def __init__(self, lanes, lane_for):
+        """
+        Create a work queue.
+
+        :param lanes: The `Lane`s of the queue, in the order they are served
+        :param lane_for: A function returning the name of the lane to put a
+            message in
+        """
+        self.lanes = {lane.name: Queue(maxsize=lane.maxsize) for lane in lanes}
+        self._weights = [(self.lanes[lane.name], lane.weight) for lane in lanes]
+        self._lane_for = lane_for
+
+        # Counts the messages in every lane, so `get()` can wait on them all
+        self._messages = Semaphore(0)
+
+        # The lane currently being served, and how many more messages can be
+        # taken from it before moving on
+        self._current = 0
+        self._credit = self._weights[0][1]
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Put `item` in its lane.
+
+        :raise gevent.queue.Full: If the lane is full and stays full for
+            `timeout` seconds (or at all, if `block` is false)
+        """
+        self.lanes[self._lane_for(item)].put(item, block, timeout)
+        self._messages.release()
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        """
+        Take the next message, from whichever lane's turn it is.
+
+        :raise gevent.queue.Empty: If every lane is empty and stays empty for
+            `timeout` seconds (or at all, if `block` is false)
+        """
+        if not self._messages.acquire(blocking=block, timeout=timeout):
+            raise Empty()
+
+        # There's definitely a message in one of the lanes now, so this ends
+        while True:
+            queue = self._weights[self._current][0]
+            if self._credit and queue.qsize():
+                self._credit -= 1
+                return queue.get_nowait()
+
+            self._current = (self._current + 1) % len(self._weights)
+            self._credit = self._weights[self._current][1]
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        """Get the number of messages in every lane."""
+        return sum(queue.qsize() for queue in self.lanes.values())
+
+    def empty(self):
+        return not self.qsize()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.get()
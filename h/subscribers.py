@@ -57,6 +57,25 @@ def publish_annotation_event(event):
         "annotation_id": event.annotation_id,
         "src_client_id": event.request.headers.get("X-Client-Id"),
     }
+
+    # Add the keys the streamer routes on, so it can tell whether anyone is
+    # listening before it loads the annotation. See
+    # `h.streamer.filter.SocketFilter.might_match()`
+    with event.request.tm:
+        annotation = storage.fetch_annotation(event.request.db, event.annotation_id)
+        if annotation is not None:
+            data.update(
+                {
+                    "group": annotation.groupid,
+                    # Include the URIs equivalent to the target, so sockets
+                    # watching any variant of the document are considered
+                    "uris": storage.expand_uri(
+                        event.request.db, annotation.target_uri, normalized=True
+                    ),
+                    "references": annotation.references,
+                }
+            )
+
     try:
         event.request.realtime.publish_annotation(data)
 
@@ -0,0 +1,53 @@
+"""Caches of values which are expensive to work out."""
+
+from collections import OrderedDict
+from time import monotonic
+
+
+class MemoryBackend:
+    """
+    A bounded, in-process LRU cache with TTLs.
+
+    This is the default backend of the search cache (see `h.search.cache`),
+    where shared backends (like one for memcached or Redis) with the same
+    `get()` and `set()` methods can be configured instead.
+    """
+
+    def __init__(self, maxsize=1024, clock=monotonic):
+        self.maxsize = maxsize
+        self._clock = clock
+
+        # `(expires, value)` for each key, least recently used first
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """Get the value for `key`, or `None` if there isn't one."""
+        try:
+            expires, value = self._entries[key]
+        except KeyError:
+            return None
+
+        if expires is not None and expires <= self._clock():
+            del self._entries[key]
+            return None
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Set the value for `key`, which expires after `ttl` seconds if given."""
+        expires = None if ttl is None else self._clock() + ttl
+
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Delete the value for `key`, if there is one."""
+        self._entries.pop(key, None)
+
+    def clear(self):
+        """Delete every value."""
+        self._entries.clear()
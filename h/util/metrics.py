@@ -18,9 +18,11 @@ def record_search_query_params(params, separate_replies):
     :type separate_replies: bool
     """
     keys = [
-        # Record usage of inefficient offset and it's alternative search_after.
+        # Record usage of inefficient offset and it's alternatives search_after
+        # and cursor.
         "offset",
         "search_after",
+        "cursor",
         "sort",
         # Record usage of url/uri (url is an alias of uri).
         "url",
@@ -14,6 +14,8 @@ particular, requests to the CRUD API endpoints are protected by the Pyramid
 authorization system. You can find the mapping between annotation "permissions"
 objects and Pyramid ACLs in :mod:`h.traversal`.
 """
+from contextlib import nullcontext
+
 from pyramid import i18n
 
 from h import search as search_lib
@@ -26,6 +28,7 @@ from h.schemas.annotation import (
     UpdateAnnotationSchema,
 )
 from h.schemas.util import validate_query_params
+from h.search.profile import SearchProfile
 from h.security import Permission
 from h.views.api.config import api_config
 from h.views.api.exceptions import PayloadError
@@ -45,15 +48,44 @@ def search(request):
     params = validate_query_params(schema, request.params)
 
     separate_replies = params.pop("_separate_replies", False)
-
-    result = search_lib.Search(request, separate_replies=separate_replies).run(params)
+    reply_cursors = params.pop("_reply_cursors", False)
+
+    # Only staff (who can see the admin pages) can see where the time goes,
+    # and the option is ignored for everyone else
+    profile = None
+    if params.pop("_profile", False) and request.has_permission(
+        Permission.AdminPage.INDEX
+    ):
+        profile = SearchProfile(request.db)
+
+    result = search_lib.Search(
+        request,
+        separate_replies=separate_replies,
+        reply_cursors=reply_cursors,
+        cache=True,
+        prefetch_replies=request.feature("search_prefetch_replies"),
+        profile=profile,
+    ).run(params)
 
     svc = request.find_service(name="annotation_json_presentation")
 
-    out = {"total": result.total, "rows": svc.present_all(result.annotation_ids)}
+    with _profile_step(profile, "present/annotations"):
+        out = {"total": result.total, "rows": svc.present_all(result.annotation_ids)}
+
+    if result.cursor:
+        out["cursor"] = result.cursor
 
     if separate_replies:
-        out["replies"] = svc.present_all(result.reply_ids)
+        with _profile_step(profile, "present/replies"):
+            out["replies"] = svc.present_all(result.reply_ids)
+
+        # Cursors for the rest of the replies to annotations with too many to
+        # return at once, to page through with `references` searches
+        if result.reply_cursors:
+            out["reply_cursors"] = result.reply_cursors
+
+    if profile is not None:
+        out["profile"] = profile.asdict()
 
     return out
 
@@ -163,6 +195,14 @@ def _json_payload(request):
         raise PayloadError() from err
 
 
+def _profile_step(profile, name):
+    """Return a step of `profile` to time, if the search is being profiled."""
+    if profile is None:
+        return nullcontext()
+
+    return profile.step(name)
+
+
 def _publish_annotation_event(request, annotation, action):
     """Publish an event to the annotations queue for this annotation action."""
     event = AnnotationEvent(request, annotation.id, action)
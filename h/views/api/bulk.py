@@ -7,6 +7,7 @@ from pyramid.response import Response
 from h.auth.util import client_authority
 from h.security import Permission
 from h.services.bulk_executor import BulkExecutor
+from h.services.group import readable_groups_cache
 from h.views.api.config import api_config
 
 
@@ -35,7 +36,11 @@ def bulk(request):
 
     results = BulkAPI.from_byte_stream(
         request.body_file,
-        executor=BulkExecutor(db=request.db, authority=client_authority(request)),
+        executor=BulkExecutor(
+            db=request.db,
+            authority=client_authority(request),
+            readable_cache=readable_groups_cache(request),
+        ),
     )
 
     if results is None:
@@ -113,7 +113,7 @@ def badge(request):
 
     else:
         query = MultiDict({"uri": uri, "limit": 0})
-        result = search.Search(request).run(query)
+        result = search.Search(request, cache=True).run(query)
         count = result.total
 
     return {"total": count}
@@ -13,6 +13,7 @@ from webob.multidict import MultiDict
 
 from h import db
 from h.models import Organization
+from h.models.document import EXPANDED_URIS
 from h.settings import database_url
 from tests.common import factories as common_factories
 from tests.common.fixtures import es_client  # pylint:disable=unused-import
@@ -133,6 +134,9 @@ def db_session(db_engine):
         trans.rollback()
         conn.close()
 
+        # Forget the URIs of documents which have been rolled back
+        EXPANDED_URIS.clear()
+
 
 @pytest.fixture
 def factories(db_session):
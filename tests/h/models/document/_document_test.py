@@ -184,6 +184,13 @@ class TestMergeDocuments:
 
         assert merged == duplicate_docs[0]
 
+    def test_it_invalidates_the_expanded_uris_of_the_first(
+        self, db_session, duplicate_docs, EXPANDED_URIS
+    ):
+        merged = merge_documents(db_session, duplicate_docs)
+
+        EXPANDED_URIS.invalidate.assert_called_once_with(db_session, merged)
+
     def test_it_deletes_all_but_the_first(self, db_session, duplicate_docs):
         merge_documents(db_session, duplicate_docs)
         db_session.flush()
@@ -271,6 +278,7 @@ class TestMergeDocuments:
         return documents
 
 
+@pytest.mark.usefixtures("EXPANDED_URIS")
 class TestUpdateDocumentMetadata:
     @pytest.mark.parametrize(
         "created,updated", ((sentinel.created, sentinel.updated), (None, None))
@@ -320,6 +328,13 @@ class TestUpdateDocumentMetadata:
         first.assert_called_once_with()
         assert result == first.return_value
 
+    def test_it_invalidates_the_expanded_uris_of_the_document(
+        self, Document, caller, EXPANDED_URIS
+    ):
+        document = caller()
+
+        EXPANDED_URIS.invalidate.assert_called_once_with(sentinel.db_session, document)
+
     def test_it_updates_document_updated(self, Document, caller):
         caller(updated=sentinel.updated)
 
@@ -429,6 +444,11 @@ class TestUpdateDocumentMetadata:
         return patch("h.models.document._document.merge_documents")
 
 
+@pytest.fixture
+def EXPANDED_URIS(patch):
+    return patch("h.models.document._document.EXPANDED_URIS")
+
+
 @pytest.fixture
 def datetime(patch):
     datetime = patch("h.models.document._document.datetime")
@@ -1,13 +1,15 @@
 from datetime import datetime, timedelta
+from unittest import mock
 from unittest.mock import Mock
 
 import pytest
 import sqlalchemy as sa
 from h_matchers import Any
+from sqlalchemy.orm import Session
 
 from h.models.document import ConcurrentUpdateError, create_or_update_document_uri
 from h.models.document._document import Document
-from h.models.document._uri import DocumentURI
+from h.models.document._uri import DocumentURI, ExpandedURICache
 
 
 class TestDocumentURI:
@@ -168,3 +170,109 @@ class TestCreateOrUpdateDocumentURI:
     @pytest.fixture
     def log(self, patch):
         return patch("h.models.document._uri.log")
+
+
+class TestExpandedURICache:
+    def test_it_caches_uris(self, cache):
+        cache.set("httpx://example.com", [("self-claim", "http://example.com", "x")])
+
+        assert cache.get("httpx://example.com") == [
+            ("self-claim", "http://example.com", "x")
+        ]
+        assert cache.get("httpx://example.org") is None
+
+    def test_uris_expire(self, cache, clock):
+        cache.set("httpx://example.com", [])
+
+        clock.return_value = 160
+        assert cache.get("httpx://example.com") is None
+
+    def test_invalidate_invalidates_every_uri_of_the_document(
+        self, cache, db_session, document
+    ):
+        for uri in ("httpx://example.com", "httpx://example.com/canonical"):
+            cache.set(uri, [])
+        cache.set("httpx://example.org", [])
+
+        cache.invalidate(db_session, document)
+
+        assert cache.get("httpx://example.com") is None
+        # URIs cached before the change is committed are invalidated again
+        cache.set("httpx://example.com", [])
+        db_session.commit()
+        assert cache.get("httpx://example.com") is None
+        assert cache.get("httpx://example.com/canonical") is None
+        assert cache.get("httpx://example.org") == []
+
+    def test_invalidate_invalidates_after_a_rollback(self, cache, db_session, document):
+        db_session.execute(sa.text("SELECT 1"))
+        cache.invalidate(db_session, document)
+        cache.set("httpx://example.com", [])
+        db_session.rollback()
+
+        assert cache.get("httpx://example.com") is None
+
+    def test_invalidate_only_listens_to_each_session_once(
+        self, cache, db_session, document
+    ):
+        cache.invalidate(db_session, document)
+        cache.invalidate(db_session, document)
+        db_session.commit()
+
+        # Once for each invalidation, and once at the end of the transaction
+        assert cache.generation == 3
+
+    def test_uris_read_before_an_invalidation_arent_cached(
+        self, cache, db_session, document
+    ):
+        generation = cache.generation
+        cache.invalidate(db_session, document)
+
+        cache.set("httpx://example.com", [], generation)
+
+        assert cache.get("httpx://example.com") is None
+
+    @pytest.fixture
+    def document(self):
+        return Document(
+            document_uris=[
+                DocumentURI(uri="http://example.com/"),
+                DocumentURI(uri="http://example.com/canonical"),
+            ]
+        )
+
+    @pytest.fixture
+    def db_session(self, db_engine):
+        # A session of its own, as the `db_session` fixture's transaction is
+        # only ended once the test is over
+        session = Session(bind=db_engine)
+        yield session
+        session.close()
+
+    def test_it_counts_and_records_hits_and_misses(self, cache, newrelic_agent):
+        cache.set("httpx://example.com", [])
+
+        cache.get("httpx://example.com")
+        cache.get("httpx://example.com")
+        cache.get("httpx://example.org")
+
+        assert newrelic_agent.record_custom_metric.call_args_list == [
+            mock.call("Custom/Storage/ExpandURI/Cache/Hits", 1),
+            mock.call("Custom/Storage/ExpandURI/Cache/Hits", 1),
+            mock.call("Custom/Storage/ExpandURI/Cache/Misses", 1),
+        ]
+        assert cache.report() == {"Hits": 2, "Misses": 1}
+        # The counts are reset once they've been reported
+        assert cache.report() == {"Hits": 0, "Misses": 0}
+
+    @pytest.fixture
+    def clock(self):
+        return Mock(return_value=100)
+
+    @pytest.fixture
+    def cache(self, clock):
+        return ExpandedURICache(ttl=60, clock=clock)
+
+    @pytest.fixture
+    def newrelic_agent(self, patch):
+        return patch("h.models.document._uri.newrelic.agent")
@@ -3,6 +3,7 @@ from unittest import mock
 
 import pytest
 
+from h.models.group import ReadableBy
 from h.presenters.annotation_searchindex import AnnotationSearchIndexPresenter
 
 pytestmark = pytest.mark.usefixtures("moderation_service")
@@ -45,6 +46,7 @@ class TestAnnotationSearchIndexPresenter:
             "tags": ["magic"],
             "tags_raw": ["magic"],
             "group": "__world__",
+            "group_world_readable": False,
             "shared": True,
             "target": [
                 {
@@ -59,6 +61,25 @@ class TestAnnotationSearchIndexPresenter:
             "hidden": False,
         }
 
+    @pytest.mark.parametrize(
+        "readable_by,world_readable",
+        ((ReadableBy.world, True), (ReadableBy.members, False), (None, False)),
+    )
+    def test_it_marks_annotations_in_world_readable_groups(
+        self, pyramid_request, readable_by, world_readable
+    ):
+        annotation = mock.MagicMock(userid="acct:luke@hypothes.is")
+        if readable_by is None:
+            annotation.group = None
+        else:
+            annotation.group.readable_by = readable_by
+
+        annotation_dict = AnnotationSearchIndexPresenter(
+            annotation, pyramid_request
+        ).asdict()
+
+        assert annotation_dict["group_world_readable"] == world_readable
+
     @pytest.mark.parametrize("is_moderated", [True, False])
     @pytest.mark.parametrize("replies_moderated", [True, False])
     def test_it_marks_annotation_hidden_correctly(
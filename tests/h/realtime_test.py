@@ -82,6 +82,99 @@ class TestConsumer:
         return patch("h.realtime.Consumer.generate_queue_name")
 
 
+class TestTopicConsumer:
+    def test_get_consumers_creates_a_queue_bound_to_the_routing_keys(
+        self, consumer, consumer_factory, generate_queue_name
+    ):
+        consumer.get_consumers(consumer_factory, mock.Mock())
+
+        consumer_factory.assert_called_once_with(
+            queues=[Any.instance_of(kombu.Queue)], callbacks=[consumer.handle_message]
+        )
+        queue = consumer_factory.call_args[1]["queues"][0]
+        assert queue.name == generate_queue_name.return_value
+        assert not queue.durable
+        assert queue.auto_delete
+        assert {
+            (binding.exchange, binding.routing_key) for binding in queue.bindings
+        } == {
+            (realtime.get_topic_exchange(), "annotation.group.a"),
+            (realtime.get_topic_exchange(), "annotation.group.b"),
+        }
+
+    def test_get_consumers_returns_list_of_one_consumer(
+        self, consumer, consumer_factory
+    ):
+        consumers = consumer.get_consumers(consumer_factory, channel=None)
+
+        assert consumers == [consumer_factory.return_value]
+
+    def test_on_iteration_updates_the_bindings(
+        self, consumer, consumer_factory, routing_keys, queue
+    ):
+        consumer.get_consumers(consumer_factory, channel=None)
+        routing_keys.return_value = frozenset(
+            ["annotation.group.b", "annotation.group.c"]
+        )
+
+        consumer.on_iteration()
+
+        queue.bind_to.assert_called_once_with(
+            realtime.get_topic_exchange(), routing_key="annotation.group.c"
+        )
+        queue.unbind_from.assert_called_once_with(
+            realtime.get_topic_exchange(), routing_key="annotation.group.a"
+        )
+
+    def test_on_iteration_does_nothing_if_the_keys_are_the_same(
+        self, consumer, consumer_factory, queue
+    ):
+        consumer.get_consumers(consumer_factory, channel=None)
+
+        consumer.on_iteration()
+
+        queue.bind_to.assert_not_called()
+        queue.unbind_from.assert_not_called()
+
+    def test_on_iteration_only_updates_changed_bindings_once(
+        self, consumer, consumer_factory, routing_keys, queue
+    ):
+        consumer.get_consumers(consumer_factory, channel=None)
+        routing_keys.return_value = frozenset(["annotation.group.c"])
+
+        consumer.on_iteration()
+        consumer.on_iteration()
+
+        assert queue.bind_to.call_count == 1
+        assert queue.unbind_from.call_count == 2
+
+    @pytest.fixture
+    def consumer(self, routing_keys):
+        return realtime.TopicConsumer(
+            mock.sentinel.connection, routing_keys, mock.sentinel.handler
+        )
+
+    @pytest.fixture
+    def routing_keys(self):
+        return mock.Mock(
+            return_value=frozenset(["annotation.group.a", "annotation.group.b"])
+        )
+
+    @pytest.fixture
+    def queue(self):
+        return mock.create_autospec(kombu.Queue, instance=True)
+
+    @pytest.fixture
+    def consumer_factory(self, queue):
+        consumer_factory = mock.Mock(spec_set=[])
+        consumer_factory.return_value.queues = [queue]
+        return consumer_factory
+
+    @pytest.fixture
+    def generate_queue_name(self, patch):
+        return patch("h.realtime.TopicConsumer.generate_queue_name")
+
+
 class TestPublisher:
     def test_publish_annotation(self, producer, publisher, exchange):
         payload = {"action": "create", "annotation": {"id": "foobar"}}
@@ -89,7 +182,7 @@ class TestPublisher:
         publisher.publish_annotation(payload)
 
         producer.publish.assert_called_once_with(
-            payload,
+            {**payload, "published_at": Any.float()},
             exchange=exchange,
             declare=[exchange],
             routing_key="annotation",
@@ -97,13 +190,37 @@ class TestPublisher:
             retry_policy=RETRY_POLICY_VERY_QUICK,
         )
 
+    @pytest.mark.parametrize(
+        "group,routing_key",
+        (("abc123", "annotation.group.abc123"), (None, "annotation.unknown")),
+    )
+    def test_publish_annotation_with_topic_routing(
+        self, producer, pyramid_request, group, routing_key
+    ):
+        pyramid_request.registry.settings["h.realtime.annotation_routing"] = "topic"
+        payload = {"action": "create", "annotation_id": "foobar"}
+        if group:
+            payload["group"] = group
+
+        realtime.Publisher(pyramid_request).publish_annotation(payload)
+
+        exchange = realtime.get_topic_exchange()
+        producer.publish.assert_called_once_with(
+            {**payload, "published_at": Any.float()},
+            exchange=exchange,
+            declare=[exchange],
+            routing_key=routing_key,
+            retry=True,
+            retry_policy=RETRY_POLICY_VERY_QUICK,
+        )
+
     def test_publish_user(self, producer, publisher, exchange):
         payload = {"action": "create", "user": {"id": "foobar"}}
 
         publisher.publish_user(payload)
 
         producer.publish.assert_called_once_with(
-            payload,
+            {**payload, "published_at": Any.float()},
             exchange=exchange,
             declare=[exchange],
             routing_key="user",
@@ -111,6 +228,14 @@ class TestPublisher:
             retry_policy=RETRY_POLICY_VERY_QUICK,
         )
 
+    @pytest.mark.usefixtures("producer")
+    def test_publish_doesnt_modify_the_payload(self, publisher):
+        payload = {"action": "create", "user": {"id": "foobar"}}
+
+        publisher.publish_user(payload)
+
+        assert "published_at" not in payload
+
     @pytest.mark.parametrize("exception", (OperationalError, LimitExceeded))
     def test_it_raises_RealtimeMessageQueueError_on_errors(
         self, publisher, producer, exception
@@ -154,6 +279,17 @@ class TestGetExchange:
         assert exchange.delivery_mode == 1
 
 
+class TestGetTopicExchange:
+    def test_it(self):
+        exchange = realtime.get_topic_exchange()
+
+        assert isinstance(exchange, kombu.Exchange)
+        assert exchange.name == "realtime-topic"
+        assert exchange.type == "topic"
+        assert not exchange.durable
+        assert exchange.delivery_mode == 1
+
+
 class TestGetConnection:
     def test_defaults(self, Connection):
         realtime.get_connection({})
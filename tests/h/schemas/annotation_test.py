@@ -11,7 +11,7 @@ from h.schemas.annotation import (
     UpdateAnnotationSchema,
 )
 from h.schemas.util import validate_query_params
-from h.search.query import LIMIT_DEFAULT, LIMIT_MAX, OFFSET_MAX
+from h.search.query import LIMIT_DEFAULT, LIMIT_MAX, OFFSET_MAX, encode_cursor
 
 
 def create_annotation_schema_validate(request, data):
@@ -575,6 +575,8 @@ class TestSearchParamsSchema:
         expected_params = MultiDict(
             {
                 "_separate_replies": True,
+                "_reply_cursors": True,
+                "_profile": True,
                 "group": "group1",
                 "quote": "quote me",
                 "references": "3456TA12",
@@ -598,6 +600,8 @@ class TestSearchParamsSchema:
             MultiDict(
                 {
                     "_separate_replies": "1",
+                    "_reply_cursors": "1",
+                    "_profile": "1",
                     "group": "group1",
                     "quote": "quote me",
                     "references": "3456TA12",
@@ -688,6 +692,21 @@ class TestSearchParamsSchema:
         with pytest.raises(ValidationError):
             validate_query_params(schema, input_params)
 
+    def test_it_accepts_a_cursor(self, schema):
+        cursor = encode_cursor("updated", "desc", [1514764800000, "abc"])
+        input_params = NestedMultiDict(MultiDict({"cursor": cursor, "offset": "20"}))
+
+        params = validate_query_params(schema, input_params)
+
+        assert params["cursor"] == cursor
+        assert params["offset"] == 0
+
+    def test_raises_if_invalid_cursor(self, schema):
+        input_params = NestedMultiDict(MultiDict({"cursor": "invalid"}))
+
+        with pytest.raises(ValidationError):
+            validate_query_params(schema, input_params)
+
     def test_raises_if_invalid_search_after_date(self, schema):
         input_params = NestedMultiDict(MultiDict({"search_after": "invalid_date"}))
 
@@ -0,0 +1,215 @@
+from unittest import mock
+
+import pytest
+from webob.multidict import MultiDict
+
+from h.search.cache import (
+    ALL,
+    SearchCache,
+    annotation_tags,
+    get_cache,
+    search_key,
+    search_tags,
+)
+from h.util.cache import MemoryBackend
+
+
+class TestSearchCache:
+    def test_it_caches_results(self, search_cache):
+        set_(search_cache, "key", {"uri:example.com"}, "result")
+
+        assert get(search_cache, "key", {"uri:example.com"}) == "result"
+        assert get(search_cache, "other_key", {"uri:example.com"}) is None
+        assert get(search_cache, "key", {"uri:example.org"}) is None
+
+    def test_it_caches_results_for_the_ttl(self, search_cache, clock):
+        set_(search_cache, "key", {ALL}, "result")
+
+        clock.return_value = 129
+        assert get(search_cache, "key", {ALL}) == "result"
+        clock.return_value = 130
+        assert get(search_cache, "key", {ALL}) is None
+
+    def test_invalidate_invalidates_results_with_any_of_the_tags(self, search_cache):
+        set_(search_cache, "key_1", {"uri:example.com"}, "result_1")
+        set_(search_cache, "key_2", {"group:abc", "group:def"}, "result_2")
+        set_(search_cache, "key_3", {"uri:example.org"}, "result_3")
+
+        search_cache.invalidate({"uri:example.com", "group:def"})
+
+        assert get(search_cache, "key_1", {"uri:example.com"}) is None
+        assert get(search_cache, "key_2", {"group:abc", "group:def"}) is None
+        assert get(search_cache, "key_3", {"uri:example.org"}) == "result_3"
+
+    def test_results_are_invalidated_if_their_generation_is_lost(
+        self, search_cache, backend
+    ):
+        set_(search_cache, "key", {ALL}, "result")
+
+        del backend._entries["search-generation:all"]
+
+        assert get(search_cache, "key", {ALL}) is None
+
+    def test_results_found_before_an_invalidation_arent_got_after_it(
+        self, search_cache
+    ):
+        entry_key = search_cache.entry_key("key", {ALL})
+
+        search_cache.invalidate({ALL})
+        search_cache.set(entry_key, "stale result")
+
+        assert get(search_cache, "key", {ALL}) is None
+
+    def test_results_arent_cached_until_invalidations_have_settled(
+        self, search_cache, clock
+    ):
+        search_cache.settle = 5
+        search_cache.invalidate({"uri:example.com"})
+
+        clock.return_value = 104
+        assert search_cache.entry_key("key", {"uri:example.com"}) is None
+        clock.return_value = 105
+        assert search_cache.entry_key("key", {"uri:example.com"})
+
+    def test_new_generations_have_to_settle(self, search_cache, clock):
+        search_cache.settle = 5
+
+        assert search_cache.entry_key("key", {ALL}) is None
+        clock.return_value = 105
+        assert search_cache.entry_key("key", {ALL})
+
+    @pytest.mark.parametrize("hit", (True, False))
+    def test_it_records_hits_and_misses(self, search_cache, newrelic_agent, hit):
+        if hit:
+            set_(search_cache, "key", {ALL}, "result")
+
+        get(search_cache, "key", {ALL})
+
+        newrelic_agent.record_custom_metric.assert_called_once_with(
+            "Custom/Search/Cache/Hits" if hit else "Custom/Search/Cache/Misses", 1
+        )
+
+    @pytest.fixture
+    def clock(self):
+        return mock.Mock(return_value=100)
+
+    @pytest.fixture
+    def backend(self, clock):
+        return MemoryBackend(clock=clock)
+
+    @pytest.fixture
+    def search_cache(self, backend, clock):
+        return SearchCache(backend, ttl=30, settle=0, clock=clock)
+
+    @pytest.fixture(autouse=True)
+    def newrelic_agent(self, patch):
+        return patch("h.search.cache.newrelic.agent")
+
+
+def get(search_cache, key, tags):
+    return search_cache.get(search_cache.entry_key(key, tags))
+
+
+def set_(search_cache, key, tags, result):
+    search_cache.set(search_cache.entry_key(key, tags), result)
+
+
+class TestSearchKey:
+    def test_it_ignores_the_order_of_params(self):
+        assert search_key(
+            MultiDict([("uri", "https://example.com"), ("limit", "20")]),
+            False,
+            None,
+            ["__world__"],
+        ) == search_key(
+            MultiDict([("limit", 20), ("uri", "https://example.com")]),
+            False,
+            None,
+            ["__world__"],
+        )
+
+    @pytest.mark.parametrize(
+        "other",
+        (
+            (MultiDict({"limit": "21"}), False, None, ["__world__"]),
+            (MultiDict({"limit": "20"}), True, None, ["__world__"]),
+            (MultiDict({"limit": "20"}), False, "acct:user@example.com", ["__world__"]),
+            (MultiDict({"limit": "20"}), False, None, ["__world__", "abc"]),
+            (MultiDict({"limit": "20"}), False, None, ["__world__"], True),
+        ),
+    )
+    def test_it_varies_with_the_search(self, other):
+        assert search_key(MultiDict({"limit": "20"}), False, None, ["__world__"]) != (
+            search_key(*other)
+        )
+
+
+class TestSearchTags:
+    @pytest.mark.parametrize(
+        "params,tags",
+        (
+            (
+                [("uri", "https://example.com/"), ("url", "example.org")],
+                {"uri:httpx://example.com", "uri:httpx://example.org"},
+            ),
+            (
+                [("uri", "https://example.com"), ("group", "abc")],
+                {"uri:httpx://example.com"},
+            ),
+            ([("group", "abc"), ("user", "acct:user@example.com")], {"group:abc"}),
+            ([("uri", "https://example.com/*")], {ALL}),
+            ([("wildcard_uri", "https://example.com/*")], {ALL}),
+            ([("user", "acct:user@example.com")], {ALL}),
+        ),
+    )
+    def test_it(self, params, tags):
+        assert search_tags(MultiDict(params)) == tags
+
+    def test_annotation_tags_match_the_tags_of_searches_for_it(self, factories):
+        annotation = factories.Annotation.build(groupid="abc")
+
+        assert annotation_tags(annotation, ["httpx://example.com"]) == {
+            ALL,
+            "group:abc",
+            "uri:httpx://example.com",
+        }
+
+
+class TestGetCache:
+    def test_it_returns_None_if_caching_is_disabled(self):
+        assert get_cache({}) is None
+
+    def test_it_returns_a_memory_cache(self):
+        search_cache = get_cache(
+            {
+                "h.search.cache": "memory",
+                "h.search.cache_ttl": "30",
+                "h.search.cache_size": "10",
+            }
+        )
+
+        assert search_cache.ttl == 30
+        assert search_cache.backend.maxsize == 10
+        # Invalidations don't reach other processes
+        assert search_cache.anonymous_only
+
+    def test_it_returns_a_cache_with_a_shared_backend(self, patch):
+        DottedNameResolver = patch("h.search.cache.DottedNameResolver")
+        backend_factory = DottedNameResolver.return_value.resolve.return_value
+        settings = {"h.search.cache": "example.cache:backend"}
+
+        search_cache = get_cache(settings)
+
+        DottedNameResolver.return_value.resolve.assert_called_once_with(
+            "example.cache:backend"
+        )
+        backend_factory.assert_called_once_with(settings)
+        assert search_cache.backend == backend_factory.return_value
+        assert not search_cache.anonymous_only
+
+    def test_it_reads_the_settle_time(self):
+        search_cache = get_cache(
+            {"h.search.cache": "memory", "h.search.cache_settle": "2"}
+        )
+
+        assert search_cache.settle == 2
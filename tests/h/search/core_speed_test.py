@@ -0,0 +1,41 @@
+from datetime import datetime
+
+import pytest
+from webob.multidict import MultiDict
+
+from h import search
+
+
+@pytest.mark.skip("Only of use during development")
+@pytest.mark.usefixtures("group_service", "nipsa_service")
+class TestSearchRepliesSpeed:  # pragma: no cover
+    URI = "http://example.com/page"
+
+    @pytest.mark.parametrize("reps", (16,))
+    @pytest.mark.parametrize("prefetch_replies", (False, True))
+    def test_speed(self, pyramid_request, threads, prefetch_replies, reps):
+        params = MultiDict({"uri": self.URI, "limit": 20})
+
+        start = datetime.utcnow()
+        for _ in range(reps):
+            result = search.Search(
+                pyramid_request,
+                separate_replies=True,
+                prefetch_replies=prefetch_replies,
+            ).run(params.copy())
+        diff = datetime.utcnow() - start
+
+        assert result.annotation_ids
+
+        millis = diff.seconds * 1000 + diff.microseconds / 1000
+        print(
+            f"prefetch_replies={prefetch_replies} x {reps}: {millis} ms, {millis/reps} ms/search"
+        )
+
+    @pytest.fixture
+    def threads(self, Annotation):
+        # Some threads with lots of replies, and lots without any
+        for i in range(100):
+            annotation = Annotation(target_uri=self.URI, shared=True)
+            for _ in range(10 if i % 10 == 0 else 0):
+                Annotation(target_uri=self.URI, references=[annotation.id], shared=True)
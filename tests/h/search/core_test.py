@@ -6,12 +6,17 @@ Tests for filtering/matching/aggregating on specific annotation fields are in
 """
 
 import datetime
+from unittest import mock
 
 import pytest
 from h_matchers import Any
 from webob.multidict import MultiDict
 
 from h import search
+from h.search import core, query
+from h.search.cache import SearchCache
+from h.search.profile import SearchProfile
+from h.util.cache import MemoryBackend
 
 
 @pytest.mark.usefixtures("group_service", "nipsa_service")
@@ -290,14 +295,608 @@ class TestSearchWithSeparateReplies:
 
         # Create three more replies so that the oldest reply will be pushed out
         # of reply_ids. (We only need 3, not 200, because we're going to use
-        # the _replies_limit test seam to limit it to 3 replies instead of 200.
+        # the _replies_max test seam to limit it to 3 replies instead of 200.
         # This is just to make the test faster.)
         for _ in range(3):
             Annotation(references=[annotation.id], shared=True)
 
         result = search.Search(
-            pyramid_request, separate_replies=True, _replies_limit=3
+            pyramid_request, separate_replies=True, _replies_max=3
         ).run(MultiDict({}))
 
         assert len(result.reply_ids) == 3
         assert oldest_reply.id not in result.reply_ids
+        assert not result.reply_cursors
+
+    def test_only_a_few_replies_to_each_annotation_are_included(
+        self, pyramid_request, Annotation
+    ):
+        """
+        No more than 10 replies to each annotation are included in reply_ids.
+
+        Instead, there's a cursor for the rest of the replies to any
+        annotations with more than that.
+        """
+        annotation = Annotation(shared=True)
+        oldest_reply = Annotation(references=[annotation.id], shared=True)
+        other_annotation = Annotation(shared=True)
+        other_reply = Annotation(references=[other_annotation.id], shared=True)
+
+        # Create three more replies so that the oldest reply will be pushed out
+        # of reply_ids. (We only need 3, not 10, because we're going to use
+        # the _replies_limit test seam to limit it to 3 replies instead of 10.
+        # This is just to make the test faster.)
+        for _ in range(3):
+            Annotation(references=[annotation.id], shared=True)
+
+        result = search.Search(
+            pyramid_request, separate_replies=True, reply_cursors=True, _replies_limit=3
+        ).run(MultiDict({}))
+
+        assert len(result.reply_ids) == 4
+        assert oldest_reply.id not in result.reply_ids
+        assert other_reply.id in result.reply_ids
+        assert list(result.reply_cursors) == [annotation.id]
+
+    def test_reply_cursors_continue_with_the_rest_of_the_replies(
+        self, pyramid_request, Annotation
+    ):
+        annotation = Annotation(shared=True)
+        replies = [
+            Annotation(references=[annotation.id], shared=True) for _ in range(5)
+        ]
+        first = search.Search(
+            pyramid_request, separate_replies=True, reply_cursors=True, _replies_limit=3
+        ).run(MultiDict({}))
+
+        rest = search.Search(pyramid_request).run(
+            MultiDict(
+                {
+                    "references": annotation.id,
+                    "cursor": first.reply_cursors[annotation.id],
+                }
+            )
+        )
+
+        assert sorted(first.reply_ids + rest.annotation_ids) == sorted(
+            reply.id for reply in replies
+        )
+
+    def test_prefetching_replies_returns_the_same_results(
+        self, pyramid_request, Annotation
+    ):
+        uri = "http://example.com/page"
+        for _ in range(3):
+            annotation = Annotation(target_uri=uri, shared=True)
+            for _ in range(2):
+                Annotation(target_uri=uri, references=[annotation.id], shared=True)
+        Annotation(target_uri="http://example.com/other", shared=True)
+        params = MultiDict({"uri": uri})
+
+        result = search.Search(
+            pyramid_request, separate_replies=True, reply_cursors=True
+        ).run(params.copy())
+        prefetched = search.Search(
+            pyramid_request,
+            separate_replies=True,
+            reply_cursors=True,
+            prefetch_replies=True,
+        ).run(params.copy())
+
+        assert len(result.reply_ids) == 6
+        assert prefetched == result
+
+    def test_prefetching_replies_leaves_out_replies_on_other_uris(
+        self, pyramid_request, Annotation
+    ):
+        # This is a known difference, which the feature flag opts in to
+        uri = "http://example.com/page"
+        annotation = Annotation(target_uri=uri, shared=True)
+        reply = Annotation(
+            target_uri="http://example.com/other",
+            references=[annotation.id],
+            shared=True,
+        )
+        params = MultiDict({"uri": uri})
+
+        result = search.Search(
+            pyramid_request, separate_replies=True, reply_cursors=True
+        ).run(params.copy())
+        prefetched = search.Search(
+            pyramid_request,
+            separate_replies=True,
+            reply_cursors=True,
+            prefetch_replies=True,
+        ).run(params.copy())
+
+        assert result.reply_ids == [reply.id]
+        assert prefetched.reply_ids == []
+
+    def test_reply_cursors_reach_threads_crowded_out_of_the_replies(
+        self, pyramid_request, Annotation
+    ):
+        annotation = Annotation(shared=True)
+        Annotation(references=[annotation.id], shared=True)
+        # The replies to the annotation after it on the page don't fit
+        other_annotation = Annotation(shared=True)
+        other_reply = Annotation(references=[other_annotation.id], shared=True)
+        first = search.Search(
+            pyramid_request, separate_replies=True, reply_cursors=True, _replies_max=1
+        ).run(MultiDict({"sort": "created", "order": "asc"}))
+
+        rest = search.Search(pyramid_request).run(
+            MultiDict(
+                {
+                    "references": other_annotation.id,
+                    "cursor": first.reply_cursors[other_annotation.id],
+                }
+            )
+        )
+
+        assert other_reply.id not in first.reply_ids
+        assert rest.annotation_ids == [other_reply.id]
+
+
+@pytest.mark.usefixtures("group_service", "metrics")
+class TestSearchRepliesAggregation:
+    def test_it_merges_the_replies_to_each_annotation(
+        self, pyramid_request, _search, _build_search
+    ):
+        _build_search.return_value.execute.return_value = self.response(
+            hits=[{"_id": "id_1"}, {"_id": "id_2"}]
+        )
+        _search.side_effect = [
+            self.response(
+                replies={
+                    "id_1": (1, [{"_id": "reply_1", "sort": [3, "reply_1"]}]),
+                    "id_2": (
+                        3,
+                        [
+                            {"_id": "reply_3", "sort": [4, "reply_3"]},
+                            {"_id": "reply_2", "sort": [2, "reply_2"]},
+                        ],
+                    ),
+                }
+            ),
+        ]
+
+        result = search.Search(
+            pyramid_request, separate_replies=True, reply_cursors=True
+        ).run(MultiDict({}))
+
+        assert result.reply_ids == ["reply_3", "reply_1", "reply_2"]
+        assert result.reply_cursors == {
+            "id_2": query.encode_cursor("updated", "desc", [2, "reply_2"])
+        }
+
+    def test_it_gets_a_few_replies_to_each_annotation(
+        self, pyramid_request, _search, _build_search
+    ):
+        _build_search.return_value.execute.return_value = self.response(
+            hits=[{"_id": "id_1"}]
+        )
+        _search.return_value = self.response(replies={})
+
+        search.Search(pyramid_request, separate_replies=True, reply_cursors=True).run(
+            MultiDict({})
+        )
+
+        aggregation = _search.call_args[0][2][0]
+        assert aggregation.limit == core.REPLIES_PER_THREAD
+
+    def test_it_shares_out_the_replies_when_there_are_too_many(
+        self, pyramid_request, _search, _build_search
+    ):
+        _build_search.return_value.execute.return_value = self.response(
+            hits=[{"_id": "id_1"}, {"_id": "id_2"}]
+        )
+        _search.return_value = self.response(
+            replies={
+                # The thread with more replies comes first
+                thread: (
+                    3,
+                    [
+                        {"_id": f"{thread}_reply_{i}", "sort": [i, f"reply_{i}"]}
+                        for i in (3, 2, 1)
+                    ],
+                )
+                for thread in ("id_2", "id_1")
+            }
+        )
+
+        result = search.Search(
+            pyramid_request, separate_replies=True, reply_cursors=True, _replies_max=3
+        ).run(MultiDict({}))
+
+        # Each thread's newest replies, in page order
+        assert sorted(result.reply_ids) == [
+            "id_1_reply_2",
+            "id_1_reply_3",
+            "id_2_reply_3",
+        ]
+        assert result.reply_cursors == {
+            "id_1": query.encode_cursor("updated", "desc", [2, "reply_2"]),
+            "id_2": query.encode_cursor("updated", "desc", [3, "reply_3"]),
+        }
+
+    def test_it_gives_threads_crowded_out_of_the_replies_a_cursor(
+        self, pyramid_request, _search, _build_search
+    ):
+        _build_search.return_value.execute.return_value = self.response(
+            hits=[{"_id": "id_1"}, {"_id": "id_2"}]
+        )
+        _search.return_value = self.response(
+            replies={
+                thread: (1, [{"_id": f"{thread}_reply", "sort": [3, "reply"]}])
+                for thread in ("id_1", "id_2")
+            }
+        )
+
+        result = search.Search(
+            pyramid_request, separate_replies=True, reply_cursors=True, _replies_max=1
+        ).run(MultiDict({}))
+
+        assert result.reply_ids == ["id_1_reply"]
+        # Starting before the thread's newest reply
+        assert result.reply_cursors == {
+            "id_2": query.encode_cursor("updated", "desc", [4, ""])
+        }
+
+    def test_it_doesnt_search_for_replies_to_no_annotations(
+        self, pyramid_request, _search, _build_search
+    ):
+        _build_search.return_value.execute.return_value = self.response()
+
+        result = search.Search(
+            pyramid_request, separate_replies=True, reply_cursors=True
+        ).run(MultiDict({}))
+
+        assert result.reply_ids == []
+        assert result.reply_cursors == {}
+        _search.assert_not_called()
+
+    def test_it_prefetches_the_replies(
+        self, pyramid_request, _search, _build_search, MultiSearch
+    ):
+        replies_search, annotations_search = _build_search.side_effect = [
+            mock.sentinel.replies_search,
+            mock.sentinel.annotations_search,
+        ]
+        MultiSearch.return_value.add.return_value = MultiSearch.return_value
+        MultiSearch.return_value.execute.return_value = [
+            self.response(hits=[{"_id": "id_1"}, {"_id": "id_2"}]),
+            self.response(
+                replies={
+                    "id_1": (1, [{"_id": "reply_1", "sort": [3, "reply_1"]}]),
+                    "id_3": (1, [{"_id": "reply_3", "sort": [4, "reply_3"]}]),
+                }
+            ),
+        ]
+
+        result = search.Search(
+            pyramid_request,
+            separate_replies=True,
+            reply_cursors=True,
+            prefetch_replies=True,
+        ).run(MultiDict({"uri": "https://example.com", "user": "bob"}))
+
+        MultiSearch.return_value.add.assert_has_calls(
+            [mock.call(annotations_search), mock.call(replies_search)]
+        )
+        # The replies are searched for on the same URIs as the annotations,
+        # with any other params left out
+        assert _build_search.call_args_list[0][0][3] == MultiDict(
+            {"uri": "https://example.com", "limit": 0}
+        )
+        assert result.reply_ids == ["reply_1"]
+        _search.assert_not_called()
+
+    def test_it_searches_for_replies_the_prefetch_missed(
+        self, pyramid_request, _search, _build_search, MultiSearch
+    ):
+        MultiSearch.return_value.add.return_value = MultiSearch.return_value
+        MultiSearch.return_value.execute.return_value = [
+            self.response(hits=[{"_id": "id_1"}, {"_id": "id_2"}]),
+            self.response(
+                replies={"id_1": (1, [{"_id": "reply_1", "sort": [3, "reply_1"]}])},
+                complete=False,
+            ),
+        ]
+        _search.return_value = self.response(
+            replies={"id_2": (1, [{"_id": "reply_2", "sort": [4, "reply_2"]}])}
+        )
+
+        result = search.Search(
+            pyramid_request,
+            separate_replies=True,
+            reply_cursors=True,
+            prefetch_replies=True,
+        ).run(MultiDict({"uri": "https://example.com"}))
+
+        modifiers = _search.call_args[0][1]
+        assert modifiers[0].annotation_ids == ["id_2"]
+        assert result.reply_ids == ["reply_2", "reply_1"]
+
+    def test_it_assumes_annotations_the_complete_prefetch_missed_have_no_replies(
+        self, pyramid_request, _search, MultiSearch
+    ):
+        MultiSearch.return_value.add.return_value = MultiSearch.return_value
+        MultiSearch.return_value.execute.return_value = [
+            self.response(hits=[{"_id": "id_1"}, {"_id": "id_2"}]),
+            self.response(
+                replies={"id_1": (1, [{"_id": "reply_1", "sort": [3, "reply_1"]}])}
+            ),
+        ]
+
+        result = search.Search(
+            pyramid_request,
+            separate_replies=True,
+            reply_cursors=True,
+            prefetch_replies=True,
+        ).run(MultiDict({"uri": "https://example.com"}))
+
+        # So any replies to `id_2` on other URIs are left out
+        assert result.reply_ids == ["reply_1"]
+        _search.assert_not_called()
+
+    def test_it_searches_for_all_the_replies_without_reply_cursors(
+        self, pyramid_request, _search, _build_search
+    ):
+        _build_search.return_value.execute.return_value = self.response(
+            hits=[{"_id": "id_1"}]
+        )
+        _search.return_value = self.response(
+            hits=[{"_id": "reply_2"}, {"_id": "reply_1"}]
+        )
+
+        result = search.Search(pyramid_request, separate_replies=True).run(
+            MultiDict({})
+        )
+
+        _, modifiers, aggregations, params = _search.call_args[0]
+        assert modifiers[0].annotation_ids == ["id_1"]
+        assert not aggregations
+        assert params == MultiDict({"limit": core.REPLIES_MAX})
+        assert result.reply_ids == ["reply_2", "reply_1"]
+        assert result.reply_cursors == {}
+
+    def test_it_doesnt_prefetch_replies_without_reply_cursors(
+        self, pyramid_request, _search, _build_search, MultiSearch
+    ):
+        _build_search.return_value.execute.return_value = self.response(
+            hits=[{"_id": "id_1"}]
+        )
+        _search.return_value = self.response()
+
+        search.Search(
+            pyramid_request, separate_replies=True, prefetch_replies=True
+        ).run(MultiDict({"uri": "https://example.com"}))
+
+        MultiSearch.assert_not_called()
+        _search.assert_called_once()
+
+    def test_it_doesnt_prefetch_replies_without_a_uri(
+        self, pyramid_request, _search, _build_search, MultiSearch
+    ):
+        _build_search.return_value.execute.return_value = self.response(
+            hits=[{"_id": "id_1"}]
+        )
+        _search.return_value = self.response(replies={})
+
+        search.Search(
+            pyramid_request,
+            separate_replies=True,
+            reply_cursors=True,
+            prefetch_replies=True,
+        ).run(MultiDict({"group": "abc"}))
+
+        MultiSearch.assert_not_called()
+        _search.assert_called_once()
+
+    @staticmethod
+    def response(hits=(), replies=None, complete=True):
+        buckets = [
+            {"key": key, "doc_count": total, "latest": {"hits": {"hits": hits}}}
+            for key, (total, hits) in (replies or {}).items()
+        ]
+        return mock.Mock(
+            spec_set=["__getitem__", "aggregations"],
+            aggregations={
+                "replies": {
+                    "buckets": buckets,
+                    "sum_other_doc_count": 0 if complete else 1,
+                }
+            }
+            if replies is not None
+            else None,
+            __getitem__=lambda _, key: {"total": len(hits), "hits": list(hits)},
+        )
+
+    @pytest.fixture
+    def MultiSearch(self, patch):
+        return patch("h.search.core.elasticsearch_dsl.MultiSearch")
+
+    @pytest.fixture
+    def _search(self, patch):
+        return patch("h.search.core.Search._search")
+
+    @pytest.fixture
+    def _build_search(self, patch):
+        return patch("h.search.core.Search._build_search")
+
+    @pytest.fixture(autouse=True)
+    def cursor_for(self, patch):
+        return patch("h.search.core.query.cursor_for")
+
+
+@pytest.mark.usefixtures("group_service", "metrics")
+class TestSearchCaching:
+    def test_it_caches_results(self, pyramid_request, _run):
+        first = search.Search(pyramid_request, cache=True).run(self.params())
+        second = search.Search(pyramid_request, cache=True).run(self.params())
+
+        assert first == second == _run.return_value
+        _run.assert_called_once_with(Any(), self.params())
+
+    def test_results_are_invalidated_by_their_tags(
+        self, pyramid_request, search_cache, _run
+    ):
+        search.Search(pyramid_request, cache=True).run(self.params())
+
+        search_cache.invalidate({"uri:httpx://example.com"})
+        search.Search(pyramid_request, cache=True).run(self.params())
+
+        assert _run.call_count == 2
+
+    def test_results_found_while_invalidating_arent_served_after(
+        self, pyramid_request, search_cache, _run
+    ):
+        # The annotations change while the first search is running
+        _run.side_effect = lambda *_args: (
+            search_cache.invalidate({"uri:httpx://example.com"}) or mock.DEFAULT
+        )
+        search.Search(pyramid_request, cache=True).run(self.params())
+        _run.side_effect = None
+
+        search.Search(pyramid_request, cache=True).run(self.params())
+
+        assert _run.call_count == 2
+
+    def test_results_are_cached_for_each_set_of_readable_groups(
+        self, pyramid_request, group_service, _run
+    ):
+        search.Search(pyramid_request, cache=True).run(self.params())
+
+        group_service.groupids_readable_by.return_value = ["__world__", "abc"]
+        search.Search(pyramid_request, cache=True).run(self.params())
+
+        assert _run.call_count == 2
+
+    def test_it_doesnt_cache_unsettled_searches(
+        self, pyramid_request, search_cache, _run
+    ):
+        search_cache.settle = 60
+
+        search.Search(pyramid_request, cache=True).run(self.params())
+        search.Search(pyramid_request, cache=True).run(self.params())
+
+        assert _run.call_count == 2
+
+    def test_it_only_caches_logged_out_users_searches_if_asked_to(
+        self, pyramid_request, pyramid_config, search_cache, _run
+    ):
+        search_cache.anonymous_only = True
+        pyramid_config.testing_securitypolicy("acct:user@example.com")
+
+        search.Search(pyramid_request, cache=True).run(self.params())
+        search.Search(pyramid_request, cache=True).run(self.params())
+
+        assert _run.call_count == 2
+
+    def test_it_only_caches_when_asked_to(self, pyramid_request, _run):
+        search.Search(pyramid_request).run(self.params())
+        search.Search(pyramid_request).run(self.params())
+
+        assert _run.call_count == 2
+
+    @pytest.mark.parametrize(
+        "customise",
+        (
+            lambda search_: search_.append_modifier(query.DeletedFilter()),
+            lambda search_: search_.append_aggregation(query.TagsAggregation()),
+            lambda search_: search_.clear(),
+        ),
+    )
+    def test_it_doesnt_cache_customised_searches(
+        self, pyramid_request, _run, customise
+    ):
+        for _ in range(2):
+            search_ = search.Search(pyramid_request, cache=True)
+            customise(search_)
+            search_.run(self.params())
+
+        assert _run.call_count == 2
+
+    def test_it_doesnt_cache_profiled_searches(self, pyramid_request, _run):
+        for _ in range(2):
+            search.Search(pyramid_request, cache=True, profile=mock.Mock()).run(
+                self.params()
+            )
+
+        assert _run.call_count == 2
+
+    def test_it_doesnt_cache_when_the_cache_is_disabled(self, pyramid_request, _run):
+        pyramid_request.registry["search.cache"] = None
+
+        search.Search(pyramid_request, cache=True).run(self.params())
+        search.Search(pyramid_request, cache=True).run(self.params())
+
+        assert _run.call_count == 2
+
+    @staticmethod
+    def params():
+        return MultiDict({"uri": "https://example.com", "limit": 10})
+
+    @pytest.fixture(autouse=True)
+    def search_cache(self, pyramid_config):
+        search_cache = SearchCache(MemoryBackend(), settle=0)
+        pyramid_config.registry["search.cache"] = search_cache
+        return search_cache
+
+    @pytest.fixture
+    def _run(self, patch):
+        _run = patch("h.search.core.Search._run")
+        _run.return_value = search.core.SearchResult(1, ["id"], [], {})
+        return _run
+
+
+@pytest.mark.usefixtures("group_service")
+class TestSearchProfiling:
+    def test_it_records_a_step_for_each_modifier_and_aggregation(
+        self, pyramid_request, profile
+    ):
+        search_ = search.Search(pyramid_request, profile=profile)
+        search_.clear()
+        search_.append_modifier(query.DeletedFilter())
+        search_.append_aggregation(query.TagsAggregation())
+
+        search_._build_search(  # pylint:disable=protected-access
+            search_._modifiers,  # pylint:disable=protected-access
+            search_._aggregations,  # pylint:disable=protected-access
+            MultiDict({}),
+        )
+
+        assert profile.step.call_args_list == [
+            mock.call("build/TagsAggregation"),
+            mock.call("build/DeletedFilter"),
+            mock.call("build/Sorter"),
+        ]
+
+    def test_it_turns_on_elasticsearch_profiling(self, pyramid_request, profile):
+        search_ = search.Search(pyramid_request, profile=profile)
+
+        es_search = search_._build_search(  # pylint:disable=protected-access
+            [], [], MultiDict({})
+        )
+
+        assert es_search.to_dict()["profile"] is True
+
+    def test_it_records_each_search(self, pyramid_request, profile):
+        es_search = mock.Mock()
+
+        response = search.Search(  # pylint:disable=protected-access
+            pyramid_request, profile=profile
+        )._execute("annotations", es_search)
+
+        profile.step.assert_called_once_with("execute/annotations")
+        profile.add_response.assert_called_once_with("annotations", response)
+        assert response == es_search.execute.return_value
+
+    @pytest.fixture
+    def profile(self):
+        return mock.create_autospec(SearchProfile, instance=True, spec_set=True)
+
+
+@pytest.fixture
+def metrics(patch):
+    return patch("h.search.core.metrics")
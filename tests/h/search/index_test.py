@@ -4,7 +4,9 @@ from unittest.mock import sentinel
 
 import elasticsearch
 import pytest
+import sqlalchemy as sa
 
+from h.search import index
 from h.search.index import BatchIndexer
 
 
@@ -140,6 +142,23 @@ class TestBatchIndexer:
         assert errored == expected_errored_ids
 
 
+class TestEagerLoadedAnnotations:
+    def test_it_loads_the_groups(self, db_session, factories):
+        factories.Annotation.create_batch(2)
+        db_session.flush()
+        db_session.expunge_all()
+
+        annotations = list(
+            index._eager_loaded_annotations(  # pylint:disable=protected-access
+                db_session
+            )
+        )
+
+        assert annotations
+        for annotation in annotations:
+            assert "group" not in sa.inspect(annotation).unloaded
+
+
 @pytest.fixture
 def batch_indexer(  # pylint:disable=unused-argument
     db_session, es_client, pyramid_request, moderation_service
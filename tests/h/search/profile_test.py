@@ -0,0 +1,63 @@
+from unittest import mock
+
+import pytest
+import sqlalchemy as sa
+
+from h.search.profile import SearchProfile
+
+
+class TestSearchProfile:
+    def test_step_times_the_block(self, profile, clock):
+        with profile.step("build"):
+            clock.return_value = 100.25
+
+        assert profile.steps == [{"name": "build", "time_ms": 250, "sql_statements": 0}]
+
+    def test_step_counts_the_sql_statements_run_in_the_block(self, profile, db_session):
+        db_session.execute(sa.text("SELECT 1"))
+
+        with profile.step("build"):
+            db_session.execute(sa.text("SELECT 1"))
+            db_session.execute(sa.text("SELECT 2"))
+        db_session.execute(sa.text("SELECT 3"))
+
+        assert profile.steps[0]["sql_statements"] == 2
+
+    def test_step_is_recorded_if_the_block_raises(self, profile):
+        with pytest.raises(ValueError):
+            with profile.step("build"):
+                raise ValueError()
+
+        assert [step["name"] for step in profile.steps] == ["build"]
+
+    def test_add_response(self, profile):
+        response = mock.Mock()
+        response.to_dict.return_value = {"took": 12, "profile": {"shards": []}}
+
+        profile.add_response("annotations", response)
+
+        assert profile.searches == [
+            {"name": "annotations", "took_ms": 12, "profile": {"shards": []}}
+        ]
+
+    def test_asdict(self, profile, clock):
+        with profile.step("build"):
+            clock.return_value = 100.5
+        profile.steps[0]["sql_statements"] = 3
+        profile.searches.append(mock.sentinel.search)
+        clock.return_value = 101
+
+        assert profile.asdict() == {
+            "total_ms": 1000,
+            "sql_statements": 3,
+            "steps": profile.steps,
+            "elasticsearch": [mock.sentinel.search],
+        }
+
+    @pytest.fixture
+    def clock(self):
+        return mock.Mock(return_value=100)
+
+    @pytest.fixture
+    def profile(self, db_session, clock):
+        return SearchProfile(db_session, clock=clock)
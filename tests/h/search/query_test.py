@@ -5,6 +5,7 @@ import elasticsearch_dsl
 import pytest
 import webob
 
+from h.schemas import ValidationError
 from h.search import Search, query
 
 MISSING = object()
@@ -192,6 +193,64 @@ class TestSorter:
     def test_it_ignores_unknown_sort_fields(self, search):
         search.run(webob.multidict.MultiDict({"sort": "no_such_field"}))
 
+    def test_it_breaks_ties_by_id(self, es_dsl_search):
+        q = query.Sorter()(es_dsl_search, {"sort": "user", "order": "asc"}).to_dict()
+
+        assert q["sort"] == [
+            {"user_raw": {"order": "asc", "unmapped_type": "boolean"}},
+            {"id": {"order": "asc"}},
+        ]
+
+    @pytest.mark.parametrize(
+        "params", ({"sort": "id"}, {"sort": "updated", "search_after": "2018"})
+    )
+    def test_it_doesnt_break_ties_when_it_cant(self, es_dsl_search, params):
+        q = query.Sorter()(es_dsl_search, params).to_dict()
+
+        assert len(q["sort"]) == 1
+
+    def test_it_carries_on_from_a_cursor(self, es_dsl_search):
+        params = {
+            "sort": "updated",
+            "search_after": "2018",
+            "cursor": query.encode_cursor("created", "asc", [1514764800000, "abc"]),
+        }
+
+        q = query.Sorter()(es_dsl_search, params).to_dict()
+
+        assert q["search_after"] == [1514764800000, "abc"]
+        assert q["sort"] == [
+            {"created": {"order": "asc", "unmapped_type": "boolean"}},
+            {"id": {"order": "asc"}},
+        ]
+
+    def test_it_rejects_invalid_cursors(self, es_dsl_search):
+        with pytest.raises(ValidationError, match="cursor is not a valid cursor"):
+            query.Sorter()(es_dsl_search, {"cursor": "invalid"})
+
+    def test_it_pages_through_annotations_with_cursors(self, Annotation, search):
+        dt = datetime.datetime
+        # Annotations which share a sort value are still paged through in turn
+        ann_ids = [
+            Annotation(updated=dt(2017, 1, 1)).id,
+            Annotation(updated=dt(2018, 1, 1)).id,
+            Annotation(updated=dt(2018, 1, 1)).id,
+            Annotation(updated=dt(2019, 1, 1)).id,
+        ]
+
+        result_ids = []
+        params = {"limit": 1}
+        while True:
+            result = search.run(webob.multidict.MultiDict(params))
+            if not result.annotation_ids:
+                break
+            result_ids.extend(result.annotation_ids)
+            params = {"limit": 1, "cursor": result.cursor}
+
+        assert result_ids == [ann_ids[3]] + sorted(ann_ids[1:3], reverse=True) + [
+            ann_ids[0]
+        ]
+
     @pytest.mark.parametrize(
         "date,expected",
         [
@@ -259,6 +318,65 @@ class TestSorter:
         assert result.annotation_ids == ann_ids
 
 
+class TestCursors:
+    @pytest.mark.parametrize(
+        "sort_by,order,after",
+        (
+            ("updated", "desc", [1514764800000, "abc"]),
+            ("user", "asc", ["acct:user@example.com", "abc"]),
+            ("id", "asc", ["abc"]),
+        ),
+    )
+    def test_it_decodes_encoded_cursors(self, sort_by, order, after):
+        cursor = query.encode_cursor(sort_by, order, after)
+
+        assert query.decode_cursor(cursor) == (sort_by, order, after)
+
+    @pytest.mark.parametrize(
+        "cursor",
+        (
+            "!!!",
+            "bm90IGpzb24",
+            query.encode_cursor("updated", "desc", [1514764800000]),
+            query.encode_cursor("no_such_field", "desc", [1, "abc"]),
+            query.encode_cursor("updated", "sideways", [1, "abc"]),
+            query.encode_cursor("updated", "desc", [{"script": "..."}, "abc"]),
+            query.encode_cursor("updated", "desc", "abc"),
+        ),
+    )
+    def test_it_raises_for_invalid_cursors(self, cursor):
+        with pytest.raises(ValueError):
+            query.decode_cursor(cursor)
+
+    def test_cursor_for(self, es_dsl_search):
+        search = query.Sorter()(es_dsl_search, {"sort": "user", "order": "asc"})
+
+        cursor = query.cursor_for(search, {"sort": ["acct:user@example.com", "abc"]})
+
+        assert query.decode_cursor(cursor) == (
+            "user",
+            "asc",
+            ["acct:user@example.com", "abc"],
+        )
+
+    @pytest.mark.parametrize(
+        "params",
+        (
+            {"sort": "updated", "search_after": "2018"},
+            {"sort": "no_such_field"},
+        ),
+    )
+    def test_cursor_for_returns_None_if_it_cant_carry_on(self, es_dsl_search, params):
+        search = query.Sorter()(es_dsl_search, params)
+
+        assert query.cursor_for(search, {"sort": [1, "abc"]}) is None
+
+    def test_cursor_for_returns_None_for_missing_values(self, es_dsl_search):
+        search = query.Sorter()(es_dsl_search, {"sort": "group"})
+
+        assert query.cursor_for(search, {"sort": [None, "abc"]}) is None
+
+
 class TestTopLevelAnnotationsFilter:
     def test_it_filters_out_replies_but_leaves_annotations_in(self, Annotation, search):
         annotation = Annotation()
@@ -274,6 +392,21 @@ class TestTopLevelAnnotationsFilter:
         return search
 
 
+class TestReplyFilter:
+    def test_it_filters_out_annotations_but_leaves_replies_in(self, Annotation, search):
+        annotation = Annotation()
+        reply = Annotation(references=[annotation.id])
+
+        result = search.run(webob.multidict.MultiDict({}))
+
+        assert [reply.id] == result.annotation_ids
+
+    @pytest.fixture
+    def search(self, search):
+        search.append_modifier(query.ReplyFilter())
+        return search
+
+
 class TestAuthorityFilter:
     def test_it_filters_out_non_matching_authorities(self, Annotation, search):
         annotations_auth1 = [
@@ -375,6 +508,52 @@ class TestGroupFilter:
 
         assert sorted(result.annotation_ids) == sorted(expected_ids)
 
+    def test_it_matches_world_readable_groups_by_their_flag(
+        self, pyramid_request, group_service, es_dsl_search, world_readable_flag
+    ):
+        group_service.member_groupids_readable_by.return_value = ["private_group"]
+
+        search = query.GroupFilter(pyramid_request)(es_dsl_search, {})
+
+        group_service.member_groupids_readable_by.assert_called_once_with(
+            pyramid_request.user
+        )
+        group_service.groupids_readable_by.assert_not_called()
+        assert search.to_dict()["query"]["bool"]["filter"] == [
+            {
+                "bool": {
+                    "should": [
+                        {"term": {"group_world_readable": True}},
+                        {"terms": {"group": ["private_group"]}},
+                    ]
+                }
+            }
+        ]
+
+    def test_it_finds_annotations_in_world_readable_groups_by_their_flag(
+        self, pyramid_request, search, Annotation, factories, world_readable_flag
+    ):
+        group = factories.OpenGroup()
+        expected_ids = [Annotation(groupid=group.pubid, group=group).id]
+        Annotation(groupid="private_group")
+
+        result = search.run(webob.multidict.MultiDict({}))
+
+        assert result.annotation_ids == expected_ids
+
+    def test_it_checks_the_group_param_without_the_flag(
+        self, pyramid_request, group_service, es_dsl_search, world_readable_flag
+    ):
+        query.GroupFilter(pyramid_request)(es_dsl_search, {"group": "abc"})
+
+        group_service.groupids_readable_by.assert_called_once_with(
+            pyramid_request.user, ["abc"]
+        )
+
+    @pytest.fixture
+    def world_readable_flag(self, pyramid_request):
+        pyramid_request.registry.settings["h.search.world_readable_flag"] = "true"
+
     @pytest.fixture
     def search(self, pyramid_request, search):
         search.append_modifier(query.GroupFilter(pyramid_request))
@@ -923,6 +1102,72 @@ class TestRepliesMatcher:
         assert sorted(result.annotation_ids) == sorted(expected_reply_ids)
 
 
+class TestRepliesAggregation:
+    def test_it_aggregates_the_latest_replies_to_each_annotation(self, es_dsl_search):
+        aggregation = query.RepliesAggregation(["id_1", "id_2"], limit=3)
+
+        aggregation(es_dsl_search, {})
+
+        assert es_dsl_search.to_dict()["aggs"] == {
+            "replies": {
+                "terms": {
+                    "field": "references",
+                    "include": ["id_1", "id_2"],
+                    "size": 2,
+                },
+                "aggs": {
+                    "latest": {
+                        "top_hits": {
+                            "size": 3,
+                            "sort": [
+                                {"updated": {"order": "desc"}},
+                                {"id": {"order": "desc"}},
+                            ],
+                            "_source": False,
+                        }
+                    }
+                },
+            }
+        }
+
+    def test_parse_result(self):
+        hit = {"_id": "reply_1", "sort": [1, "reply_1"]}
+        result = {
+            "replies": {
+                "buckets": [
+                    {"key": "id_1", "doc_count": 5, "latest": {"hits": {"hits": [hit]}}}
+                ]
+            }
+        }
+
+        parsed = query.RepliesAggregation(["id_1"], limit=1).parse_result(result)
+
+        assert parsed == {"id_1": (5, [hit])}
+
+    def test_without_ids_it_aggregates_the_replies_to_any_annotation(
+        self, es_dsl_search
+    ):
+        aggregation = query.RepliesAggregation(None, limit=3, size=10)
+
+        aggregation(es_dsl_search, {})
+
+        assert es_dsl_search.to_dict()["aggs"]["replies"]["terms"] == {
+            "field": "references",
+            "size": 10,
+        }
+
+    @pytest.mark.parametrize("sum_other_doc_count,complete", ((0, True), (3, False)))
+    def test_is_complete(self, sum_other_doc_count, complete):
+        result = {
+            "replies": {"buckets": [], "sum_other_doc_count": sum_other_doc_count}
+        }
+
+        assert (
+            query.RepliesAggregation(None, limit=1, size=1).is_complete(result)
+            == complete
+        )
+
+
 class TestTagsAggregation:
     def test_it_returns_annotation_counts_by_tag(self, Annotation, search):
         for _ in range(2):
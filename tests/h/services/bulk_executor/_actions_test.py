@@ -1,6 +1,6 @@
 from copy import deepcopy
 from operator import attrgetter
-from unittest.mock import Mock, patch, sentinel
+from unittest.mock import Mock, create_autospec, patch, sentinel
 
 import pytest
 from h_api.bulk_api import Report
@@ -20,6 +20,7 @@ from h.services.bulk_executor._actions import (
     GroupUpsertAction,
     UserUpsertAction,
 )
+from h.services.group import ReadableGroupsCache
 from tests.h.services.bulk_executor.conftest import (
     AUTHORITY,
     group_membership_create,
@@ -276,6 +277,19 @@ class TestBulkGroupMembershipCreate:
 
         assert final_ids == list(reversed(initial_ids))
 
+    def test_it_invalidates_the_new_members_readable_groups(
+        self, db_session, commands, user
+    ):
+        readable_cache = create_autospec(
+            ReadableGroupsCache, instance=True, spec_set=True
+        )
+
+        GroupMembershipCreateAction(db_session, readable_cache=readable_cache).execute(
+            commands
+        )
+
+        readable_cache.invalidate.assert_called_once_with(user_ids=[user.id])
+
     def test_it_raises_conflict_with_bad_user_foreign_key(self, db_session, groups):
         with pytest.raises(ConflictingDataError):
             GroupMembershipCreateAction(db_session).execute(
@@ -1,3 +1,5 @@
+from unittest.mock import sentinel
+
 import pytest
 from h_api.bulk_api.model.config_body import Configuration
 from h_api.enums import CommandType, DataType
@@ -14,23 +16,26 @@ from tests.h.services.bulk_executor.conftest import (
 
 class TestDBExecutor:
     @pytest.mark.parametrize(
-        "command_type,data_type,handler",
+        "command_type,data_type,handler,handler_kwargs",
         (
-            (CommandType.UPSERT, DataType.USER, "UserUpsertAction"),
-            (CommandType.UPSERT, DataType.GROUP, "GroupUpsertAction"),
+            (CommandType.UPSERT, DataType.USER, "UserUpsertAction", {}),
+            (CommandType.UPSERT, DataType.GROUP, "GroupUpsertAction", {}),
             (
                 CommandType.CREATE,
                 DataType.GROUP_MEMBERSHIP,
                 "GroupMembershipCreateAction",
+                {"readable_cache": sentinel.readable_cache},
             ),
         ),
         indirect=["handler"],
     )
-    def test_it_calls_correct_db_handler(
-        self, db_session, command_type, data_type, handler, commands
+    def test_it_calls_correct_db_handler(  # pylint:disable=too-many-arguments
+        self, db_session, command_type, data_type, handler, handler_kwargs, commands
     ):
-        executor = BulkExecutor(db_session, authority=AUTHORITY)
-        handler.assert_called_once_with(db_session)
+        executor = BulkExecutor(
+            db_session, authority=AUTHORITY, readable_cache=sentinel.readable_cache
+        )
+        handler.assert_called_once_with(db_session, **handler_kwargs)
 
         executor.effective_user_id = 1
 
@@ -41,6 +41,18 @@ class TestDeleteGroupService:
         ]
         assert sorted(deleted_anns) == sorted(annotations)
 
+    def test_it_invalidates_the_members_readable_groups(
+        self, svc, factories, readable_groups_cache
+    ):
+        group = factories.OpenGroup()
+        group.members.append(factories.User())
+
+        svc.delete(group)
+
+        readable_groups_cache.return_value.invalidate.assert_called_once_with(
+            user_ids=[member.id for member in group.members], world=True
+        )
+
 
 @pytest.mark.usefixtures("annotation_delete_service")
 class TestDeleteGroupServiceFactory:
@@ -56,6 +68,11 @@ def svc(db_session, pyramid_request):
     return delete_group_service_factory({}, pyramid_request)
 
 
+@pytest.fixture
+def readable_groups_cache(patch):
+    return patch("h.services.delete_group.readable_groups_cache")
+
+
 @pytest.fixture
 def annotation_delete_service(pyramid_config):
     service = mock.create_autospec(
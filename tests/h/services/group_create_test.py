@@ -5,6 +5,7 @@ from h_matchers import Any
 
 from h.models import Group, GroupScope, User
 from h.models.group import JoinableBy, ReadableBy, WriteableBy
+from h.services.group import ReadableGroupsCache
 from h.services.group_create import GroupCreateService, group_create_factory
 from tests.common.matchers import Matcher
 
@@ -112,6 +113,15 @@ class TestCreatePrivateGroup:
 
         publish.assert_called_once_with("group-join", group.pubid, creator.userid)
 
+    def test_it_invalidates_the_creators_readable_groups(
+        self, svc, creator, readable_cache
+    ):
+        svc.create_private_group("Dishwasher disassemblers", creator.userid)
+
+        readable_cache.invalidate.assert_called_once_with(
+            user_ids=[creator.id], world=False
+        )
+
 
 class TestCreateOpenGroup:
     def test_it_returns_group_model(self, creator, svc, origins):
@@ -119,6 +129,13 @@ class TestCreateOpenGroup:
 
         assert isinstance(group, Group)
 
+    def test_it_invalidates_the_world_readable_groups(
+        self, creator, svc, origins, readable_cache
+    ):
+        svc.create_open_group("Anteater fans", creator.userid, scopes=origins)
+
+        readable_cache.invalidate.assert_called_once_with(user_ids=[], world=True)
+
     @pytest.mark.parametrize(
         "group_attr,expected_value",
         [("name", "test group"), ("description", "test description")],
@@ -464,8 +481,15 @@ def publish():
 
 
 @pytest.fixture
-def svc(db_session, usr_svc, publish):
-    return GroupCreateService(db_session, usr_svc, publish=publish)
+def readable_cache():
+    return mock.create_autospec(ReadableGroupsCache, instance=True, spec_set=True)
+
+
+@pytest.fixture
+def svc(db_session, usr_svc, publish, readable_cache):
+    return GroupCreateService(
+        db_session, usr_svc, publish=publish, readable_cache=readable_cache
+    )
 
 
 @pytest.fixture
@@ -3,6 +3,7 @@ from unittest import mock
 import pytest
 
 from h.models import GroupScope, User
+from h.services.group import ReadableGroupsCache
 from h.services.group_members import GroupMembersService, group_members_factory
 from tests.common.matchers import Matcher
 
@@ -31,6 +32,16 @@ class TestMemberJoin:
 
         publish.assert_called_once_with("group-join", group.pubid, user.userid)
 
+    def test_it_invalidates_the_users_readable_groups(
+        self, group_members_service, factories, readable_cache
+    ):
+        group = factories.Group()
+        user = factories.User()
+
+        group_members_service.member_join(group, user.userid)
+
+        readable_cache.invalidate.assert_called_once_with(user_ids=[user.id])
+
 
 class TestMemberLeave:
     def test_it_removes_user_from_group(
@@ -63,6 +74,17 @@ class TestMemberLeave:
 
         publish.assert_called_once_with("group-leave", group.pubid, new_member.userid)
 
+    def test_it_invalidates_the_users_readable_groups(
+        self, group_members_service, factories, readable_cache
+    ):
+        group = factories.Group()
+        new_member = factories.User()
+        group.members.append(new_member)
+
+        group_members_service.member_leave(group, new_member.userid)
+
+        readable_cache.invalidate.assert_called_once_with(user_ids=[new_member.id])
+
 
 class TestAddMembers:
     def test_it_adds_users_in_userids(self, factories, group_members_service):
@@ -218,8 +240,20 @@ def publish():
 
 
 @pytest.fixture
-def group_members_service(db_session, usr_group_members_service, publish):
-    return GroupMembersService(db_session, usr_group_members_service, publish=publish)
+def readable_cache():
+    return mock.create_autospec(ReadableGroupsCache, instance=True, spec_set=True)
+
+
+@pytest.fixture
+def group_members_service(
+    db_session, usr_group_members_service, publish, readable_cache
+):
+    return GroupMembersService(
+        db_session,
+        usr_group_members_service,
+        publish=publish,
+        readable_cache=readable_cache,
+    )
 
 
 @pytest.fixture
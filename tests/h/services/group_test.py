@@ -2,10 +2,13 @@ import datetime
 from unittest import mock
 
 import pytest
+from h_matchers import Any
 
 from h.models import Group, GroupScope, User
 from h.models.group import ReadableBy
-from h.services.group import GroupService, groups_factory
+from h.search.cache import SearchCache
+from h.services.group import GroupService, ReadableGroupsCache, groups_factory
+from h.util.cache import MemoryBackend
 from tests.common.matchers import Matcher
 
 
@@ -157,6 +160,29 @@ class TestGroupServiceGroupIds:
         pubids = [group.pubid, "doesnotexist"]
         assert svc.groupids_readable_by(user, group_ids=pubids) == [group.pubid]
 
+    def test_world_readable_groupids(self, svc, db_session, factories):
+        factories.Group(readable_by=ReadableBy.members)
+        group = factories.Group(readable_by=ReadableBy.world)
+        db_session.flush()
+
+        assert (
+            svc.world_readable_groupids()
+            == Any.list.containing(["__world__", group.pubid]).only()
+        )
+
+    def test_member_groupids_readable_by(self, svc, db_session, factories):
+        user = factories.User()
+        group = factories.Group(readable_by=ReadableBy.members)
+        group.members.append(user)
+        factories.Group(readable_by=ReadableBy.members)
+        factories.Group(readable_by=ReadableBy.world).members.append(user)
+        db_session.flush()
+
+        assert svc.member_groupids_readable_by(user) == [group.pubid]
+
+    def test_member_groupids_readable_by_returns_empty_list_for_missing_user(self, svc):
+        assert svc.member_groupids_readable_by(None) == []
+
     def test_created_by_includes_created_groups(self, svc, factories):
         user = factories.User()
         group = factories.Group(creator=user)
@@ -176,6 +202,163 @@ class TestGroupServiceGroupIds:
         assert svc.groupids_created_by(None) == []
 
 
+class TestGroupServiceReadableCache:
+    def test_it_caches_readable_groups(self, svc, db_session, factories):
+        user = factories.User()
+        group = factories.Group(readable_by=ReadableBy.members)
+        group.members.append(user)
+        db_session.flush()
+        readable = svc.groupids_readable_by(user)
+
+        group.members.remove(user)
+        db_session.flush()
+
+        assert svc.groupids_readable_by(user) == readable
+        assert group.pubid in readable
+
+    def test_invalidating_a_user_refreshes_their_groups(
+        self, svc, db_session, factories
+    ):
+        user = factories.User()
+        group = factories.Group(readable_by=ReadableBy.members)
+        group.members.append(user)
+        db_session.flush()
+        svc.groupids_readable_by(user)
+
+        group.members.remove(user)
+        db_session.flush()
+        svc.readable_cache.invalidate(user_ids=[user.id])
+
+        assert group.pubid not in svc.groupids_readable_by(user)
+
+    def test_invalidating_the_world_refreshes_world_readable_groups(
+        self, svc, db_session, factories
+    ):
+        svc.groupids_readable_by(None)
+
+        group = factories.Group(readable_by=ReadableBy.world)
+        db_session.flush()
+        assert group.pubid not in svc.groupids_readable_by(None)
+
+        svc.readable_cache.invalidate(world=True)
+        assert group.pubid in svc.groupids_readable_by(None)
+
+    def test_groups_read_before_an_invalidation_arent_cached_after_it(
+        self, svc, db_session, factories
+    ):
+        user = factories.User()
+        group = factories.Group(readable_by=ReadableBy.members)
+        db_session.flush()
+
+        # The user joins the group while their groups are being read
+        def join(*_args, **_kwargs):
+            svc.readable_cache.invalidate(user_ids=[user.id])
+            group.members.append(user)
+            db_session.flush()
+            return real_filter(*_args, **_kwargs)
+
+        query = db_session.query(Group.pubid)
+        real_filter = query.filter
+        with mock.patch.object(svc.session, "query", return_value=query):
+            with mock.patch.object(query, "filter", side_effect=join):
+                svc.member_groupids_readable_by(user)
+
+        assert svc.member_groupids_readable_by(user) == [group.pubid]
+
+    def test_it_doesnt_cache_with_group_ids(self, svc, db_session, factories):
+        group = factories.Group(readable_by=ReadableBy.world)
+        db_session.flush()
+        svc.groupids_readable_by(None, group_ids=[group.pubid])
+
+        group.readable_by = ReadableBy.members
+        db_session.flush()
+
+        assert svc.groupids_readable_by(None, group_ids=[group.pubid]) == []
+
+    @pytest.fixture
+    def svc(self, db_session, usr_svc):
+        return GroupService(
+            db_session,
+            usr_svc,
+            readable_cache=ReadableGroupsCache(SearchCache(MemoryBackend())),
+        )
+
+
+class TestReadableGroupsCache:
+    def test_it_does_nothing_without_a_search_cache(self):
+        readable_cache = ReadableGroupsCache(None)
+
+        entry_key = readable_cache.entry_key(ReadableGroupsCache.WORLD_KEY)
+        readable_cache.set(entry_key, ["abc"])
+        readable_cache.invalidate(user_ids=[1], world=True)
+
+        assert entry_key is None
+        assert readable_cache.get(entry_key) is None
+
+    def test_it_caches_groups_in_the_search_caches_backend(self, search_cache):
+        readable_cache = ReadableGroupsCache(search_cache)
+
+        entry_key = readable_cache.entry_key(ReadableGroupsCache.USER_KEY + "1")
+        readable_cache.set(entry_key, ["abc"])
+
+        assert search_cache.backend.get(entry_key) == ["abc"]
+        assert readable_cache.get(entry_key) == ["abc"]
+
+    def test_invalidate_changes_the_entry_key(self, search_cache):
+        readable_cache = ReadableGroupsCache(search_cache)
+        user_key = ReadableGroupsCache.USER_KEY + "1"
+        entry_keys = (
+            readable_cache.entry_key(user_key),
+            readable_cache.entry_key(ReadableGroupsCache.WORLD_KEY),
+        )
+
+        readable_cache.invalidate(user_ids=[1])
+
+        assert readable_cache.entry_key(user_key) != entry_keys[0]
+        assert readable_cache.entry_key(ReadableGroupsCache.WORLD_KEY) == (
+            entry_keys[1]
+        )
+
+    @pytest.mark.parametrize("committed", (True, False))
+    def test_it_invalidates_once_the_transaction_has_committed(
+        self, search_cache, committed
+    ):
+        tm = mock.Mock(spec_set=["get"])
+        readable_cache = ReadableGroupsCache(search_cache, tm=tm)
+        entry_key = readable_cache.entry_key(ReadableGroupsCache.WORLD_KEY)
+
+        readable_cache.invalidate(world=True)
+
+        assert readable_cache.entry_key(ReadableGroupsCache.WORLD_KEY) == entry_key
+        hook = tm.get.return_value.addAfterCommitHook.call_args[0][0]
+        hook(committed)
+        assert (
+            readable_cache.entry_key(ReadableGroupsCache.WORLD_KEY) == entry_key
+        ) != committed
+
+    def test_it_only_briefly_caches_world_readable_groups_in_each_process(
+        self, search_cache
+    ):
+        search_cache.anonymous_only = True
+        search_cache.backend = mock.create_autospec(
+            MemoryBackend, instance=True, spec_set=True
+        )
+        search_cache.backend.get.return_value = "generation"
+        readable_cache = ReadableGroupsCache(search_cache)
+
+        assert readable_cache.entry_key(ReadableGroupsCache.USER_KEY + "1") is None
+        entry_key = readable_cache.entry_key(ReadableGroupsCache.WORLD_KEY)
+        readable_cache.set(entry_key, ["abc"])
+
+        search_cache.backend.set.assert_called_once_with(
+            entry_key, ["abc"], ReadableGroupsCache.PROCESS_TTL
+        )
+
+    @pytest.fixture
+    def search_cache(self):
+        return SearchCache(MemoryBackend(), ttl=30)
+
+
 @pytest.mark.usefixtures("user_service")
 class TestGroupsFactory:
     def test_returns_groups_service(self, pyramid_request):
@@ -195,6 +378,31 @@ class TestGroupsFactory:
 
         user_service.fetch.assert_called_once_with("foo")
 
+    def test_caches_readable_groups_in_the_search_cache(
+        self, pyramid_request, pyramid_config
+    ):
+        search_cache = pyramid_config.registry["search.cache"] = SearchCache(
+            MemoryBackend()
+        )
+        pyramid_request.tm = mock.Mock(spec_set=["get"])
+        svc = groups_factory(None, pyramid_request)
+
+        entry_key = svc.readable_cache.entry_key(ReadableGroupsCache.WORLD_KEY)
+        svc.readable_cache.set(entry_key, ["abc"])
+
+        assert search_cache.backend.get(entry_key) == ["abc"]
+
+    def test_invalidates_readable_groups_after_the_requests_transaction(
+        self, pyramid_request, pyramid_config
+    ):
+        pyramid_config.registry["search.cache"] = SearchCache(MemoryBackend())
+        pyramid_request.tm = mock.Mock(spec_set=["get"])
+        svc = groups_factory(None, pyramid_request)
+
+        svc.readable_cache.invalidate(world=True)
+
+        pyramid_request.tm.get.return_value.addAfterCommitHook.assert_called_once()
+
 
 @pytest.fixture
 def usr_svc(db_session):
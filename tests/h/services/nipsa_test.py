@@ -1,5 +1,8 @@
+from unittest import mock
+
 import pytest
 
+from h.exceptions import RealtimeMessageQueueError
 from h.services.nipsa import NipsaService, nipsa_factory
 
 
@@ -35,6 +38,11 @@ class TestNipsaService:
             schedule_in=30,
         )
 
+    def test_flag_publishes_the_change(self, svc, users, publish):
+        svc.flag(users["unflagged_user"])
+
+        publish.assert_called_once_with("acct:unflagged_user@example.com", True)
+
     def test_unflag_sets_nipsa_false(self, svc, users):
         svc.unflag(users["flagged_user"])
 
@@ -51,6 +59,11 @@ class TestNipsaService:
             schedule_in=30,
         )
 
+    def test_unflag_publishes_the_change(self, svc, users, publish):
+        svc.unflag(users["flagged_user"])
+
+        publish.assert_called_once_with("acct:flagged_user@example.com", False)
+
     def test_fetch_all_flagged_userids_caches_lookup(self, svc, users):
         svc.fetch_all_flagged_userids()
         users["flagged_user"].nipsa = False
@@ -86,8 +99,12 @@ class TestNipsaService:
         assert not svc.is_flagged("acct:flagged_user@example.com")
 
     @pytest.fixture
-    def svc(self, db_session, search_index):
-        return NipsaService(db_session, lambda: search_index)
+    def svc(self, db_session, search_index, publish):
+        return NipsaService(db_session, lambda: search_index, publish)
+
+    @pytest.fixture
+    def publish(self):
+        return mock.Mock(spec_set=[])
 
     @pytest.fixture(autouse=True)
     def users(self, db_session, factories):
@@ -106,3 +123,49 @@ def test_nipsa_factory(pyramid_request, search_index):
     assert isinstance(svc, NipsaService)
     assert svc.session == pyramid_request.db
     assert svc._get_search_index() == search_index  # pylint:disable=protected-access
+
+
+def test_nipsa_factory_publishes_changes_once_committed(pyramid_request):
+    svc = nipsa_factory(None, pyramid_request)
+
+    svc._publish("acct:someone@example.com", True)  # pylint:disable=protected-access
+
+    pyramid_request.realtime.publish_user.assert_not_called()
+    after_commit_hook(pyramid_request)(True)
+    pyramid_request.realtime.publish_user.assert_called_once_with(
+        {"type": "nipsa-change", "userid": "acct:someone@example.com", "nipsa": True}
+    )
+
+
+def test_nipsa_factory_doesnt_publish_changes_that_are_rolled_back(pyramid_request):
+    svc = nipsa_factory(None, pyramid_request)
+
+    svc._publish("acct:someone@example.com", True)  # pylint:disable=protected-access
+    after_commit_hook(pyramid_request)(False)
+
+    pyramid_request.realtime.publish_user.assert_not_called()
+
+
+def test_nipsa_factory_reports_publishing_errors(pyramid_request, patch):
+    report_exception = patch("h.services.nipsa.report_exception")
+    error = RealtimeMessageQueueError()
+    pyramid_request.realtime.publish_user.side_effect = error
+    svc = nipsa_factory(None, pyramid_request)
+
+    svc._publish("acct:someone@example.com", True)  # pylint:disable=protected-access
+    after_commit_hook(pyramid_request)(True)
+
+    report_exception.assert_called_once_with(error)
+
+
+def after_commit_hook(pyramid_request):
+    transaction = pyramid_request.tm.get.return_value
+    transaction.addAfterCommitHook.assert_called_once()
+    return transaction.addAfterCommitHook.call_args[0][0]
+
+
+@pytest.fixture
+def pyramid_request(pyramid_request):
+    pyramid_request.realtime = mock.Mock(spec_set=["publish_user"])
+    pyramid_request.tm = mock.Mock(spec_set=["get"])
+    return pyramid_request
@@ -5,6 +5,7 @@ import pytest
 from h_matchers import Any
 
 from h.events import AnnotationEvent
+from h.search.cache import SearchCache
 from h.search.client import Client
 from h.services.search_index._queue import Queue
 from h.services.search_index.service import SearchIndexService
@@ -216,6 +217,70 @@ class TestDeleteAnnotationById:
         )
 
 
+class TestInvalidateSearchCache:
+    def test_adding_an_annotation_invalidates_its_searches(
+        self, search_index, storage, annotation, search_cache, annotation_tags
+    ):
+        search_index.add_annotation_by_id(annotation.id)
+
+        storage.expand_uri.assert_called_once_with(
+            search_index._db,  # pylint:disable=protected-access
+            annotation.target_uri,
+            normalized=True,
+        )
+        annotation_tags.assert_called_once_with(
+            annotation, storage.expand_uri.return_value
+        )
+        search_cache.invalidate.assert_called_once_with(annotation_tags.return_value)
+
+    def test_deleting_an_annotation_invalidates_its_searches(
+        self, search_index, storage, annotation, search_cache, annotation_tags
+    ):
+        search_index.delete_annotation_by_id(annotation.id)
+
+        storage.fetch_annotation.assert_called_with(
+            search_index._db, annotation.id  # pylint:disable=protected-access
+        )
+        annotation_tags.assert_called_once_with(
+            annotation, storage.expand_uri.return_value
+        )
+        search_cache.invalidate.assert_called_once_with(annotation_tags.return_value)
+
+    def test_it_does_nothing_for_missing_annotations(
+        self, search_index, storage, search_cache
+    ):
+        storage.fetch_annotation.return_value = None
+
+        search_index.delete_annotation_by_id(sentinel.annotation_id)
+
+        search_cache.invalidate.assert_not_called()
+
+    def test_it_does_nothing_if_the_cache_is_disabled(
+        self, search_index, storage, pyramid_request
+    ):
+        pyramid_request.registry["search.cache"] = None
+
+        search_index.delete_annotation_by_id(sentinel.annotation_id)
+
+        storage.fetch_annotation.assert_not_called()
+
+    @pytest.fixture
+    def annotation(self, factories, storage):
+        annotation = factories.Annotation.build(references=[])
+        storage.fetch_annotation.return_value = annotation
+        return annotation
+
+    @pytest.fixture
+    def search_cache(self, pyramid_request):
+        search_cache = create_autospec(SearchCache, instance=True, spec_set=True)
+        pyramid_request.registry["search.cache"] = search_cache
+        return search_cache
+
+    @pytest.fixture
+    def annotation_tags(self, patch):
+        return patch("h.services.search_index.service.annotation_tags")
+
+
 class TestHandleAnnotationEvent:
     def test_we_dispatch_correctly(
         self, search_index, pyramid_request, action, handler_for
@@ -52,6 +52,16 @@ class TestFetchOrderedAnnotations:
             db_session, [ann_2.id, ann_1.id], query_processor=only_maria
         )
 
+    def test_it_skips_invalid_ids(self, db_session, factories):
+        annotation = factories.Annotation()
+
+        assert storage.fetch_ordered_annotations(
+            db_session, ["foo", annotation.id]
+        ) == [annotation]
+
+    def test_it_handles_only_invalid_ids(self, db_session):
+        assert storage.fetch_ordered_annotations(db_session, ["foo"]) == []
+
     def test_it_handles_empty_ids(self):
         results = storage.fetch_ordered_annotations(sentinel.db_session, ids=[])
 
@@ -59,6 +69,41 @@ class TestFetchOrderedAnnotations:
 
 
 class TestExpandURI:
+    def test_it_caches_the_uris_of_documents(self, db_session, factories):
+        document = factories.Document()
+        factories.DocumentURI(uri="http://example.com/", document=document)
+        db_session.flush()
+        storage.expand_uri(db_session, "http://example.com/")
+
+        factories.DocumentURI(uri="http://example.org/", document=document)
+        db_session.flush()
+
+        assert storage.expand_uri(db_session, "http://example.com/") == [
+            "http://example.com/"
+        ]
+
+    def test_updating_document_metadata_invalidates_the_cache(self, db_session):
+        storage.expand_uri(db_session, "http://example.com/")
+
+        storage.update_document_metadata(
+            db_session,
+            "http://example.com/",
+            [],
+            [
+                {
+                    "claimant": "http://example.com/",
+                    "uri": "http://example.org/",
+                    "type": "rel-alternate",
+                    "content_type": "",
+                }
+            ],
+        )
+
+        assert sorted(storage.expand_uri(db_session, "http://example.com/")) == [
+            "http://example.com/",
+            "http://example.org/",
+        ]
+
     @pytest.mark.parametrize(
         "normalized,expected_uris",
         (
@@ -0,0 +1,98 @@
+from datetime import datetime
+from unittest.mock import sentinel
+
+import pytest
+from h_matchers import Any
+from pyramid.request import Request
+from pyramid.scripting import prepare
+from pyramid.threadlocal import get_current_registry, get_current_request
+
+from h.streamer.contexts import request_context
+
+
+class TestRequestContext:
+    def test_it_yields_a_request(self, registry):
+        with request_context(registry, sentinel.session) as request:
+            assert request == Any.instance_of(Request).with_attrs(
+                {"registry": registry, "db": sentinel.session}
+            )
+
+    def test_it_sets_the_threadlocals(self, registry):
+        with request_context(registry, sentinel.session) as request:
+            assert get_current_request() == request
+            assert get_current_registry() == registry
+
+        assert get_current_request() != request
+
+    def test_it_reuses_the_request(self, registry):
+        with request_context(registry, sentinel.session) as request:
+            pass
+
+        with request_context(registry, sentinel.other_session) as other_request:
+            assert other_request is request
+            assert other_request.db == sentinel.other_session
+
+    def test_it_recreates_services_for_each_request(self, registry, pyramid_config):
+        pyramid_config.register_service_factory(
+            lambda _context, _request: object(), name="user"
+        )
+
+        with request_context(registry, sentinel.session) as request:
+            service = request.find_service(name="user")
+            assert request.find_service(name="user") is service
+
+        with request_context(registry, sentinel.session) as request:
+            assert request.find_service(name="user") is not service
+
+    def test_it_shares_the_links_service(self, registry, pyramid_config):
+        pyramid_config.register_service_factory(
+            lambda _context, _request: object(), name="links"
+        )
+
+        with request_context(registry, sentinel.session) as request:
+            service = request.find_service(name="links")
+
+        with request_context(registry, sentinel.session) as request:
+            assert request.find_service(name="links") is service
+
+    @pytest.fixture
+    def registry(self, pyramid_config):
+        return pyramid_config.registry
+
+
+@pytest.mark.skip("Only of use during development")
+class TestRequestContextSpeed:  # pragma: no cover
+    # Compares the per-message cost of building a request with `prepare()`
+    # (as we used to) with reusing one with `request_context()`
+
+    @pytest.mark.parametrize("reps", (1000, 10000))
+    def test_prepare(self, registry, reps):
+        def get_request():
+            with prepare(registry=registry) as env:
+                env["request"].find_service(name="links")
+
+        self._time("prepare", get_request, reps)
+
+    @pytest.mark.parametrize("reps", (1000, 10000))
+    def test_request_context(self, registry, reps):
+        def get_request():
+            with request_context(registry, sentinel.session) as request:
+                request.find_service(name="links")
+
+        self._time("request_context", get_request, reps)
+
+    def _time(self, name, get_request, reps):
+        # Flush out any first load costs
+        get_request()
+
+        start = datetime.utcnow()
+        for _ in range(reps):
+            get_request()
+        diff = datetime.utcnow() - start
+
+        millis = diff.seconds * 1000 + diff.microseconds / 1000
+        print(f"{name} x {reps}: {millis} ms, {millis/reps*1000} μs/message")
+
+    @pytest.fixture
+    def registry(self, pyramid_config, links_service):
+        return pyramid_config.registry
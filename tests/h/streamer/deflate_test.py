@@ -0,0 +1,261 @@
+import json
+import zlib
+from time import process_time
+
+import pytest
+from ws4py.framing import OPCODE_CONTINUATION, OPCODE_PING, OPCODE_TEXT, Frame
+
+from h.streamer import deflate
+
+
+class TestNegotiate:
+    @pytest.mark.parametrize(
+        "offers",
+        (
+            "permessage-deflate",
+            "permessage-deflate; client_max_window_bits",
+            "permessage-deflate; client_max_window_bits=10; server_no_context_takeover",
+            "permessage-deflate; server_max_window_bits=15",
+            'permessage-deflate; server_max_window_bits="15"',
+            "x-webkit-deflate-frame, permessage-deflate",
+            "permessage-deflate; server_max_window_bits=10, permessage-deflate",
+        ),
+    )
+    def test_it_accepts_permessage_deflate(self, offers):
+        assert deflate.negotiate(offers) == (
+            "permessage-deflate; server_no_context_takeover"
+        )
+
+    @pytest.mark.parametrize(
+        "offers",
+        (
+            None,
+            "",
+            "x-webkit-deflate-frame",
+            "permessage-deflate; server_max_window_bits=10",
+            "permessage-deflate; unknown_param",
+        ),
+    )
+    def test_it_declines_anything_else(self, offers):
+        assert deflate.negotiate(offers) is None
+
+
+class TestDeflate:
+    def test_it_compresses_without_the_tail(self):
+        payload = deflate.deflate(b"Hello Hello Hello", 6)
+
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        assert decompressor.decompress(payload + b"\x00\x00\xff\xff") == (
+            b"Hello Hello Hello"
+        )
+
+    def test_deflate_frame(self):
+        frame = deflate.deflate_frame(b"Hello Hello Hello", 6)
+
+        # FIN, RSV1 and the text opcode, then an unmasked length
+        assert frame[0] == 0xC1
+        assert frame[1] == len(frame) - 2
+        assert frame[2:] == deflate.deflate(b"Hello Hello Hello", 6)
+
+    # Frames from RFC 7692 section 7.2.3.1
+    def test_it_matches_the_rfc_example(self):
+        assert deflate.deflate_frame(b"Hello", 6) == bytes(
+            [0xC1, 0x07, 0xF2, 0x48, 0xCD, 0xC9, 0xC9, 0x07, 0x00]
+        )
+
+
+class TestInflater:
+    def test_it_passes_through_uncompressed_frames(self, inflater):
+        frame = Frame(OPCODE_TEXT, b"Hello", masking_key=b"mask", fin=1).build()
+
+        assert list(inflater.frames(frame)) == [frame]
+
+    def test_it_inflates_compressed_frames(self, inflater):
+        frame = compressed_frame(b"Hello")
+
+        assert list(inflater.frames(frame)) == [
+            Frame(OPCODE_TEXT, b"Hello", masking_key=b"mask", fin=1).build()
+        ]
+
+    def test_it_inflates_fragmented_messages(self, inflater):
+        payload = deflate.deflate(b"Hello Hello", 6)
+        frames = [
+            Frame(OPCODE_TEXT, payload[:3], masking_key=b"mask", rsv1=1).build(),
+            Frame(OPCODE_PING, b"ping", masking_key=b"mask", fin=1).build(),
+            Frame(OPCODE_CONTINUATION, payload[3:], masking_key=b"mask", fin=1).build(),
+        ]
+
+        inflated = list(inflater.frames(b"".join(frames)))
+
+        assert len(inflated) == 3
+        assert inflated[1] == frames[1]
+        assert b"".join(parse(frame) for frame in (inflated[0], inflated[2])) == (
+            b"Hello Hello"
+        )
+
+    def test_it_inflates_messages_using_earlier_ones(self, inflater):
+        # Clients can compress each message using the ones before it
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        frames = []
+        for _ in range(2):
+            payload = compressor.compress(b"Hello") + compressor.flush(
+                zlib.Z_SYNC_FLUSH
+            )
+            frames.append(compressed_frame(payload=payload[:-4]))
+
+        inflated = [frame for data in frames for frame in inflater.frames(data)]
+
+        assert [parse(frame) for frame in inflated] == [b"Hello", b"Hello"]
+
+    def test_it_buffers_partial_frames(self, inflater):
+        data = compressed_frame(b"Hello" * 20)
+
+        inflated = [
+            frame
+            for i in range(0, len(data), 3)
+            for frame in inflater.frames(data[i : i + 3])
+        ]
+
+        assert [parse(frame) for frame in inflated] == [b"Hello" * 20]
+
+    @pytest.mark.parametrize("size", (200, 70000))
+    def test_it_reads_extended_lengths(self, inflater, size):
+        frame = Frame(OPCODE_TEXT, b"x" * size, masking_key=b"mask", fin=1).build()
+
+        assert list(inflater.frames(frame[:-1])) == []
+        assert list(inflater.frames(frame[-1:])) == [frame]
+
+    def test_it_refuses_frames_over_the_size_limit(self):
+        inflater = deflate.Inflater(max_frame_size=199)
+        frame = Frame(OPCODE_TEXT, b"x" * 200, masking_key=b"mask", fin=1).build()
+
+        # Before buffering the rest of the frame
+        with pytest.raises(deflate.MessageTooBig):
+            list(inflater.frames(frame[:10]))
+
+    def test_it_accepts_messages_up_to_the_size_limit(self):
+        inflater = deflate.Inflater(max_message_size=100)
+
+        inflated = list(inflater.frames(compressed_frame(b"x" * 100)))
+
+        assert [parse(frame) for frame in inflated] == [b"x" * 100]
+
+    def test_it_refuses_messages_which_inflate_over_the_size_limit(self):
+        inflater = deflate.Inflater(max_message_size=100)
+
+        with pytest.raises(deflate.MessageTooBig):
+            list(inflater.frames(compressed_frame(b"x" * 101)))
+
+    def test_it_limits_the_size_of_whole_fragmented_messages(self):
+        inflater = deflate.Inflater(max_message_size=100)
+        payload = deflate.deflate(b"x" * 101, 6)
+        frames = [
+            Frame(OPCODE_TEXT, payload[:3], masking_key=b"mask", rsv1=1).build(),
+            Frame(OPCODE_CONTINUATION, payload[3:], masking_key=b"mask", fin=1).build(),
+        ]
+
+        with pytest.raises(deflate.MessageTooBig):
+            list(inflater.frames(b"".join(frames)))
+
+    def test_the_size_limit_is_per_message(self):
+        inflater = deflate.Inflater(max_message_size=100)
+
+        inflated = [
+            frame
+            for _ in range(3)
+            for frame in inflater.frames(compressed_frame(b"x" * 100))
+        ]
+
+        assert len(inflated) == 3
+
+    @pytest.fixture
+    def inflater(self):
+        return deflate.Inflater()
+
+
+@pytest.mark.skip(reason="For dev purposes only")
+class TestDeflateSpeed:  # pragma: no cover
+    @pytest.mark.parametrize("level", (1, 6, 9))
+    def test_speed(self, level):
+        # Roughly what `_generate_annotation_event()` sends for an annotation
+        data = json.dumps(
+            {
+                "type": "annotation-notification",
+                "options": {"action": "create"},
+                "payload": [annotation_json(0)],
+            }
+        ).encode("utf-8")
+        reps = 10000
+
+        start = process_time()
+        for _ in range(reps):
+            frame = deflate.deflate_frame(data, level)
+        seconds = process_time() - start
+
+        print(
+            f"Level {level}: {len(data)} -> {len(frame)} bytes "
+            f"({len(frame) / len(data):.0%}), {seconds / reps * 1000000:.1f} us/msg"
+        )
+
+
+def annotation_json(i):
+    uri = f"https://example.com/articles/{i}/a-long-article-title"
+    return {
+        "id": f"AbCdEfGhIjKlMnOp{i:06d}",
+        "created": "2021-03-01T12:34:56.789012+00:00",
+        "updated": "2021-03-01T12:34:56.789012+00:00",
+        "user": "acct:someone@hypothes.is",
+        "uri": uri,
+        "text": "A comment about the highlighted text in the article.",
+        "tags": ["research", "reading"],
+        "group": "__world__",
+        "permissions": {
+            "read": ["group:__world__"],
+            "admin": ["acct:someone@hypothes.is"],
+            "update": ["acct:someone@hypothes.is"],
+            "delete": ["acct:someone@hypothes.is"],
+        },
+        "target": [
+            {
+                "source": uri,
+                "selector": [
+                    {
+                        "type": "RangeSelector",
+                        "endOffset": 120,
+                        "startOffset": 0,
+                        "endContainer": "/main[1]/article[1]/p[3]",
+                        "startContainer": "/main[1]/article[1]/p[3]",
+                    },
+                    {"end": 4521, "type": "TextPositionSelector", "start": 4401},
+                    {
+                        "type": "TextQuoteSelector",
+                        "exact": "the highlighted text in the article " * 3,
+                        "prefix": "Some text which comes before ",
+                        "suffix": " and some text which comes after",
+                    },
+                ],
+            }
+        ],
+        "document": {"title": ["A long article title"]},
+        "links": {
+            "html": f"https://hypothes.is/a/AbCdEfGhIjKlMnOp{i:06d}",
+            "incontext": f"https://hyp.is/AbCdEfGhIjKlMnOp{i:06d}/example.com",
+            "json": f"https://hypothes.is/api/annotations/AbCdEfGhIjKlMnOp{i:06d}",
+        },
+        "user_info": {"display_name": "Some One"},
+        "flagged": False,
+        "hidden": False,
+        "moderation": {"flagCount": 0},
+    }
+
+
+def compressed_frame(data=None, payload=None):
+    if payload is None:
+        payload = deflate.deflate(data, 6)
+
+    return Frame(OPCODE_TEXT, payload, masking_key=b"mask", fin=1, rsv1=1).build()
+
+
+def parse(frame):
+    """Get the unmasked payload of a masked frame without extended length."""
+    return bytes(Frame(masking_key=frame[2:6]).unmask(frame[6:]))
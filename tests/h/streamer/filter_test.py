@@ -1,3 +1,4 @@
+import sys
 from datetime import datetime
 from random import random
 
@@ -5,7 +6,14 @@ import pytest
 from h_matchers import Any
 from pytest import param
 
-from h.streamer.filter import SocketFilter
+from h.storage import expand_uri
+from h.streamer.filter import (
+    FilterRows,
+    PrefixTrie,
+    SocketFilter,
+    intern_rows,
+    normalize_uri_prefix,
+)
 
 
 class FakeSocket:
@@ -83,6 +91,30 @@ class TestFilterHandler:
             db_session, annotation.target_uri, normalized=True
         )
 
+    @pytest.mark.parametrize(
+        "prefix,ann_uri,should_match",
+        [
+            ("https://example.com", "https://example.com", True),
+            ("https://example.com", "https://example.com/docs/a.pdf", True),
+            ("https://example.com/docs/", "http://example.com/docs/a.pdf", True),
+            ("https://example.com/docs/", "https://example.com/docs-old", False),
+            ("https://example.com/docs/", "https://example.com", False),
+            ("https://example.com", "https://example.org", False),
+        ],
+    )
+    def test_it_matches_uri_prefix(
+        self, factories, prefix, ann_uri, should_match, filter_matches
+    ):
+        ann = factories.Annotation(target_uri=ann_uri)
+
+        filter_ = {
+            "match_policy": "include_any",
+            "actions": {},
+            "clauses": [{"field": "/uri", "operator": "prefix", "value": prefix}],
+        }
+
+        assert filter_matches(filter_, ann) is should_match
+
     def test_it_matches_id(self, factories, filter_matches, annotation):
         other_annotation = factories.Annotation()
 
@@ -113,20 +145,108 @@ class TestFilterHandler:
         assert filter_matches(filter_, annotation)
         assert not filter_matches(filter_, other_annotation)
 
-    def test_it_does_not_crash_without_filter_rows(self, annotation, db_session):
-        socket_no_rows = FakeSocket()
+    def test_it_does_not_match_sockets_without_a_filter(self, annotation, db_session):
+        FakeSocket()
 
-        result = tuple(SocketFilter.matching([socket_no_rows], annotation, db_session))
+        result = tuple(SocketFilter.matching(annotation, db_session))
         assert not result
 
-    def test_it_does_not_crash_with_unexpected_fields(self, annotation, db_session):
+    def test_it_matches_each_socket_once(self, annotation, db_session):
         socket = FakeSocket()
-        socket.filter_rows = (  # pylint:disable=attribute-defined-outside-init
-            ("/not_a_thing", "value"),
+        SocketFilter.set_filter(
+            socket,
+            {
+                "match_policy": "include_any",
+                "actions": {},
+                "clauses": [
+                    {"field": "/id", "operator": "equals", "value": annotation.id},
+                    {
+                        "field": "/group",
+                        "operator": "equals",
+                        "value": annotation.groupid,
+                    },
+                ],
+            },
         )
 
-        result = tuple(SocketFilter.matching([socket], annotation, db_session))
-        assert not result
+        result = tuple(SocketFilter.matching(annotation, db_session))
+
+        assert result == (socket,)
+
+    def test_set_filter_replaces_the_previous_filter(self, annotation, db_session):
+        socket = FakeSocket()
+        SocketFilter.set_filter(socket, self.filter_for("/id", annotation.id))
+
+        SocketFilter.set_filter(socket, self.filter_for("/id", "other"))
+
+        assert not tuple(SocketFilter.matching(annotation, db_session))
+
+    def test_remove_filter(self, annotation, db_session):
+        socket = FakeSocket()
+        SocketFilter.set_filter(socket, self.filter_for("/id", annotation.id))
+
+        SocketFilter.remove_filter(socket)
+
+        assert not tuple(SocketFilter.matching(annotation, db_session))
+        assert not SocketFilter._index  # pylint:disable=protected-access
+
+    def test_remove_filter_removes_uri_prefixes(self, payload):
+        socket = FakeSocket()
+        SocketFilter.set_filter(
+            socket, self.filter_for("/uri", "https://example.com", "prefix")
+        )
+
+        SocketFilter.remove_filter(socket)
+
+        assert not SocketFilter.might_match(payload)
+        assert not list(
+            SocketFilter._uri_prefixes.prefixes_of(  # pylint:disable=protected-access
+                "httpx://example.com"
+            )
+        )
+
+    def test_remove_filter_only_removes_the_given_socket(self, annotation, db_session):
+        socket, other_socket = FakeSocket(), FakeSocket()
+        SocketFilter.set_filter(socket, self.filter_for("/id", annotation.id))
+        SocketFilter.set_filter(other_socket, self.filter_for("/id", annotation.id))
+
+        SocketFilter.remove_filter(socket)
+
+        assert tuple(SocketFilter.matching(annotation, db_session)) == (other_socket,)
+
+    def test_remove_filter_does_not_crash_without_a_filter(self):
+        SocketFilter.remove_filter(FakeSocket())
+
+    @pytest.mark.parametrize(
+        "field,value",
+        (
+            ("/id", "ANNOTATION_ID"),
+            ("/group", "GROUP_ID"),
+            ("/uri", "https://example.com"),
+            ("/uri", "urn:x-pdf:1234"),
+            ("/references", "PARENT_ID"),
+        ),
+    )
+    def test_might_match(self, field, value, payload):
+        socket = FakeSocket()
+        SocketFilter.set_filter(socket, self.filter_for(field, value))
+
+        assert SocketFilter.might_match(payload)
+
+    def test_might_match_with_a_uri_prefix(self, payload):
+        socket = FakeSocket()
+        SocketFilter.set_filter(socket, self.filter_for("/uri", "https://ex", "prefix"))
+
+        assert SocketFilter.might_match(payload)
+
+    def test_might_match_returns_False_if_nothing_is_subscribed(self, payload):
+        socket = FakeSocket()
+        SocketFilter.set_filter(socket, self.filter_for("/group", "OTHER_GROUP"))
+
+        assert not SocketFilter.might_match(payload)
+
+    def test_might_match_returns_True_without_routing_keys(self):
+        assert SocketFilter.might_match({"annotation_id": "ANNOTATION_ID"})
 
     @pytest.mark.parametrize(
         "field,value,expected",
@@ -153,6 +273,9 @@ class TestFilterHandler:
             ("/uri", "http://example.com", [("/uri", "httpx://example.com")]),
             # Ignored
             ("/filter", "v1", []),
+            ("/id", {}, []),
+            ("/id", ["v1", {}, ["v2"], 3, None], [("/id", "v1")]),
+            ("/uri", [{}], []),
             ("/random", "v1", []),
         ),
     )
@@ -169,6 +292,106 @@ class TestFilterHandler:
 
         assert socket.filter_rows == Any.iterable.containing(expected).only()
 
+    @pytest.mark.parametrize(
+        "field,value,expected",
+        (
+            (
+                "/uri",
+                "http://example.com/docs/",
+                [("/uri prefix", "httpx://example.com/docs/")],
+            ),
+            (
+                "/uri",
+                ["https://example.com", "https://example.org/"],
+                [
+                    ("/uri prefix", "httpx://example.com"),
+                    ("/uri prefix", "httpx://example.org/"),
+                ],
+            ),
+            # Prefixes without a host would match too much
+            ("/uri", ["", "h", "urn:x-pdf"], []),
+            # Only URIs can be matched by prefix
+            ("/id", "v1", []),
+            # Values which aren't strings are ignored
+            ("/uri", [{}, 3], []),
+        ),
+    )
+    def test_set_filter_with_prefixes(self, field, value, expected):
+        socket = FakeSocket()
+
+        SocketFilter.set_filter(socket, self.filter_for(field, value, "prefix"))
+
+        assert socket.filter_rows == Any.iterable.containing(expected).only()
+
+    def test_routing_keys_with_nothing_subscribed(self):
+        assert SocketFilter.routing_keys() == {"annotation.unknown"}
+
+    def test_routing_keys_with_only_groups_subscribed(self):
+        SocketFilter.set_filter(FakeSocket(), self.filter_for("/group", ["g1", "g2"]))
+        SocketFilter.set_filter(FakeSocket(), self.filter_for("/group", "g2"))
+
+        assert SocketFilter.routing_keys() == {
+            "annotation.unknown",
+            "annotation.group.g1",
+            "annotation.group.g2",
+        }
+
+    @pytest.mark.parametrize(
+        "field,value",
+        (
+            ("/uri", "https://example.com"),
+            ("/id", "ANNOTATION_ID"),
+            ("/references", "PARENT_ID"),
+        ),
+    )
+    def test_routing_keys_with_anything_else_subscribed(self, field, value):
+        SocketFilter.set_filter(FakeSocket(), self.filter_for("/group", "g1"))
+        SocketFilter.set_filter(FakeSocket(), self.filter_for(field, value))
+
+        assert SocketFilter.routing_keys() == {"annotation.unknown", "annotation.#"}
+
+    def test_routing_keys_with_a_uri_prefix_subscribed(self):
+        SocketFilter.set_filter(
+            FakeSocket(), self.filter_for("/uri", "https://example.com", "prefix")
+        )
+
+        assert SocketFilter.routing_keys() == {"annotation.unknown", "annotation.#"}
+
+    def test_routing_keys_change_as_filters_are_removed(self):
+        group_socket, uri_socket = FakeSocket(), FakeSocket()
+        SocketFilter.set_filter(group_socket, self.filter_for("/group", "g1"))
+        SocketFilter.set_filter(uri_socket, self.filter_for("/uri", "https://a.com"))
+
+        SocketFilter.remove_filter(uri_socket)
+        assert SocketFilter.routing_keys() == {
+            "annotation.unknown",
+            "annotation.group.g1",
+        }
+
+        SocketFilter.remove_filter(group_socket)
+        assert SocketFilter.routing_keys() == {"annotation.unknown"}
+
+    def test_routing_keys_returns_the_same_set_until_they_change(self):
+        SocketFilter.set_filter(FakeSocket(), self.filter_for("/group", "g1"))
+        keys = SocketFilter.routing_keys()
+
+        # Another socket watching the same group doesn't change anything
+        SocketFilter.set_filter(FakeSocket(), self.filter_for("/group", "g1"))
+        assert SocketFilter.routing_keys() is keys
+
+        SocketFilter.set_filter(FakeSocket(), self.filter_for("/group", "g2"))
+        assert SocketFilter.routing_keys() is not keys
+
+    def test_set_filter_shares_filter_rows_between_sockets(self):
+        sockets = [FakeSocket(), FakeSocket()]
+
+        for socket in sockets:
+            SocketFilter.set_filter(
+                socket, self.filter_for("/uri", "https://example.com")
+            )
+
+        assert sockets[0].filter_rows is sockets[1].filter_rows
+
     def test_it_matches_parent_id(self, factories, filter_matches):
         parent_ann = factories.Annotation()
         other_ann = factories.Annotation()
@@ -192,9 +415,9 @@ class TestFilterHandler:
         assert not filter_matches(filter_, ann)
 
     @pytest.mark.skip(reason="For dev purposes only")
-    def test_speed(self, factories, db_session):  # pragma: no cover
-        # I think the max number connected at once is 4096
-        sockets = [FakeSocket() for _ in range(4096)]
+    @pytest.mark.parametrize("socket_count", (1000, 10000, 50000))
+    def test_speed(self, factories, db_session, socket_count):  # pragma: no cover
+        sockets = [FakeSocket() for _ in range(socket_count)]
 
         for socket in sockets:
             SocketFilter.set_filter(socket, self.get_randomized_filter())
@@ -203,11 +426,44 @@ class TestFilterHandler:
 
         start = datetime.utcnow()
         # This returns a generator, we need to force it to produce answers
-        tuple(SocketFilter.matching(sockets, ann, db_session))
+        indexed = set(SocketFilter.matching(ann, db_session))
+        indexed_ms = self.millis_since(start)
+
+        start = datetime.utcnow()
+        scanned = set(self.scan_matching(sockets, ann, db_session))
+        scanned_ms = self.millis_since(start)
+
+        assert indexed == scanned
+        print(f"{socket_count} sockets: index {indexed_ms} ms, scan {scanned_ms} ms")
+
+    @staticmethod
+    def scan_matching(sockets, annotation, session):  # pragma: no cover
+        """Match by scanning every socket, as we did before the index."""
+        values = {
+            "/id": [annotation.id],
+            "/group": [annotation.groupid],
+            "/uri": set(expand_uri(session, annotation.target_uri, normalized=True)),
+            "/references": set(annotation.references),
+        }
+
+        for socket in sockets:
+            for field, value in socket.filter_rows:
+                if value in values[field]:
+                    yield socket
+                    break
 
+    @staticmethod
+    def millis_since(start):  # pragma: no cover
         diff = datetime.utcnow() - start
-        ms = diff.seconds * 1000 + diff.microseconds / 1000
-        print(ms, "ms")
+        return diff.seconds * 1000 + diff.microseconds / 1000
+
+    @staticmethod
+    def filter_for(field, value, operator="equals"):
+        return {
+            "match_policy": "include_any",
+            "actions": {},
+            "clauses": [{"field": field, "operator": operator, "value": value}],
+        }
 
     def get_randomized_filter(self):  # pragma: no cover
         return {
@@ -246,6 +502,26 @@ class TestFilterHandler:
             ],
         }
 
+    @pytest.fixture(autouse=True)
+    def empty_index(self):
+        # The index is shared by all sockets in the process, so tests would
+        # otherwise see sockets from each other
+        # pylint:disable=protected-access
+        SocketFilter._index.clear()
+        SocketFilter._uri_prefixes = PrefixTrie()
+        SocketFilter._groups.clear()
+        SocketFilter._other_rows = 0
+        SocketFilter._routing_keys = None
+
+    @pytest.fixture
+    def payload(self):
+        return {
+            "annotation_id": "ANNOTATION_ID",
+            "group": "GROUP_ID",
+            "uris": ["httpx://example.com", "urn:x-pdf:1234"],
+            "references": ["PARENT_ID"],
+        }
+
     @pytest.fixture
     def storage(self, patch):
         return patch("h.streamer.filter.storage")
@@ -260,6 +536,95 @@ class TestFilterHandler:
             socket = FakeSocket()
             SocketFilter.set_filter(socket, filter_)
 
-            return bool(tuple(SocketFilter.matching([socket], annotation, db_session)))
+            return bool(tuple(SocketFilter.matching(annotation, db_session)))
 
         return filter_matches
+
+
+class TestInternRows:
+    def test_it_returns_shared_filter_rows(self):
+        rows = intern_rows([("/id", "a"), ("/uri", "b")])
+
+        assert isinstance(rows, FilterRows)
+        assert rows == {("/id", "a"), ("/uri", "b")}
+        assert intern_rows([("/uri", "b"), ("/id", "a")]) is rows
+
+    def test_it_interns_the_values(self):
+        value = "".join(["https://", "example.com"])
+
+        ((_, interned),) = intern_rows([("/uri", value)])
+
+        assert interned is sys.intern("https://example.com")
+
+    def test_it_returns_different_rows_for_different_filters(self):
+        assert intern_rows([("/id", "a")]) != intern_rows([("/id", "b")])
+
+
+class TestPrefixTrie:
+    def test_it_finds_the_prefixes_of_a_string(self, trie):
+        assert list(trie.prefixes_of("https://example.com/docs/a.pdf")) == [
+            "https://example.com",
+            "https://example.com/docs/",
+        ]
+
+    @pytest.mark.parametrize(
+        "string", ("https://example.org", "https://example.co", "", "other")
+    )
+    def test_it_finds_nothing_without_prefixes(self, trie, string):
+        assert not list(trie.prefixes_of(string))
+
+    def test_remove(self, trie):
+        trie.remove("https://example.com")
+
+        assert list(trie.prefixes_of("https://example.com/docs/a.pdf")) == [
+            "https://example.com/docs/"
+        ]
+
+    def test_remove_prunes_the_trie(self, trie):
+        trie.remove("https://example.com/docs/")
+        trie.remove("https://example.com")
+
+        assert not trie._root  # pylint:disable=protected-access
+
+    def test_remove_does_nothing_for_strings_not_in_the_trie(self, trie):
+        trie.remove("https://example.com/other")
+        trie.remove("https://example.com/docs")
+
+        assert len(list(trie.prefixes_of("https://example.com/docs/a.pdf"))) == 2
+
+    @pytest.fixture
+    def trie(self):
+        trie = PrefixTrie()
+        trie.add("https://example.com")
+        trie.add("https://example.com/docs/")
+        return trie
+
+
+class TestNormalizeURIPrefix:
+    @pytest.mark.parametrize(
+        "prefix,expected",
+        (
+            ("https://Example.com/docs", "httpx://example.com/docs"),
+            ("https://example.com/docs/", "httpx://example.com/docs/"),
+            ("http://example.com", "httpx://example.com"),
+            ("ftp://example.com/docs", "ftp://example.com/docs"),
+        ),
+    )
+    def test_it(self, prefix, expected):
+        assert normalize_uri_prefix(prefix) == expected
+
+    @pytest.mark.parametrize(
+        "prefix",
+        (
+            "",
+            "h",
+            "https",
+            "https://",
+            "https:///docs",
+            "example.com/docs",
+            "urn:x-pdf:",
+            "http://[::1",
+        ),
+    )
+    def test_it_rejects_prefixes_without_a_host(self, prefix):
+        assert normalize_uri_prefix(prefix) is None
@@ -0,0 +1,134 @@
+from unittest.mock import create_autospec, sentinel
+
+import pytest
+
+from h.streamer.heartbeat import Heartbeats, TimingWheel
+from h.streamer.websocket import WebSocket
+
+
+class TestTimingWheel:
+    @pytest.mark.parametrize("delay", (1, 2.5, 8, 9, 30))
+    def test_it_returns_items_when_they_are_due(self, wheel, delay):
+        wheel.schedule(sentinel.item, delay)
+
+        ticks = [wheel.advance() for _ in range(40)]
+
+        due = int(delay + 0.5)
+        assert ticks[due - 1] == [sentinel.item]
+        assert not [items for items in ticks[: due - 1] + ticks[due:] if items]
+
+    def test_it_returns_every_item_due_at_once(self, wheel):
+        wheel.schedule(sentinel.item_1, 2)
+        wheel.schedule(sentinel.item_2, 2)
+
+        wheel.advance()
+
+        assert wheel.advance() == [sentinel.item_1, sentinel.item_2]
+
+    def test_it_waits_at_least_one_tick(self, wheel):
+        wheel.schedule(sentinel.item, 0)
+
+        assert wheel.advance() == [sentinel.item]
+
+    @pytest.fixture
+    def wheel(self):
+        return TimingWheel(tick=1, size=8)
+
+
+class TestHeartbeats:
+    def test_it_sends_heartbeats(self, heartbeats, socket):
+        heartbeats.add(socket)
+
+        heartbeats.beat()
+        socket.heartbeat.assert_not_called()
+        heartbeats.beat()
+
+        socket.heartbeat.assert_called_once_with()
+
+    def test_it_keeps_sending_heartbeats(self, heartbeats, socket, monotonic):
+        heartbeats.add(socket)
+
+        for now in range(1, 5):
+            socket.last_received = monotonic.return_value = now
+            heartbeats.beat()
+
+        assert socket.heartbeat.call_count == 2
+
+    def test_it_drops_closed_connections(self, heartbeats, socket):
+        socket.terminated = True
+        heartbeats.add(socket)
+
+        heartbeats.beat()
+        heartbeats.beat()
+
+        socket.heartbeat.assert_not_called()
+        assert not any(slot for slot in heartbeats.wheel._slots)
+
+    def test_it_drops_connections_which_stop_responding(
+        self, heartbeats, socket, monotonic
+    ):
+        heartbeats.add(socket)
+        monotonic.return_value = 5
+
+        heartbeats.beat()
+        heartbeats.beat()
+
+        socket.abort.assert_called_once_with()
+        socket.heartbeat.assert_not_called()
+
+    def test_it_closes_connections_which_send_no_filter(
+        self, heartbeats, socket, monotonic
+    ):
+        socket.filter_received = False
+        heartbeats.add(socket)
+        socket.last_received = monotonic.return_value = 11
+
+        heartbeats.beat()
+        heartbeats.beat()
+
+        socket.close_queued.assert_called_once_with(reason="No filter received")
+        socket.heartbeat.assert_not_called()
+
+    def test_it_doesnt_close_connections_which_send_no_filter_before_the_timeout(
+        self, heartbeats, socket
+    ):
+        socket.filter_received = False
+        heartbeats.add(socket)
+
+        heartbeats.beat()
+        heartbeats.beat()
+
+        socket.close_queued.assert_not_called()
+
+    def test_it_can_not_close_connections_which_send_no_filter(
+        self, heartbeats, socket, monotonic
+    ):
+        heartbeats.filter_timeout = 0
+        socket.filter_received = False
+        heartbeats.add(socket)
+        socket.last_received = monotonic.return_value = 11
+
+        heartbeats.beat()
+        heartbeats.beat()
+
+        socket.close_queued.assert_not_called()
+
+    @pytest.fixture
+    def heartbeats(self):
+        heartbeats = Heartbeats(interval=2, filter_timeout=10)
+        heartbeats.wheel.tick = 1
+        return heartbeats
+
+    @pytest.fixture
+    def socket(self):
+        socket = create_autospec(WebSocket, instance=True)
+        socket.terminated = False
+        socket.filter_received = True
+        socket.connected_at = socket.last_received = 0
+        return socket
+
+    @pytest.fixture(autouse=True)
+    def monotonic(self, patch):
+        monotonic = patch("h.streamer.heartbeat.monotonic")
+        monotonic.return_value = 0
+        return monotonic
@@ -0,0 +1,128 @@
+from unittest.mock import sentinel
+
+import pytest
+from gevent.queue import Queue
+from h_matchers import Any
+
+from h.streamer import loadtest, messages
+from h.streamer.filter import SocketFilter
+from h.streamer.websocket import json_frame
+
+
+class TestStats:
+    @pytest.mark.parametrize("size", (10, 1000, 100000))
+    def test_sent_records_the_delivery_time(self, stats, time, size):
+        time.return_value = 105
+        frame = json_frame({"cursor": 100, "text": "x" * size}).build()
+
+        stats.sent(frame)
+        stats.sent(frame)
+
+        assert stats.frames == 2
+        assert stats.bytes == 2 * len(frame)
+        assert stats.delivery.count == 2
+        assert stats.delivery.max == 5
+
+    def test_sent_ignores_frames_without_a_cursor(self, stats):
+        stats.sent(json_frame({"type": "session-change"}).build())
+
+        assert stats.frames == 1
+        assert not stats.delivery.count
+
+    @pytest.fixture
+    def stats(self):
+        return loadtest.Stats()
+
+    @pytest.fixture
+    def time(self, patch):
+        return patch("h.streamer.loadtest.time")
+
+
+class TestConnect:
+    def test_it_opens_connections_watching_the_uris(self, work_queue):
+        sockets = loadtest._connect(
+            ["https://example.com/a"],
+            [1],
+            loadtest.Stats(),
+            work_queue,
+            connections=3,
+            authenticated_share=0.5,
+        )
+
+        assert len(sockets) == 3
+        for socket in sockets:
+            assert socket.filter_rows == {("/uri", "httpx://example.com/a")}
+        assert SocketFilter.might_match(
+            {
+                "annotation_id": "id",
+                "group": "__world__",
+                "uris": ["httpx://example.com/a"],
+                "references": [],
+            }
+        )
+
+        for socket in sockets:
+            socket.closed(1000)
+
+
+class TestPublishEvents:
+    def test_it_publishes_events(self, work_queue):
+        published, dropped = loadtest._publish_events(
+            work_queue,
+            {"https://example.com/a": ["id"]},
+            [1],
+            [],
+            rate=1000,
+            duration=0.005,
+            user_event_share=0,
+        )
+
+        assert published == work_queue.qsize() == 6
+        assert not dropped
+        assert work_queue.get() == messages.Message(
+            topic="annotation",
+            payload=Any.dict.containing(
+                {
+                    "annotation_id": "id",
+                    "uris": ["httpx://example.com/a"],
+                    "published_at": Any.float(),
+                }
+            ),
+        )
+
+    def test_it_counts_events_dropped_when_the_queue_is_full(self):
+        published, dropped = loadtest._publish_events(
+            Queue(maxsize=1),
+            {"https://example.com/a": ["id"]},
+            [1],
+            [],
+            rate=1000,
+            duration=0.005,
+            user_event_share=0,
+        )
+
+        assert (published, dropped) == (1, 5)
+
+    def test_it_publishes_user_events(self, work_queue):
+        socket = sentinel.socket
+        socket.authenticated_userid = "acct:user@example.com"
+
+        loadtest._publish_events(
+            work_queue,
+            {"https://example.com/a": ["id"]},
+            [1],
+            [socket],
+            rate=1000,
+            duration=0,
+            user_event_share=1,
+        )
+
+        assert work_queue.get() == messages.Message(
+            topic="user",
+            payload=Any.dict.containing({"userid": "acct:user@example.com"}),
+        )
+
+
+@pytest.fixture
+def work_queue():
+    return Queue()
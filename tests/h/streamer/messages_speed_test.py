@@ -18,21 +18,18 @@ class TestHandleAnnotationEventSpeed:  # pragma: no cover
     @pytest.mark.parametrize("reps", (1, 16, 256, 4096))
     @pytest.mark.parametrize("action", ("create", "delete"))
     def test_speed(  # pylint: disable=too-many-arguments
-        self, db_session, pyramid_request, socket, message, action, reps
+        self, db_session, pyramid_request, socket, message, action, reps, SocketFilter
     ):
         sockets = list(socket for _ in range(reps))
+        SocketFilter.matching.side_effect = lambda annotation, session: iter(sockets)
         message["action"] = action
 
         start = datetime.utcnow()
-        handle_annotation_event(
-            message=message,
-            sockets=sockets,
-            request=pyramid_request,
-            session=db_session,
-        )
+        # Annotation events find their sockets with `SocketFilter.matching()`
+        handle_annotation_event(message, [], pyramid_request, db_session)
         diff = datetime.utcnow() - start
 
-        assert socket.send_json.count == reps
+        assert socket.send_frame.count == reps
 
         millis = diff.seconds * 1000 + diff.microseconds / 1000
         print(
@@ -44,8 +41,8 @@ class TestHandleAnnotationEventSpeed:  # pragma: no cover
         return factories.Annotation(shared=True)
 
     @pytest.fixture
-    def pyramid_request(self, registry):
-        with request_context(registry) as request:
+    def pyramid_request(self, registry, db_session):
+        with request_context(registry, db_session) as request:
             yield request
 
     @pytest.fixture
@@ -73,9 +70,7 @@ class TestHandleAnnotationEventSpeed:  # pragma: no cover
     def SocketFilter(self, patch):
         # We aren't interested in the speed of the socket filter, as that has
         # it's own speed tests
-        SocketFilter = patch("h.streamer.messages.SocketFilter")
-        SocketFilter.matching.side_effect = lambda sockets, annotation: iter(sockets)
-        return SocketFilter
+        return patch("h.streamer.messages.SocketFilter")
 
     @pytest.mark.usefixtures("registry")
     @pytest.fixture
@@ -96,6 +91,6 @@ class TestHandleAnnotationEventSpeed:  # pragma: no cover
             fake_send.count += 1
 
         fake_send.count = 0
-        socket.send_json = fake_send
+        socket.send_frame = fake_send
 
         return socket
@@ -1,14 +1,19 @@
+from time import time
 from unittest import mock
-from unittest.mock import Mock, create_autospec, sentinel
+from unittest.mock import MagicMock, Mock, create_autospec, sentinel
 
 import pytest
 from gevent.queue import Queue
 from h_matchers import Any
 from pyramid import security
 from pyramid.request import Request
+from pyramid.security import Everyone
 
 from h.security import Permission
-from h.streamer import messages
+from h.streamer import messages, shedding
+from h.streamer.nipsa import FlaggedUsers
+from h.streamer.replay import EventBuffer, Replay
+from h.streamer.websocket import Message as WSMessage
 from h.streamer.websocket import WebSocket
 
 
@@ -28,6 +33,40 @@ class TestProcessMessages:
         consumer = Consumer.return_value
         consumer.run.assert_called_once_with()
 
+    def test_it_creates_and_runs_a_topic_consumer(
+        self, TopicConsumer, realtime, work_queue
+    ):
+        messages.process_messages(
+            {},
+            "routing_key",
+            work_queue,
+            raise_error=False,
+            routing_keys=sentinel.routing_keys,
+        )
+
+        TopicConsumer.assert_called_once_with(
+            connection=realtime.get_connection.return_value,
+            routing_keys=sentinel.routing_keys,
+            handler=Any(),
+        )
+        TopicConsumer.return_value.run.assert_called_once_with()
+
+    def test_topic_consumers_queue_messages_for_the_routing_key(
+        self, TopicConsumer, work_queue
+    ):
+        messages.process_messages(
+            {},
+            "routing_key",
+            work_queue,
+            raise_error=False,
+            routing_keys=sentinel.routing_keys,
+        )
+        handler = TopicConsumer.call_args[1]["handler"]
+
+        handler({"foo": "bar"})
+
+        assert work_queue.get_nowait().topic == "routing_key"
+
     def test_it_puts_message_on_queue(self, _handler, work_queue):
         _handler({"foo": "bar"})
 
@@ -35,13 +74,71 @@ class TestProcessMessages:
         assert result.topic == "routing_key"  # Set by _handler fixture
         assert result.payload == {"foo": "bar"}
 
-    def test_it_handles_a_full_queue(self, _handler, work_queue):
+    def test_it_handles_a_full_queue(self, _handler, work_queue, SHEDDER):
         work_queue.put(messages.Message(topic="queue_is_full", payload={}))
 
         _handler({"foo": "bar"})
 
         result = work_queue.get_nowait()
         assert result.topic == "queue_is_full"
+        SHEDDER.record.assert_called_once_with("dropped")
+
+    def test_it_tells_the_replay_buffer_about_dropped_messages(
+        self, Consumer, work_queue
+    ):
+        replay_buffer = create_autospec(EventBuffer, instance=True, spec_set=True)
+        messages.process_messages(
+            {},
+            "annotation",
+            work_queue,
+            raise_error=False,
+            replay_buffer=replay_buffer,
+        )
+        handler = Consumer.call_args[1]["handler"]
+        work_queue.put(messages.Message(topic="queue_is_full", payload={}))
+
+        handler({"foo": "bar"})
+
+        replay_buffer.skip.assert_called_once_with({"foo": "bar"})
+
+    def test_it_drops_annotation_events_when_shedding_load(
+        self, Consumer, work_queue, SHEDDER
+    ):
+        SHEDDER.level.return_value = shedding.Level.DROP
+        messages.process_messages({}, "annotation", work_queue, raise_error=False)
+        handler = Consumer.call_args[1]["handler"]
+
+        handler({"foo": "bar"})
+
+        assert work_queue.empty()
+        SHEDDER.record.assert_called_once_with("dropped")
+
+    def test_it_tells_the_replay_buffer_about_events_dropped_when_shedding_load(
+        self, Consumer, work_queue, SHEDDER
+    ):
+        SHEDDER.level.return_value = shedding.Level.DROP
+        replay_buffer = create_autospec(EventBuffer, instance=True, spec_set=True)
+        messages.process_messages(
+            {},
+            "annotation",
+            work_queue,
+            raise_error=False,
+            replay_buffer=replay_buffer,
+        )
+        handler = Consumer.call_args[1]["handler"]
+
+        handler({"foo": "bar"})
+
+        replay_buffer.skip.assert_called_once_with({"foo": "bar"})
+
+    def test_it_doesnt_drop_other_events_when_shedding_load(
+        self, _handler, work_queue, SHEDDER
+    ):
+        SHEDDER.level.return_value = shedding.Level.DROP
+
+        _handler({"foo": "bar"})
+
+        assert work_queue.get_nowait().payload == {"foo": "bar"}
 
     def test_it_raises_if_the_consumer_exits(self, work_queue):
         with pytest.raises(RuntimeError):
@@ -56,6 +153,10 @@ class TestProcessMessages:
     def Consumer(self, patch):
         return patch("h.streamer.messages.Consumer")
 
+    @pytest.fixture
+    def TopicConsumer(self, patch):
+        return patch("h.streamer.messages.TopicConsumer")
+
     @pytest.fixture(autouse=True)
     def realtime(self, patch):
         return patch("h.streamer.messages.realtime")
@@ -69,20 +170,39 @@ class TestHandleMessage:
     def test_calls_handler_with_list_of_sockets(self, websocket, registry):
         handler = Mock(return_value=None)
         session = sentinel.db_session
-        message = messages.Message(topic="foo", payload={"foo": "bar"})
+        message = messages.Message(topic="user", payload={"foo": "bar"})
         websocket.instances = [sentinel.socket_1, sentinel.socket_2]
 
         messages.handle_message(
-            message, registry, session, topic_handlers={"foo": handler}
+            message, registry, session, topic_handlers={"user": handler}
         )
 
         handler.assert_called_once_with(
             message.payload,
             websocket.instances,
-            Any.object.of_type(Request).with_attrs({"registry": registry}),
+            Any.object.of_type(Request).with_attrs(
+                {"registry": registry, "db": session}
+            ),
             session,
         )
 
+    def test_it_doesnt_list_the_sockets_for_annotation_events(
+        self, websocket, registry
+    ):
+        handler = Mock(return_value=None)
+        message = messages.Message(topic="annotation", payload={"foo": "bar"})
+        websocket.instances = MagicMock()
+
+        messages.handle_message(
+            message,
+            registry,
+            sentinel.db_session,
+            topic_handlers={"annotation": handler},
+        )
+
+        websocket.instances.__iter__.assert_not_called()
+        handler.assert_called_once_with(message.payload, [], Any(), Any())
+
     def test_it_raises_RuntimeError_for_bad_topics(self, registry):
         message = messages.Message(topic="unknown", payload={})
         topic_handlers = {"known": sentinel.handler}
@@ -96,14 +216,36 @@ class TestHandleMessage:
             )
 
     @pytest.fixture
-    def registry(self, pyramid_request):
-        return pyramid_request.registry
+    def registry(self, pyramid_config):
+        return pyramid_config.registry
 
     @pytest.fixture
     def websocket(self, patch):
         return patch("h.streamer.websocket.WebSocket")
 
 
+class TestIsUnwatched:
+    @pytest.mark.parametrize("might_match", (True, False))
+    def test_it_checks_annotation_events(self, SocketFilter, might_match):
+        SocketFilter.might_match.return_value = might_match
+        message = messages.Message(topic="annotation", payload=sentinel.payload)
+
+        result = messages.is_unwatched(message)
+
+        SocketFilter.might_match.assert_called_once_with(sentinel.payload)
+        assert result is not might_match
+
+    def test_it_returns_False_for_other_topics(self, SocketFilter):
+        message = messages.Message(topic="user", payload=sentinel.payload)
+
+        assert not messages.is_unwatched(message)
+        SocketFilter.might_match.assert_not_called()
+
+    @pytest.fixture
+    def SocketFilter(self, patch):
+        return patch("h.streamer.messages.SocketFilter")
+
+
 @pytest.mark.usefixtures("nipsa_service", "user_service", "links_service")
 class TestHandleAnnotationEvent:
     def test_it_fetches_the_annotation(
@@ -139,9 +281,24 @@ class TestHandleAnnotationEvent:
         )
         assert AnnotationJSONPresenter.return_value.asdict.called
 
+    def test_notification_includes_the_cursor(
+        self, handle_annotation_event, message, json_frame
+    ):
+        message["published_at"] = 1234.5
+
+        handle_annotation_event()
+
+        json_frame.assert_called_once_with(Any.dict.containing({"cursor": 1234.5}))
+
     @pytest.mark.parametrize("action", ["create", "update", "delete"])
     def test_notification_format(
-        self, handle_annotation_event, action, message, socket, AnnotationJSONPresenter
+        self,
+        handle_annotation_event,
+        action,
+        message,
+        socket,
+        AnnotationJSONPresenter,
+        json_frame,
     ):
         message["action"] = action
 
@@ -152,13 +309,97 @@ class TestHandleAnnotationEvent:
         else:
             expected_payload = AnnotationJSONPresenter.return_value.asdict.return_value
 
-        socket.send_json.assert_called_once_with(
+        json_frame.assert_called_once_with(
             {
                 "payload": [expected_payload],
                 "type": "annotation-notification",
                 "options": {"action": action},
             }
         )
+        socket.send_frame.assert_called_once_with(json_frame.return_value)
+
+    def test_it_serializes_the_notification_once(
+        self,
+        handle_annotation_event,
+        SocketFilter,
+        json_frame,
+        principals_allowed_by_permission,
+    ):
+        principals_allowed_by_permission.return_value = ["principal"]
+        sockets = [
+            create_autospec(
+                WebSocket,
+                instance=True,
+                effective_principals=frozenset(["principal"]),
+            )
+            for _ in range(3)
+        ]
+        SocketFilter.matching.side_effect = None
+        SocketFilter.matching.return_value = iter(sockets)
+
+        handle_annotation_event(sockets=sockets)
+
+        json_frame.assert_called_once()
+        for socket in sockets:
+            socket.send_frame.assert_called_once_with(json_frame.return_value)
+
+    def test_it_records_the_latency_of_each_stage(
+        self, handle_annotation_event, message, metrics
+    ):
+        message["published_at"] = time() - 2
+
+        handle_annotation_event()
+
+        for histogram in (
+            metrics.LATENCY_DB_FETCH,
+            metrics.LATENCY_FILTER_MATCHING,
+            metrics.LATENCY_PRESENTATION,
+            metrics.LATENCY_SEND,
+        ):
+            histogram.time.assert_called_once_with()
+        metrics.LATENCY_TOTAL.record.assert_called_once_with(
+            Any.float().greater_than(2)
+        )
+
+    def test_it_doesnt_record_total_latency_for_unstamped_messages(
+        self, handle_annotation_event, metrics
+    ):
+        handle_annotation_event()
+
+        metrics.LATENCY_TOTAL.record.assert_not_called()
+
+    def test_it_defers_notifications_for_anonymous_sockets(
+        self, handle_annotation_event, SocketFilter, socket, message, SHEDDER
+    ):
+        SHEDDER.level.return_value = shedding.Level.DEFER
+        socket.authenticated_userid = "acct:user@example.com"
+        anonymous_socket = create_autospec(
+            WebSocket,
+            instance=True,
+            authenticated_userid=None,
+            effective_principals=socket.effective_principals,
+        )
+        SocketFilter.matching.side_effect = None
+        SocketFilter.matching.return_value = iter([socket, anonymous_socket])
+
+        handle_annotation_event()
+
+        socket.send_frame.assert_called_once()
+        anonymous_socket.send_frame.assert_not_called()
+        SHEDDER.defer.assert_called_once_with(
+            messages.Message(topic="annotation", payload=message)
+        )
+
+    def test_it_doesnt_defer_anything_without_anonymous_sockets(
+        self, handle_annotation_event, socket, SHEDDER
+    ):
+        SHEDDER.level.return_value = shedding.Level.DEFER
+        socket.authenticated_userid = "acct:user@example.com"
+
+        handle_annotation_event()
+
+        socket.send_frame.assert_called_once()
+        SHEDDER.defer.assert_not_called()
 
     def test_it_filters_the_sockets(
         self,
@@ -172,7 +413,7 @@ class TestHandleAnnotationEvent:
         handle_annotation_event(sockets=[socket], session=db_session)
 
         SocketFilter.matching.assert_called_once_with(
-            [socket], fetch_annotation.return_value, db_session
+            fetch_annotation.return_value, db_session
         )
 
     def test_no_send_for_sender_socket(self, handle_annotation_event, socket, message):
@@ -180,7 +421,7 @@ class TestHandleAnnotationEvent:
 
         handle_annotation_event(message=message, sockets=[socket])
 
-        socket.send_json.assert_not_called()
+        socket.send_frame.assert_not_called()
 
     def test_no_send_if_filter_does_not_match(
         self, handle_annotation_event, socket, SocketFilter
@@ -189,7 +430,7 @@ class TestHandleAnnotationEvent:
         SocketFilter.matching.return_value = iter(())
         handle_annotation_event(sockets=[socket])
 
-        socket.send_json.assert_not_called()
+        socket.send_frame.assert_not_called()
 
     @pytest.mark.parametrize(
         "userid,can_see",
@@ -208,13 +449,13 @@ class TestHandleAnnotationEvent:
         fetch_annotation,
     ):
         """Should return None if the annotation is from a NIPSA'd user."""
-        nipsa_service.is_flagged.return_value = True
+        nipsa_service.fetch_all_flagged_userids.return_value = {"nipsaed_user"}
         fetch_annotation.return_value.userid = "nipsaed_user"
         socket.authenticated_userid = userid
 
         handle_annotation_event(sockets=[socket])
 
-        assert bool(socket.send_json.call_count) == can_see
+        assert bool(socket.send_frame.call_count) == can_see
 
     @pytest.mark.parametrize(
         "user_principals,can_see",
@@ -235,14 +476,40 @@ class TestHandleAnnotationEvent:
         socket,
     ):
         principals_allowed_by_permission.return_value = ["principal", "acl_noise"]
-        socket.effective_principals = user_principals
+        socket.effective_principals = frozenset(user_principals)
 
         handle_annotation_event(sockets=[socket])
 
         principals_allowed_by_permission.assert_called_with(
             AnnotationContext.return_value, Permission.Annotation.READ_REALTIME_UPDATES
         )
-        assert bool(socket.send_json.call_count) == can_see
+        assert bool(socket.send_frame.call_count) == can_see
+
+    def test_visibility_is_checked_per_principal_set(
+        self,
+        handle_annotation_event,
+        principals_allowed_by_permission,
+        SocketFilter,
+    ):
+        principals_allowed_by_permission.return_value = ["principal"]
+        sockets = [
+            create_autospec(WebSocket, instance=True, effective_principals=principals)
+            for principals in (
+                frozenset(["principal"]),
+                frozenset(["other"]),
+                frozenset(["principal"]),
+            )
+        ]
+        SocketFilter.matching.side_effect = None
+        SocketFilter.matching.return_value = iter(sockets)
+
+        handle_annotation_event(sockets=sockets)
+
+        assert [bool(socket.send_frame.call_count) for socket in sockets] == [
+            True,
+            False,
+            True,
+        ]
 
     @pytest.fixture
     def handle_annotation_event(self, message, socket, pyramid_request, session):
@@ -289,6 +556,10 @@ class TestHandleAnnotationEvent:
     def principals_allowed_by_permission(self, patch):
         return patch("h.streamer.messages.principals_allowed_by_permission")
 
+    @pytest.fixture
+    def metrics(self, patch):
+        return patch("h.streamer.messages.metrics")
+
     @pytest.fixture
     def AnnotationContext(self, patch):
         return patch("h.streamer.messages.AnnotationContext")
@@ -298,29 +569,275 @@ class TestHandleAnnotationEvent:
         return patch("h.streamer.messages.presenters.AnnotationJSONPresenter")
 
     @pytest.fixture(autouse=True)
-    def SocketFilter(self, patch):
+    def SocketFilter(self, patch, socket):
         SocketFilter = patch("h.streamer.messages.SocketFilter")
-        SocketFilter.matching.side_effect = (
-            lambda sockets, annotation, db_session: iter(sockets)
+        SocketFilter.matching.side_effect = lambda annotation, db_session: iter(
+            [socket]
         )
         return SocketFilter
 
 
+class TestCoalesceAnnotationEvents:
+    def test_it_keeps_the_latest_event_for_each_annotation(self):
+        events = [
+            messages.Message("annotation", {"annotation_id": "a", "action": "create"}),
+            messages.Message("annotation", {"annotation_id": "b", "action": "create"}),
+            messages.Message("annotation", {"annotation_id": "a", "action": "delete"}),
+        ]
+
+        result = messages.coalesce_annotation_events(events)
+
+        assert result == [events[2], events[1]]
+
+
+@pytest.mark.usefixtures("nipsa_service", "user_service", "links_service")
+class TestHandleAnnotationEvents:
+    def test_it_loads_all_annotations_at_once(
+        self, fetch_ordered_annotations, registry, events, annotations
+    ):
+        messages.handle_annotation_events(events, registry, sentinel.session)
+
+        fetch_ordered_annotations.assert_called_once_with(
+            sentinel.session, [annotation.id for annotation in annotations]
+        )
+
+    def test_it_notifies_for_each_event(
+        self, registry, events, annotations, socket, json_frame
+    ):
+        messages.handle_annotation_events(events, registry, sentinel.session)
+
+        assert [call.args[0]["options"] for call in json_frame.call_args_list] == [
+            {"action": "create"},
+            {"action": "update"},
+        ]
+        assert socket.send_frame.call_count == len(annotations)
+
+    def test_it_skips_missing_annotations(
+        self, fetch_ordered_annotations, registry, events, socket
+    ):
+        fetch_ordered_annotations.return_value = []
+
+        messages.handle_annotation_events(events, registry, sentinel.session)
+
+        socket.send_frame.assert_not_called()
+
+    def test_it_only_notifies_the_given_sockets(self, registry, events, socket):
+        messages.handle_annotation_events(
+            events, registry, sentinel.session, sockets={sentinel.other_socket}
+        )
+
+        socket.send_frame.assert_not_called()
+
+    def test_it_can_merge_notifications_by_document(
+        self, registry, events, annotations, socket, json_frame, SHEDDER
+    ):
+        events[0].payload.update({"action": "update", "published_at": 1.0})
+        events[1].payload["published_at"] = 2.0
+
+        messages.handle_annotation_events(
+            events, registry, sentinel.session, by_document=True
+        )
+
+        json_frame.assert_called_once_with(
+            {
+                "type": "annotation-notification",
+                "options": {"action": "update"},
+                "payload": [Any(), Any()],
+                "cursor": 2.0,
+            }
+        )
+        socket.send_frame.assert_called_once_with(json_frame.return_value)
+        SHEDDER.record.assert_called_once_with("coalesced", 1)
+
+    def test_merged_notifications_only_include_readable_annotations(
+        self, registry, events, socket, json_frame, principals_allowed_by_permission
+    ):
+        events[0].payload["action"] = "update"
+        principals_allowed_by_permission.side_effect = [["group:private"], [Everyone]]
+
+        messages.handle_annotation_events(
+            events, registry, sentinel.session, by_document=True
+        )
+
+        json_frame.assert_called_once_with(Any.dict.containing({"payload": [Any()]}))
+        socket.send_frame.assert_called_once_with(json_frame.return_value)
+
+    def test_merged_notifications_share_frames_between_sockets(
+        self, registry, events, socket, json_frame, SocketFilter
+    ):
+        events[0].payload["action"] = "update"
+        other_socket = create_autospec(
+            WebSocket, instance=True, effective_principals=socket.effective_principals
+        )
+        SocketFilter.matching.side_effect = lambda annotation, db_session: iter(
+            [socket, other_socket]
+        )
+
+        messages.handle_annotation_events(
+            events, registry, sentinel.session, by_document=True
+        )
+
+        json_frame.assert_called_once()
+        socket.send_frame.assert_called_once_with(json_frame.return_value)
+        other_socket.send_frame.assert_called_once_with(json_frame.return_value)
+
+    def test_merged_notifications_skip_annotations_nobody_is_watching(
+        self, registry, events, socket, json_frame, SocketFilter
+    ):
+        events[0].payload["action"] = "update"
+        SocketFilter.matching.side_effect = [iter([]), iter([socket])]
+
+        messages.handle_annotation_events(
+            events, registry, sentinel.session, by_document=True
+        )
+
+        json_frame.assert_called_once_with(Any.dict.containing({"payload": [Any()]}))
+
+    def test_it_doesnt_merge_notifications_for_other_documents_or_actions(
+        self, registry, events, annotations, socket
+    ):
+        annotations[1].document_id = annotations[0].document_id + 1
+        events[0].payload["action"] = "update"
+
+        messages.handle_annotation_events(
+            events[:1] + events[1:], registry, sentinel.session, by_document=True
+        )
+
+        assert socket.send_frame.call_count == 2
+
+    @pytest.fixture
+    def annotations(self, factories):
+        annotations = factories.Annotation.build_batch(2, shared=True)
+        for annotation in annotations:
+            annotation.document_id = 1
+        return annotations
+
+    @pytest.fixture
+    def events(self, annotations):
+        return [
+            messages.Message(
+                topic="annotation",
+                payload={
+                    "annotation_id": annotation.id,
+                    "action": action,
+                    "src_client_id": None,
+                },
+            )
+            for annotation, action in zip(annotations, ("create", "update"))
+        ]
+
+    @pytest.fixture
+    def registry(self, pyramid_request):
+        return pyramid_request.registry
+
+    @pytest.fixture(autouse=True)
+    def fetch_ordered_annotations(self, patch, annotations):
+        fetch = patch("h.streamer.messages.storage.fetch_ordered_annotations")
+        fetch.return_value = annotations
+        return fetch
+
+    @pytest.fixture(autouse=True)
+    def principals_allowed_by_permission(self, patch):
+        principals_allowed_by_permission = patch(
+            "h.streamer.messages.principals_allowed_by_permission"
+        )
+        principals_allowed_by_permission.return_value = [security.Everyone]
+        return principals_allowed_by_permission
+
+    @pytest.fixture(autouse=True)
+    def AnnotationJSONPresenter(self, patch):
+        return patch("h.streamer.messages.presenters.AnnotationJSONPresenter")
+
+    @pytest.fixture(autouse=True)
+    def SocketFilter(self, patch, socket):
+        SocketFilter = patch("h.streamer.messages.SocketFilter")
+        SocketFilter.matching.side_effect = lambda annotation, db_session: iter(
+            [socket]
+        )
+        return SocketFilter
+
+
+@pytest.mark.usefixtures("nipsa_service", "user_service", "links_service")
+class TestReplayAnnotationEvents:
+    def test_it_replays_the_missed_events(
+        self, replay_, event_buffer, handle_annotation_events, pyramid_request
+    ):
+        events = [
+            messages.Message(topic="annotation", payload={"annotation_id": id_})
+            for id_ in ("id_1", "id_2", "id_1")
+        ]
+        event_buffer.since.return_value = (events, True)
+
+        messages.replay_annotation_events(
+            replay_, event_buffer, pyramid_request.registry, sentinel.session
+        )
+
+        event_buffer.since.assert_called_once_with(replay_.since)
+        handle_annotation_events.assert_called_once_with(
+            # Only the latest event for each annotation is replayed
+            [events[2], events[1]],
+            pyramid_request.registry,
+            sentinel.session,
+            sockets={replay_.message.socket},
+        )
+
+    @pytest.mark.parametrize("complete", (True, False))
+    def test_it_tells_the_client_whether_the_replay_is_complete(
+        self, replay_, event_buffer, pyramid_request, complete
+    ):
+        event_buffer.since.return_value = ([], complete)
+
+        messages.replay_annotation_events(
+            replay_, event_buffer, pyramid_request.registry, sentinel.session
+        )
+
+        replay_.message.reply.assert_called_once_with(
+            {"type": "replay", "complete": complete}
+        )
+
+    def test_it_does_nothing_else_if_nothing_was_missed(
+        self, replay_, event_buffer, handle_annotation_events, pyramid_request
+    ):
+        event_buffer.since.return_value = ([], True)
+
+        messages.replay_annotation_events(
+            replay_, event_buffer, pyramid_request.registry, sentinel.session
+        )
+
+        handle_annotation_events.assert_not_called()
+
+    @pytest.fixture
+    def replay_(self, socket):
+        message = create_autospec(WSMessage, instance=True, socket=socket)
+        return Replay(message=message, since=1234.5)
+
+    @pytest.fixture
+    def event_buffer(self):
+        return create_autospec(EventBuffer, instance=True, spec_set=True)
+
+    @pytest.fixture
+    def handle_annotation_events(self, patch):
+        return patch("h.streamer.messages.handle_annotation_events")
+
+
 class TestHandleUserEvent:
-    def test_sends_session_change_when_joining_or_leaving_group(self, socket, message):
+    def test_sends_session_change_when_joining_or_leaving_group(
+        self, socket, message, json_frame
+    ):
         socket.authenticated_userid = message["userid"]
 
         messages.handle_user_event(message, [socket, socket], None, None)
 
-        reply = {
-            "type": "session-change",
-            "action": "group-join",
-            "model": message["session_model"],
-        }
-
-        assert socket.send_json.call_args_list == [
-            mock.call(reply),
-            mock.call(reply),
+        json_frame.assert_called_once_with(
+            {
+                "type": "session-change",
+                "action": "group-join",
+                "model": message["session_model"],
+            }
+        )
+        assert socket.send_frame.call_args_list == [
+            mock.call(json_frame.return_value),
+            mock.call(json_frame.return_value),
         ]
 
     def test_no_send_when_socket_is_not_event_users(self, socket, message):
@@ -330,7 +847,18 @@ class TestHandleUserEvent:
 
         messages.handle_user_event(message, [socket], None, None)
 
-        socket.send_json.assert_not_called()
+        socket.send_frame.assert_not_called()
+
+    @pytest.mark.parametrize("nipsa", (True, False))
+    def test_it_records_nipsa_changes(self, socket, FLAGGED_USERS, nipsa):
+        FLAGGED_USERS.update = create_autospec(FLAGGED_USERS.update)
+        socket.authenticated_userid = "amy"
+        message = {"type": "nipsa-change", "userid": "amy", "nipsa": nipsa}
+
+        messages.handle_user_event(message, [socket], None, None)
+
+        FLAGGED_USERS.update.assert_called_once_with("amy", nipsa)
+        socket.send_frame.assert_not_called()
 
     @pytest.fixture
     def message(self):
@@ -345,5 +873,24 @@ class TestHandleUserEvent:
 @pytest.fixture
 def socket():
     socket = create_autospec(WebSocket, instance=True)
-    socket.effective_principals = [security.Everyone, "group:__world__"]
+    socket.effective_principals = frozenset([security.Everyone, "group:__world__"])
     return socket
+
+
+@pytest.fixture(autouse=True)
+def FLAGGED_USERS(patch):
+    return patch(
+        "h.streamer.messages.nipsa.FLAGGED_USERS", new=FlaggedUsers(), autospec=None
+    )
+
+
+@pytest.fixture(autouse=True)
+def SHEDDER(patch):
+    SHEDDER = patch("h.streamer.shedding.SHEDDER")
+    SHEDDER.level.return_value = shedding.Level.NORMAL
+    return SHEDDER
+
+
+@pytest.fixture(autouse=True)
+def json_frame(patch):
+    return patch("h.streamer.messages.websocket.json_frame")
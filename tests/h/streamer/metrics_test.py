@@ -1,3 +1,4 @@
+from collections import Counter
 from unittest.mock import create_autospec
 
 import pytest
@@ -5,8 +6,11 @@ from gevent.pool import Pool
 from gevent.queue import Queue
 from h_matchers import Any
 
-from h.streamer.metrics import websocket_metrics
+from h.streamer import metrics, shedding
+from h.streamer.metrics import Histogram, Summary, latency_report, websocket_metrics
+from h.streamer.shedding import LoadShedder
 from h.streamer.websocket import WebSocket
+from h.streamer.workqueue import WorkQueue
 
 
 class TestWebsocketMetrics:
@@ -35,6 +39,118 @@ class TestWebsocketMetrics:
             [("Custom/WebSocket/WorkQueueSize", size)]
         )
 
+    def test_it_records_work_queue_lane_depths(self, generate_metrics, queue):
+        queue.lanes["control"].put("message")
+
+        metrics = generate_metrics()
+
+        assert list(metrics) == Any.list.containing(
+            [
+                ("Custom/WebSocket/WorkQueue/Control/Depth", 1),
+                ("Custom/WebSocket/WorkQueue/Events/Depth", 0),
+            ]
+        )
+
+    def test_it_records_work_queue_summaries(self, generate_metrics):
+        metrics.WORK_QUEUE_BATCH_SIZE.record(3)
+        metrics.WORK_QUEUE_DRAIN_TIME.record(0.5)
+
+        result = list(generate_metrics())
+
+        assert result == Any.list.containing(
+            [
+                (
+                    "Custom/WebSocket/WorkQueue/BatchSize",
+                    Any.dict.containing({"count": 1, "total": 3}),
+                ),
+                (
+                    "Custom/WebSocket/WorkQueue/DrainTime",
+                    Any.dict.containing({"count": 1, "total": 0.5}),
+                ),
+            ]
+        )
+
+    def test_it_does_not_record_empty_summaries(self, generate_metrics):
+        result = list(generate_metrics())
+
+        assert result != Any.list.containing(
+            [Any.tuple.containing(["Custom/WebSocket/WorkQueue/BatchSize"])]
+        )
+
+    def test_it_records_send_queue_metrics(self, generate_metrics, sockets, WebSocket):
+        for socket, depth in zip(sockets, (0, 2, 10)):
+            socket.send_queue_depth = depth
+        WebSocket.send_queue_overflows.update({"drop": 3, "close": 1})
+
+        metrics = list(generate_metrics())
+
+        assert metrics == Any.list.containing(
+            [
+                (
+                    "Custom/WebSocket/SendQueue/Depth",
+                    Any.dict.containing({"count": 3, "total": 12, "max": 10}),
+                ),
+                ("Custom/WebSocket/SendQueue/Dropped", 3),
+                ("Custom/WebSocket/SendQueue/Evicted", 1),
+            ]
+        )
+        assert not WebSocket.send_queue_overflows
+
+    def test_it_records_latency_percentiles(self, generate_metrics, histograms):
+        for value in (0.001, 0.002, 0.1):
+            histograms["DBFetch"].record(value)
+
+        result = list(generate_metrics())
+
+        assert result == Any.list.containing(
+            [
+                ("Custom/WebSocket/Latency/DBFetch/p50", Any.float()),
+                ("Custom/WebSocket/Latency/DBFetch/p95", 0.1),
+                ("Custom/WebSocket/Latency/DBFetch/p99", 0.1),
+                (
+                    "Custom/WebSocket/Latency/DBFetch",
+                    Any.dict.containing({"count": 3, "max": 0.1}),
+                ),
+            ]
+        )
+        assert not histograms["DBFetch"].count
+        assert result != Any.list.containing(
+            [Any.tuple.containing(["Custom/WebSocket/Latency/Send"])]
+        )
+
+    def test_it_records_shedding_metrics(self, generate_metrics, SHEDDER):
+        SHEDDER.level.return_value = shedding.Level.COALESCE
+        SHEDDER.record("deferred", 3)
+        SHEDDER.record("coalesced", 2)
+        SHEDDER.record("dropped")
+
+        result = list(generate_metrics())
+
+        assert result == Any.list.containing(
+            [
+                ("Custom/WebSocket/Shedding/Level", 2),
+                ("Custom/WebSocket/Shedding/Deferred", 3),
+                ("Custom/WebSocket/Shedding/Coalesced", 2),
+                ("Custom/WebSocket/Shedding/Dropped", 1),
+                ("Custom/WebSocket/Shedding/Refused", 0),
+            ]
+        )
+        # The counts are reset once they've been reported
+        assert not SHEDDER.decisions
+
+    def test_it_records_expanded_uri_cache_metrics(self, generate_metrics, patch):
+        EXPANDED_URIS = patch("h.streamer.metrics.EXPANDED_URIS")
+        EXPANDED_URIS.report.return_value = {"Hits": 3, "Misses": 1}
+
+        result = list(generate_metrics())
+
+        assert result == Any.list.containing(
+            [
+                ("Custom/WebSocket/ExpandURICache/Hits", 3),
+                ("Custom/WebSocket/ExpandURICache/Misses", 1),
+            ]
+        )
+
     def test_it_records_alive_metric(self, generate_metrics):
         metrics = generate_metrics()
 
@@ -54,19 +170,44 @@ class TestWebsocketMetrics:
             ]
         )
 
+    @pytest.fixture(autouse=True)
+    def summaries(self, patch):
+        patch("h.streamer.metrics.WORK_QUEUE_BATCH_SIZE", new=Summary(), autospec=None)
+        patch("h.streamer.metrics.WORK_QUEUE_DRAIN_TIME", new=Summary(), autospec=None)
+
+    @pytest.fixture(autouse=True)
+    def SHEDDER(self, patch):
+        SHEDDER = patch(
+            "h.streamer.metrics.shedding.SHEDDER", new=LoadShedder(), autospec=None
+        )
+        SHEDDER.level = create_autospec(SHEDDER.level)
+        SHEDDER.level.return_value = shedding.Level.NORMAL
+        return SHEDDER
+
+    @pytest.fixture(autouse=True)
+    def histograms(self, patch):
+        return patch(
+            "h.streamer.metrics.LATENCY_HISTOGRAMS",
+            new={name: Histogram() for name in metrics.LATENCY_HISTOGRAMS},
+            autospec=None,
+        )
+
     @pytest.fixture
     def generate_metrics(self, queue):
         return lambda: websocket_metrics(queue)
 
     @pytest.fixture
     def queue(self):
-        return create_autospec(Queue, instance=True, spec_set=True)
+        queue = create_autospec(WorkQueue, instance=True)
+        queue.lanes = {"control": Queue(), "events": Queue()}
+        return queue
 
     @pytest.fixture
     def sockets(self):
         sockets = [create_autospec(WebSocket, instance=True) for _ in range(3)]
         for socket in sockets:
             socket.authenticated_userid = None
+            socket.send_queue_depth = 0
 
         return sockets
 
@@ -74,6 +215,7 @@ class TestWebsocketMetrics:
     def WebSocket(self, patch, sockets):
         WebSocket = patch("h.streamer.metrics.WebSocket")
         WebSocket.instances = sockets
+        WebSocket.send_queue_overflows = Counter()
 
         return WebSocket
 
@@ -89,3 +231,115 @@ class TestWebsocketMetrics:
         WSGIServer.instances = [server_instance]
 
         return server_instance
+
+
+class TestSummary:
+    def test_it_summarises_values(self):
+        summary = Summary()
+
+        for value in (2, 4, 3):
+            summary.record(value)
+
+        assert summary.report() == {
+            "count": 3,
+            "total": 9,
+            "min": 2,
+            "max": 4,
+            "sum_of_squares": 29,
+        }
+
+    def test_report_resets_the_summary(self):
+        summary = Summary()
+        summary.record(2)
+
+        summary.report()
+
+        assert summary.report() == {
+            "count": 0,
+            "total": 0,
+            "min": None,
+            "max": None,
+            "sum_of_squares": 0,
+        }
+
+
+class TestHistogram:
+    def test_it_summarises_values(self):
+        histogram = Histogram()
+
+        for value in (2, 4, 3):
+            histogram.record(value)
+
+        assert histogram.report() == Any.dict.containing(
+            {"count": 3, "total": 9, "min": 2, "max": 4}
+        )
+
+    @pytest.mark.parametrize(
+        "percent,expected",
+        # Each value is within a bucket's width (about 19%) of the true value
+        ((1, 1), (50, 50), (95, 95), (99, 99), (100, 100)),
+    )
+    def test_percentile(self, percent, expected):
+        histogram = Histogram()
+        for value in range(1, 101):
+            histogram.record(value)
+
+        assert expected <= histogram.percentile(percent) <= expected * 1.19
+
+    def test_percentile_never_exceeds_the_max(self):
+        histogram = Histogram()
+        histogram.record(0.003)
+
+        assert histogram.percentile(50) == 0.003
+
+    def test_percentile_handles_tiny_and_negative_values(self):
+        histogram = Histogram()
+        histogram.record(-0.5)
+        histogram.record(0)
+
+        assert histogram.percentile(50) == 0
+
+    def test_percentile_with_no_values(self):
+        assert Histogram().percentile(50) is None
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        histogram.record(0.5)
+
+        assert histogram.percentiles() == {"p50": 0.5, "p95": 0.5, "p99": 0.5}
+
+    def test_time(self):
+        histogram = Histogram()
+
+        with histogram.time():
+            pass
+
+        assert histogram.count == 1
+        assert 0 <= histogram.max < 1
+
+    def test_report_resets_the_histogram(self):
+        histogram = Histogram()
+        histogram.record(2)
+
+        histogram.report()
+
+        assert histogram.percentile(50) is None
+        assert not histogram.buckets
+
+
+class TestLatencyReport:
+    def test_it(self, patch):
+        histogram = Histogram()
+        histogram.record(0.5)
+        patch(
+            "h.streamer.metrics.LATENCY_HISTOGRAMS",
+            new={"Send": histogram, "Total": Histogram()},
+            autospec=None,
+        )
+
+        assert latency_report() == {
+            "Send": {"count": 1, "max": 500, "p50": 500, "p95": 500, "p99": 500},
+            "Total": {"count": 0},
+        }
+        # Reports don't reset the histograms
+        assert histogram.count == 1
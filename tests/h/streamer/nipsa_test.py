@@ -0,0 +1,68 @@
+import pytest
+
+from h.streamer.nipsa import FlaggedUsers
+
+
+class TestFlaggedUsers:
+    def test_is_flagged(self, flagged_users, pyramid_request):
+        assert flagged_users.is_flagged(pyramid_request, "acct:flagged@example.com")
+        assert not flagged_users.is_flagged(
+            pyramid_request, "acct:unflagged@example.com"
+        )
+
+    def test_it_loads_the_flagged_users_once(
+        self, flagged_users, pyramid_request, nipsa_service
+    ):
+        flagged_users.is_flagged(pyramid_request, "acct:flagged@example.com")
+        flagged_users.is_flagged(pyramid_request, "acct:unflagged@example.com")
+
+        nipsa_service.fetch_all_flagged_userids.assert_called_once_with()
+
+    def test_it_reloads_after_the_ttl(
+        self, flagged_users, pyramid_request, nipsa_service, monotonic
+    ):
+        flagged_users.is_flagged(pyramid_request, "acct:flagged@example.com")
+        nipsa_service.fetch_all_flagged_userids.return_value = set()
+        monotonic.return_value = 1061
+
+        assert not flagged_users.is_flagged(pyramid_request, "acct:flagged@example.com")
+
+    @pytest.mark.parametrize("nipsa", (True, False))
+    def test_update(self, flagged_users, pyramid_request, nipsa_service, nipsa):
+        userid = "acct:flagged@example.com" if not nipsa else "acct:other@example.com"
+        flagged_users.is_flagged(pyramid_request, userid)
+
+        flagged_users.update(userid, nipsa)
+
+        assert flagged_users.is_flagged(pyramid_request, userid) == nipsa
+        nipsa_service.fetch_all_flagged_userids.assert_called_once_with()
+
+    def test_update_before_loading_does_nothing(self, flagged_users, pyramid_request):
+        flagged_users.update("acct:other@example.com", True)
+
+        assert not flagged_users.is_flagged(pyramid_request, "acct:other@example.com")
+
+    def test_clear(self, flagged_users, pyramid_request, nipsa_service):
+        flagged_users.is_flagged(pyramid_request, "acct:flagged@example.com")
+
+        flagged_users.clear()
+        flagged_users.is_flagged(pyramid_request, "acct:flagged@example.com")
+
+        assert nipsa_service.fetch_all_flagged_userids.call_count == 2
+
+    @pytest.fixture
+    def flagged_users(self):
+        return FlaggedUsers(ttl=60)
+
+    @pytest.fixture(autouse=True)
+    def nipsa_service(self, nipsa_service):
+        nipsa_service.fetch_all_flagged_userids.return_value = {
+            "acct:flagged@example.com"
+        }
+        return nipsa_service
+
+    @pytest.fixture(autouse=True)
+    def monotonic(self, patch):
+        monotonic = patch("h.streamer.nipsa.monotonic")
+        monotonic.return_value = 1000
+        return monotonic
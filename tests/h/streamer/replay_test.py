@@ -0,0 +1,112 @@
+import pytest
+
+from h.streamer.messages import Message
+from h.streamer.replay import EventBuffer, cursor
+
+
+class TestCursor:
+    def test_it_is_the_publish_time(self):
+        assert cursor({"published_at": 1234.5}) == 1234.5
+
+    def test_it_is_None_for_unstamped_events(self):
+        assert cursor({}) is None
+
+
+class TestEventBuffer:
+    def test_since_returns_the_events_after_the_cursor(self, buffer, events, time):
+        append(buffer, events, time)
+
+        assert buffer.since(1001) == (events[2:], True)
+
+    def test_it_uses_the_time_received_for_unstamped_events(self, buffer, time):
+        event = Message(topic="annotation", payload={"annotation_id": "id"})
+        time.return_value = 1005
+
+        buffer.append(event)
+
+        assert buffer.since(1004) == ([event], True)
+        assert buffer.since(1005) == ([], True)
+
+    def test_it_keeps_a_limited_number_of_events(self, events, time):
+        buffer = EventBuffer(size=2, skew=0)
+        append(buffer, events, time)
+
+        assert buffer.since(1001) == (events[2:], True)
+        # We no longer have the event after 1000
+        assert buffer.since(1000) == (events[2:], False)
+
+    def test_it_keeps_events_for_a_limited_time(self, events, time):
+        buffer = EventBuffer(ttl=10, skew=0)
+        append(buffer, events, time)
+
+        time.return_value = 1012.5
+
+        assert buffer.since(1000) == (events[2:], False)
+
+    def test_replays_are_incomplete_from_before_it_was_created(self, buffer):
+        # The buffer was created at 1000
+        assert buffer.since(999) == ([], False)
+        assert buffer.since(1000) == ([], True)
+
+    def test_replays_allow_for_clock_skew(self, events, time):
+        buffer = EventBuffer(skew=1)
+        append(buffer, events, time)
+
+        assert buffer.since(1002) == (events[2:], True)
+
+    def test_replays_are_incomplete_from_before_skipped_events(
+        self, buffer, events, time
+    ):
+        append(buffer, events[:2], time)
+        buffer.skip(events[2].payload)
+        append(buffer, events[3:], time)
+
+        assert buffer.since(1001) == ([events[3]], False)
+        assert buffer.since(1002) == ([events[3]], True)
+
+    def test_skipping_unstamped_events_uses_the_current_time(self, buffer, time):
+        time.return_value = 1005
+
+        buffer.skip({"annotation_id": "id"})
+
+        assert buffer.since(1004) == ([], False)
+        assert buffer.since(1005) == ([], True)
+
+    def test_clock_skew_makes_replays_incomplete_for_longer(self, time):
+        buffer = EventBuffer(skew=1)
+
+        assert buffer.since(1000) == ([], False)
+        assert buffer.since(1001) == ([], True)
+
+    def test_partial_buffers_are_never_complete(self, buffer, events, time):
+        append(buffer, events, time)
+        buffer.partial = True
+
+        assert buffer.since(1001) == (events[2:], False)
+
+    @pytest.fixture
+    def buffer(self, time):  # pylint:disable=unused-argument
+        return EventBuffer(skew=0)
+
+    @pytest.fixture
+    def events(self):
+        return [
+            Message(
+                topic="annotation",
+                payload={"annotation_id": f"id_{i}", "published_at": 1000 + i},
+            )
+            for i in range(4)
+        ]
+
+    @pytest.fixture(autouse=True)
+    def time(self, patch):
+        time = patch("h.streamer.replay.time")
+        time.return_value = 1000
+        return time
+
+
+def append(buffer, events, time):
+    # Events are received a moment after they are published
+    for event in events:
+        time.return_value = event.payload["published_at"] + 0.5
+        buffer.append(event)
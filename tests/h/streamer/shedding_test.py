@@ -0,0 +1,96 @@
+from unittest.mock import sentinel
+
+import pytest
+from gevent.queue import Queue
+
+from h.streamer.shedding import Level, LoadShedder, parse_watermarks
+
+
+class TestLoadShedder:
+    @pytest.mark.parametrize(
+        "size,level",
+        (
+            (0, Level.NORMAL),
+            (4, Level.NORMAL),
+            (5, Level.DEFER),
+            (7, Level.DEFER),
+            (8, Level.COALESCE),
+            (9, Level.DROP),
+            (10, Level.DROP),
+        ),
+    )
+    def test_level(self, lane, size, level):
+        for _ in range(size):
+            lane.put_nowait(sentinel.message)
+        shedder = LoadShedder(lane, watermarks=(0.5, 0.8, 0.9, None))
+
+        assert shedder.level() == level
+
+    def test_level_skips_disabled_levels(self, lane):
+        for _ in range(10):
+            lane.put_nowait(sentinel.message)
+        shedder = LoadShedder(lane, watermarks=(None, 0.5, None, None))
+
+        assert shedder.level() == Level.COALESCE
+
+    def test_level_can_be_offline(self, lane):
+        for _ in range(10):
+            lane.put_nowait(sentinel.message)
+        shedder = LoadShedder(lane, watermarks=(0.5, 0.6, 0.7, 1.0))
+
+        assert shedder.level() == Level.OFFLINE
+
+    @pytest.mark.parametrize("lane", (None, Queue()))
+    def test_level_is_normal_without_a_bounded_lane(self, lane):
+        assert LoadShedder(lane).level() == Level.NORMAL
+
+    def test_it_records_decisions(self):
+        shedder = LoadShedder()
+
+        shedder.record("coalesced", 3)
+        shedder.record("dropped")
+        shedder.record("dropped")
+
+        assert shedder.decisions == {"coalesced": 3, "dropped": 2}
+
+    def test_it_defers_messages(self):
+        shedder = LoadShedder()
+
+        shedder.defer(sentinel.message_1)
+        shedder.defer(sentinel.message_2)
+
+        assert shedder.take_deferred() == [sentinel.message_1, sentinel.message_2]
+        assert shedder.take_deferred() == []
+        assert shedder.decisions == {"deferred": 2}
+
+    def test_it_drops_the_oldest_deferred_messages(self):
+        shedder = LoadShedder(deferred_size=2)
+
+        for message in (sentinel.message_1, sentinel.message_2, sentinel.message_3):
+            shedder.defer(message)
+
+        assert shedder.take_deferred() == [sentinel.message_2, sentinel.message_3]
+        assert shedder.decisions == {"deferred": 3, "dropped": 1}
+
+    @pytest.fixture
+    def lane(self):
+        return Queue(maxsize=10)
+
+
+class TestParseWatermarks:
+    @pytest.mark.parametrize(
+        "value,expected",
+        (
+            ("0.5 0.75 0.9 off", (0.5, 0.75, 0.9, None)),
+            ("0.5,0.75, 0.9,1", (0.5, 0.75, 0.9, 1.0)),
+            ("off 0.8", (None, 0.8, None, None)),
+            ("", (None, None, None, None)),
+        ),
+    )
+    def test_it(self, value, expected):
+        assert parse_watermarks(value) == expected
+
+    @pytest.mark.parametrize("value", ("0.5 0.6 0.7 0.8 0.9", "half"))
+    def test_it_raises_for_invalid_values(self, value):
+        with pytest.raises(ValueError):
+            parse_watermarks(value)
@@ -1,8 +1,13 @@
+from time import time
 from unittest import mock
 
+import gevent
 import pytest
+from gevent.queue import Empty, Queue
+from h_matchers import Any
 
-from h.streamer import messages, streamer, websocket
+from h.streamer import messages, shedding, streamer, websocket
+from h.streamer.replay import Replay
 from h.streamer.streamer import TOPIC_HANDLERS, UnknownMessageType
 
 
@@ -19,14 +24,26 @@ class TestProcessWorkQueue:
             topic_handlers=TOPIC_HANDLERS,
         )
 
+    def test_it_skips_unwatched_messages_without_a_transaction(
+        self, process_work_queue, message, db, is_unwatched
+    ):
+        is_unwatched.return_value = True
+
+        process_work_queue(queue=[message])
+
+        is_unwatched.assert_called_once_with(message)
+        db.read_only_transaction.assert_not_called()
+        messages.handle_message.assert_not_called()  # pylint:disable=no-member
+
     def test_it_sends_websocket_messages_to_websocket_handle_message(
-        self, process_work_queue, ws_message, session
+        self, process_work_queue, ws_message, db
     ):
         process_work_queue(queue=[ws_message])
 
         websocket.handle_message.assert_called_once_with(  # pylint:disable=no-member
-            ws_message, session
+            ws_message
         )
+        db.read_only_transaction.assert_not_called()
 
     def test_it_raises_UnknownMessageType_for_strange_messages(
         self, process_work_queue
@@ -47,6 +64,183 @@ class TestProcessWorkQueue:
         assert context_manager.__enter__.call_count == len(messages)
         assert context_manager.__exit__.call_count == len(messages)
 
+    def test_it_records_how_long_messages_waited(
+        self, process_work_queue, message, metrics
+    ):
+        message.payload["published_at"] = time() - 2
+
+        process_work_queue(queue=[message])
+
+        metrics.LATENCY_QUEUE_WAIT.record.assert_called_once_with(
+            Any.float().greater_than(2)
+        )
+
+    def test_it_doesnt_record_waits_for_unstamped_messages(
+        self, process_work_queue, metrics
+    ):
+        process_work_queue()
+
+        metrics.LATENCY_QUEUE_WAIT.record.assert_not_called()
+
+    def test_it_keeps_annotation_events_for_replay(
+        self, process_work_queue, is_unwatched, REPLAY_BUFFER
+    ):
+        # Clients which reconnect might want the event even if nobody does now
+        is_unwatched.return_value = True
+        event = messages.Message(topic="annotation", payload={"annotation_id": "id"})
+
+        process_work_queue(queue=[event])
+
+        REPLAY_BUFFER.append.assert_called_once_with(event)
+
+    def test_it_doesnt_keep_other_events_for_replay(
+        self, process_work_queue, REPLAY_BUFFER
+    ):
+        process_work_queue()
+
+        REPLAY_BUFFER.append.assert_not_called()
+
+    def test_it_configures_the_replay_buffer(
+        self, process_work_queue, registry, REPLAY_BUFFER
+    ):
+        registry.settings.update(
+            {"h.streamer.replay_size": "10", "h.streamer.replay_ttl": "60"}
+        )
+
+        process_work_queue()
+
+        assert REPLAY_BUFFER.size == 10
+        assert REPLAY_BUFFER.ttl == 60
+        assert not REPLAY_BUFFER.partial
+
+    def test_it_makes_the_replay_buffer_partial_with_topic_routing(
+        self, process_work_queue, registry, REPLAY_BUFFER
+    ):
+        registry.settings["h.realtime.annotation_routing"] = "topic"
+
+        process_work_queue()
+
+        assert REPLAY_BUFFER.partial
+
+    def test_it_configures_the_nipsa_cache(
+        self, process_work_queue, registry, FLAGGED_USERS
+    ):
+        registry.settings["h.streamer.nipsa_ttl"] = "60"
+
+        process_work_queue()
+
+        assert FLAGGED_USERS.ttl == 60
+
+    def test_it_replays_events(
+        self, process_work_queue, registry, session, REPLAY_BUFFER, db
+    ):
+        replay_ = Replay(message=mock.sentinel.message, since=1234.5)
+
+        process_work_queue(queue=[replay_])
+
+        messages.replay_annotation_events.assert_called_once_with(  # pylint:disable=no-member
+            replay_, REPLAY_BUFFER, registry, session
+        )
+        context_manager = db.read_only_transaction.return_value
+        assert context_manager.__enter__.call_count == 1
+
+    def test_it_processes_batches(
+        self, process_work_queue, registry, session, process_batch, message, ws_message
+    ):
+        registry.settings["h.streamer.batch_size"] = "2"
+
+        process_work_queue(queue=self.queue_of(message, ws_message, message))
+
+        assert process_batch.call_args_list == [
+            mock.call(registry, session, [message, ws_message]),
+            mock.call(registry, session, [message]),
+        ]
+
+    def test_batches_only_wait_for_the_first_message(
+        self, process_work_queue, registry, session, process_batch, message
+    ):
+        registry.settings["h.streamer.batch_size"] = "2"
+        queue = Queue()
+        queue.put(message)
+
+        worker = gevent.spawn(process_work_queue, queue)
+        gevent.sleep(0)
+
+        process_batch.assert_called_once_with(registry, session, [message])
+        worker.kill()
+
+    def test_it_processes_large_batches_by_document_when_shedding_load(
+        self,
+        process_work_queue,
+        registry,
+        session,
+        process_batch,
+        message,
+        ws_message,
+        SHEDDER,
+    ):
+        SHEDDER.level.return_value = shedding.Level.COALESCE
+
+        process_work_queue(queue=self.queue_of(message, ws_message, message))
+
+        process_batch.assert_called_once_with(
+            registry, session, [message, ws_message, message], by_document=True
+        )
+
+    def test_it_sends_deferred_events_once_the_queue_has_drained(
+        self, process_work_queue, registry, session, SHEDDER, send_deferred
+    ):
+        SHEDDER.deferred = [mock.sentinel.event]
+
+        process_work_queue()
+
+        send_deferred.assert_called_once_with(registry, session)
+
+    def test_it_doesnt_send_deferred_events_while_shedding_load(
+        self, process_work_queue, SHEDDER, send_deferred
+    ):
+        SHEDDER.deferred = [mock.sentinel.event]
+        SHEDDER.level.return_value = shedding.Level.DEFER
+
+        process_work_queue()
+
+        send_deferred.assert_not_called()
+
+    @staticmethod
+    def queue_of(*msgs):
+        """Get a queue of `msgs`, which stops iterating once it's empty."""
+        queue = mock.create_autospec(Queue, instance=True)
+        msgs = list(msgs)
+
+        def iterate():
+            while msgs:
+                yield msgs.pop(0)
+
+        def get_nowait():
+            if not msgs:
+                raise Empty()
+            return msgs.pop(0)
+
+        queue.__iter__.side_effect = iterate
+        queue.get_nowait.side_effect = get_nowait
+        return queue
+
+    @pytest.fixture
+    def send_deferred(self, patch):
+        return patch("h.streamer.streamer.send_deferred")
+
+    @pytest.fixture
+    def metrics(self, patch):
+        return patch("h.streamer.streamer.metrics")
+
+    @pytest.fixture(autouse=True)
+    def FLAGGED_USERS(self, patch):
+        return patch("h.streamer.streamer.nipsa.FLAGGED_USERS")
+
+    @pytest.fixture
+    def process_batch(self, patch):
+        return patch("h.streamer.streamer.process_batch")
+
     @pytest.fixture
     def process_work_queue(self, registry, message):
         def process_work_queue(queue=None):
@@ -56,7 +250,7 @@ class TestProcessWorkQueue:
 
     @pytest.fixture
     def message(self):
-        return messages.Message(topic="foo", payload="bar")
+        return messages.Message(topic="foo", payload={"foo": "bar"})
 
     @pytest.fixture
     def ws_message(self):
@@ -76,6 +270,159 @@ class TestProcessWorkQueue:
         db.get_session.return_value = session
         return db
 
+    @pytest.fixture(autouse=True)
+    def is_unwatched(self, patch):
+        is_unwatched = patch("h.streamer.messages.is_unwatched")
+        is_unwatched.return_value = False
+        return is_unwatched
+
+    @pytest.fixture(autouse=True)
+    def websocket_handle_message(self, patch):
+        return patch("h.streamer.websocket.handle_message")
+
+    @pytest.fixture(autouse=True)
+    def replay_annotation_events(self, patch):
+        return patch("h.streamer.messages.replay_annotation_events")
+
+    @pytest.fixture(autouse=True)
+    def messages_handle_message(self, patch):
+        return patch("h.streamer.messages.handle_message")
+
+
+class TestProcessBatch:
+    def test_it_handles_annotation_events_together(
+        self, registry, session, db, annotation_event
+    ):
+        other_event = messages.Message(
+            topic="annotation", payload={"annotation_id": "other"}
+        )
+
+        streamer.process_batch(
+            registry, session, [annotation_event, other_event, annotation_event]
+        )
+
+        messages.handle_annotation_events.assert_called_once_with(  # pylint:disable=no-member
+            [annotation_event, other_event], registry, session, by_document=False
+        )
+        context_manager = db.read_only_transaction.return_value
+        assert context_manager.__enter__.call_count == 1
+
+    def test_it_can_merge_notifications_by_document(
+        self, registry, session, annotation_event
+    ):
+        streamer.process_batch(registry, session, [annotation_event], by_document=True)
+
+        messages.handle_annotation_events.assert_called_once_with(  # pylint:disable=no-member
+            [annotation_event], registry, session, by_document=True
+        )
+
+    def test_it_skips_unwatched_annotation_events(
+        self, registry, session, annotation_event, is_unwatched
+    ):
+        is_unwatched.return_value = True
+
+        streamer.process_batch(registry, session, [annotation_event])
+
+        messages.handle_annotation_events.assert_not_called()  # pylint:disable=no-member
+
+    def test_it_handles_other_messages_individually(self, registry, session):
+        user_event = messages.Message(topic="user", payload={})
+        ws_message = websocket.Message(socket=mock.sentinel.SOCKET, payload="bar")
+
+        streamer.process_batch(registry, session, [user_event, ws_message])
+
+        messages.handle_message.assert_called_once_with(  # pylint:disable=no-member
+            user_event, registry, session, TOPIC_HANDLERS
+        )
+        websocket.handle_message.assert_called_once_with(  # pylint:disable=no-member
+            ws_message
+        )
+        messages.handle_annotation_events.assert_not_called()  # pylint:disable=no-member
+
+    def test_it_processes_messages_in_order(
+        self,
+        registry,
+        session,
+        annotation_event,
+        handle_annotation_events,
+        messages_handle_message,
+    ):
+        user_event = messages.Message(topic="user", payload={})
+        other_event = messages.Message(
+            topic="annotation", payload={"annotation_id": "other"}
+        )
+        calls = mock.Mock()
+        calls.attach_mock(handle_annotation_events, "handle_annotation_events")
+        calls.attach_mock(messages_handle_message, "handle_message")
+
+        streamer.process_batch(
+            registry, session, [annotation_event, user_event, other_event]
+        )
+
+        assert calls.mock_calls == [
+            mock.call.handle_annotation_events(
+                [annotation_event], registry, session, by_document=False
+            ),
+            mock.call.handle_message(user_event, registry, session, TOPIC_HANDLERS),
+            mock.call.handle_annotation_events(
+                [other_event], registry, session, by_document=False
+            ),
+        ]
+
+    def test_it_records_metrics(self, registry, session, annotation_event, metrics):
+        streamer.process_batch(registry, session, [annotation_event] * 3)
+
+        metrics.WORK_QUEUE_BATCH_SIZE.record.assert_called_once_with(3)
+        metrics.WORK_QUEUE_DRAIN_TIME.record.assert_called_once_with(Any.float())
+
+    def test_it_keeps_annotation_events_for_replay(
+        self, registry, session, annotation_event, REPLAY_BUFFER
+    ):
+        streamer.process_batch(registry, session, [annotation_event] * 2)
+
+        assert REPLAY_BUFFER.append.call_args_list == [mock.call(annotation_event)] * 2
+
+    def test_it_records_how_long_annotation_events_waited(
+        self, registry, session, annotation_event, metrics
+    ):
+        annotation_event.payload["published_at"] = time() - 2
+
+        streamer.process_batch(registry, session, [annotation_event])
+
+        metrics.LATENCY_QUEUE_WAIT.record.assert_called_once_with(
+            Any.float().greater_than(2)
+        )
+
+    @pytest.fixture
+    def annotation_event(self):
+        return messages.Message(topic="annotation", payload={"annotation_id": "id"})
+
+    @pytest.fixture
+    def registry(self, pyramid_request):
+        return pyramid_request.registry
+
+    @pytest.fixture
+    def session(self):
+        return mock.sentinel.session
+
+    @pytest.fixture(autouse=True)
+    def db(self, patch):
+        return patch("h.streamer.streamer.db")
+
+    @pytest.fixture(autouse=True)
+    def metrics(self, patch):
+        return patch("h.streamer.streamer.metrics")
+
+    @pytest.fixture(autouse=True)
+    def is_unwatched(self, patch):
+        is_unwatched = patch("h.streamer.messages.is_unwatched")
+        is_unwatched.return_value = False
+        return is_unwatched
+
+    @pytest.fixture(autouse=True)
+    def handle_annotation_events(self, patch):
+        return patch("h.streamer.messages.handle_annotation_events")
+
     @pytest.fixture(autouse=True)
     def websocket_handle_message(self, patch):
         return patch("h.streamer.websocket.handle_message")
@@ -83,3 +430,86 @@ class TestProcessWorkQueue:
     @pytest.fixture(autouse=True)
     def messages_handle_message(self, patch):
         return patch("h.streamer.messages.handle_message")
+
+
+class TestSendDeferred:
+    def test_it_sends_the_deferred_events_to_anonymous_sockets(
+        self, registry, session, db, SHEDDER, sockets, handle_annotation_events
+    ):
+        events = [
+            messages.Message(topic="annotation", payload={"annotation_id": id_})
+            for id_ in ("a", "b", "a")
+        ]
+        SHEDDER.take_deferred.return_value = events
+
+        streamer.send_deferred(registry, session)
+
+        handle_annotation_events.assert_called_once_with(
+            [events[2], events[1]], registry, session, sockets={sockets[1]}
+        )
+        db.read_only_transaction.assert_called_once_with(session)
+
+    def test_it_does_nothing_without_anonymous_sockets(
+        self, registry, session, SHEDDER, sockets, handle_annotation_events
+    ):
+        sockets[1].authenticated_userid = "acct:other@example.com"
+        SHEDDER.take_deferred.return_value = [
+            messages.Message(topic="annotation", payload={"annotation_id": "a"})
+        ]
+
+        streamer.send_deferred(registry, session)
+
+        SHEDDER.take_deferred.assert_called_once_with()
+        handle_annotation_events.assert_not_called()
+
+    @pytest.fixture
+    def sockets(self, patch):
+        sockets = [mock.Mock(), mock.Mock()]
+        sockets[0].authenticated_userid = "acct:user@example.com"
+        sockets[1].authenticated_userid = None
+
+        WebSocket = patch("h.streamer.streamer.websocket.WebSocket")
+        WebSocket.instances = sockets
+        return sockets
+
+    @pytest.fixture
+    def registry(self, pyramid_request):
+        return pyramid_request.registry
+
+    @pytest.fixture
+    def session(self):
+        return mock.sentinel.session
+
+    @pytest.fixture(autouse=True)
+    def db(self, patch):
+        return patch("h.streamer.streamer.db")
+
+    @pytest.fixture
+    def handle_annotation_events(self, patch):
+        return patch("h.streamer.messages.handle_annotation_events")
+
+
+class TestWorkQueue:
+    @pytest.mark.parametrize(
+        "msg,lane",
+        (
+            (websocket.Message(socket=mock.sentinel.socket, payload={}), "control"),
+            (messages.Message(topic="annotation", payload={}), "events"),
+            (Replay(message=mock.sentinel.message, since=0), "events"),
+        ),
+    )
+    def test_it_puts_client_messages_in_their_own_lane(self, msg, lane):
+        assert streamer._lane_for(msg) == lane  # pylint:disable=protected-access
+
+
+@pytest.fixture(autouse=True)
+def SHEDDER(patch):
+    SHEDDER = patch("h.streamer.shedding.SHEDDER")
+    SHEDDER.level.return_value = shedding.Level.NORMAL
+    SHEDDER.deferred = []
+    return SHEDDER
+
+
+@pytest.fixture(autouse=True)
+def REPLAY_BUFFER(patch):
+    return patch("h.streamer.streamer.REPLAY_BUFFER")
@@ -1,4 +1,8 @@
-from h.streamer import streamer, views
+import pytest
+from pyramid.httpexceptions import HTTPNotFound
+from pyramid.response import Response
+
+from h.streamer import shedding, streamer, views
 
 
 def test_websocket_view_adds_auth_state_to_environ(pyramid_config, pyramid_request):
@@ -19,3 +23,101 @@ def test_websocket_view_adds_work_queue_to_environ(pyramid_request):
     env = pyramid_request.environ
 
     assert env["h.ws.streamer_work_queue"] == streamer.WORK_QUEUE
+
+
+def test_websocket_view_adds_send_queue_settings_to_environ(pyramid_request):
+    pyramid_request.registry.settings.update(
+        {"h.streamer.send_queue_size": "32", "h.streamer.send_queue_overflow": "drop"}
+    )
+    pyramid_request.get_response = lambda _: None
+
+    views.websocket_view(pyramid_request)
+    env = pyramid_request.environ
+
+    assert env["h.ws.send_queue_size"] == 32
+    assert env["h.ws.send_queue_overflow"] == "drop"
+
+
+def test_websocket_view_refuses_connections_when_offline(pyramid_request, SHEDDER):
+    SHEDDER.level.return_value = shedding.Level.OFFLINE
+
+    response = views.websocket_view(pyramid_request)
+
+    assert response.status_code == 429
+    SHEDDER.record.assert_called_once_with("refused")
+
+
+@pytest.fixture(autouse=True)
+def SHEDDER(patch):
+    SHEDDER = patch("h.streamer.views.shedding.SHEDDER")
+    SHEDDER.level.return_value = shedding.Level.NORMAL
+    return SHEDDER
+
+
+class TestDebugLatency:
+    @pytest.mark.parametrize("remote_addr", ("127.0.0.1", "::1"))
+    def test_it_reports_latency(self, pyramid_request, latency_report, remote_addr):
+        pyramid_request.remote_addr = remote_addr
+
+        assert views.debug_latency(pyramid_request) == latency_report.return_value
+
+    def test_it_is_only_available_locally(self, pyramid_request):
+        pyramid_request.remote_addr = "10.0.0.1"
+
+        with pytest.raises(HTTPNotFound):
+            views.debug_latency(pyramid_request)
+
+    @pytest.fixture
+    def latency_report(self, patch):
+        return patch("h.streamer.views.metrics.latency_report")
+
+
+class TestWebsocketViewDeflate:
+    def test_it_negotiates_permessage_deflate(self, pyramid_request, settings):
+        response = views.websocket_view(pyramid_request)
+        env = pyramid_request.environ
+
+        assert response.headers["Sec-WebSocket-Extensions"] == (
+            "permessage-deflate; server_no_context_takeover"
+        )
+        assert env["h.ws.deflate_level"] == 6
+        assert env["h.ws.deflate_min_size"] == 512
+
+    def test_it_uses_the_default_min_size(self, pyramid_request, settings):
+        del settings["h.streamer.deflate_min_size"]
+
+        views.websocket_view(pyramid_request)
+
+        assert pyramid_request.environ["h.ws.deflate_min_size"] == 1024
+
+    def test_it_doesnt_negotiate_if_disabled(self, pyramid_request, settings):
+        del settings["h.streamer.deflate_level"]
+
+        response = views.websocket_view(pyramid_request)
+
+        assert "Sec-WebSocket-Extensions" not in response.headers
+        assert "h.ws.deflate_level" not in pyramid_request.environ
+
+    def test_it_doesnt_negotiate_if_not_offered(self, pyramid_request):
+        del pyramid_request.headers["Sec-WebSocket-Extensions"]
+
+        response = views.websocket_view(pyramid_request)
+
+        assert "Sec-WebSocket-Extensions" not in response.headers
+        assert "h.ws.deflate_level" not in pyramid_request.environ
+
+    @pytest.fixture
+    def settings(self, pyramid_request):
+        settings = pyramid_request.registry.settings
+        settings.update(
+            {"h.streamer.deflate_level": "6", "h.streamer.deflate_min_size": "512"}
+        )
+        return settings
+
+    @pytest.fixture
+    def pyramid_request(self, pyramid_request):
+        pyramid_request.headers[
+            "Sec-WebSocket-Extensions"
+        ] = "permessage-deflate; client_max_window_bits"
+        pyramid_request.get_response = lambda _: Response(status=101)
+        return pyramid_request
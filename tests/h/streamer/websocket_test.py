@@ -1,17 +1,30 @@
+import tracemalloc
 from collections import namedtuple
 from unittest import mock
+from unittest.mock import create_autospec
 
+import gevent
 import pytest
 from gevent.queue import Queue
 from h_matchers import Any
 from jsonschema import ValidationError
 from pyramid import security
+from ws4py.framing import OPCODE_TEXT, Frame
+from ws4py.messaging import CloseControlMessage
+from ws4py.websocket import WebSocket as _WebSocket
 
-from h.streamer import websocket
+from h.streamer import deflate, websocket
+from h.streamer.filter import SocketFilter
+from h.streamer.replay import Replay
 
 FakeMessage = namedtuple("FakeMessage", ["data"])
 
 
+class FakeSock:
+    def sendall(self, data):
+        ...
+
+
 class TestMessage:
     def test_reply_adds_reply_to(self, socket):
         """Adds an appropriate `reply_to` field to the sent message."""
@@ -83,6 +96,17 @@ class TestWebSocket:
         # A second closure (however unusual) should not raise
         client1.closed(1000)
 
+    def test_it_keeps_its_state_out_of_the_instance_dict(self, client):
+        client.opened()
+
+        # Only ws4py's own attributes should be in the dict, ours are in slots
+        assert set(vars(client)) == set(vars(_WebSocket(FakeSock())))
+
+    def test_removes_filter_when_closed(self, client, SocketFilter):
+        client.closed(1000)
+
+        SocketFilter.remove_filter.assert_called_once_with(client)
+
     def test_enqueues_incoming_messages(self, client, queue):
         """Valid messages are pushed onto the queue."""
         message = FakeMessage('{"foo":"bar"}')
@@ -132,27 +156,332 @@ class TestWebSocket:
 
     def test_socket_sets_auth_data_from_environ(self, client):
         assert client.authenticated_userid == "janet"
-        assert client.effective_principals == [
+        assert client.effective_principals == {
             security.Everyone,
             security.Authenticated,
             "group:__world__",
-        ]
+        }
 
-    def test_socket_send_json(self, client, fake_socket_send):
-        payload = {"foo": "bar"}
+    def test_socket_doesnt_keep_the_environ(self, client):
+        assert client.environ is None
 
-        client.send_json(payload)
+    def test_socket_principals_are_shared(self, fake_environ):
+        client1 = websocket.WebSocket(mock.sentinel.sock1, environ=fake_environ)
+        client2 = websocket.WebSocket(mock.sentinel.sock2, environ=fake_environ)
 
-        fake_socket_send.assert_called_once_with(client, '{"foo": "bar"}')
+        assert client1.effective_principals is client2.effective_principals
+
+    def test_socket_send_json(self, client):
+        client.send_json({"foo": "bar"})
+
+        assert client.send_queue_depth == 1
+        # pylint:disable=protected-access
+        assert client._send_queue.get_nowait() == b"\x81\x0e" + b'{"foo": "bar"}'
 
     def test_socket_send_json_skips_when_terminated(
-        self, client, fake_socket_send, fake_socket_terminated
+        self, client, fake_socket_terminated
     ):
         fake_socket_terminated.return_value = True
 
         client.send_json({"foo": "bar"})
 
-        assert not fake_socket_send.called
+        assert not client.send_queue_depth
+
+    def test_socket_send_frame(self, client):
+        client.send_frame(websocket.Frame(b"frame"))
+
+        assert client.send_queue_depth == 1
+
+    def test_socket_send_frame_skips_when_terminated(
+        self, client, fake_socket_terminated
+    ):
+        fake_socket_terminated.return_value = True
+
+        client.send_frame(websocket.Frame(b"frame"))
+
+        assert not client.send_queue_depth
+
+    def test_socket_send_frame_compresses_for_deflate_clients(self, fake_environ):
+        fake_environ.update({"h.ws.deflate_level": 6, "h.ws.deflate_min_size": 8})
+        client = websocket.WebSocket(mock.sentinel.sock, environ=fake_environ)
+        frame = websocket.Frame(b"a_longer_frame")
+
+        client.send_frame(frame)
+
+        # pylint:disable=protected-access
+        assert client._send_queue.get_nowait() == frame.build(6)
+
+    def test_socket_send_frame_doesnt_compress_small_frames(self, fake_environ):
+        fake_environ.update({"h.ws.deflate_level": 6, "h.ws.deflate_min_size": 8})
+        client = websocket.WebSocket(mock.sentinel.sock, environ=fake_environ)
+        frame = websocket.Frame(b"frame")
+
+        client.send_frame(frame)
+
+        # pylint:disable=protected-access
+        assert client._send_queue.get_nowait() == frame.build()
+
+    def test_socket_inflates_compressed_messages(self, fake_environ, queue):
+        fake_environ["h.ws.deflate_level"] = 6
+        client = websocket.WebSocket(mock.sentinel.sock, environ=fake_environ)
+        frame = Frame(
+            opcode=OPCODE_TEXT,
+            body=deflate.deflate(b'{"type": "ping"}', 6),
+            masking_key=b"mask",
+            fin=1,
+            rsv1=1,
+        ).build()
+
+        # Split the frame to check partial frames are buffered
+        assert client.process(frame[:5])
+        assert client.process(frame[5:])
+
+        assert queue.get_nowait().payload == {"type": "ping"}
+
+    def test_socket_closes_when_a_message_is_too_big(
+        self, fake_environ, queue, fake_socket_close
+    ):
+        fake_environ["h.ws.deflate_level"] = 6
+        client = websocket.WebSocket(mock.sentinel.sock, environ=fake_environ)
+        frame = Frame(
+            opcode=OPCODE_TEXT,
+            body=deflate.deflate(b" " * (deflate.MAX_MESSAGE_SIZE + 1), 6),
+            masking_key=b"mask",
+            fin=1,
+            rsv1=1,
+        ).build()
+
+        assert not client.process(frame)
+
+        fake_socket_close.assert_called_once_with(
+            client, code=1009, reason="message too big"
+        )
+        assert queue.empty()
+
+    def test_request_replay(self, client, queue):
+        message = websocket.Message(socket=client, payload={"id": 1})
+
+        client.request_replay(message, 1234.5)
+
+        assert queue.get_nowait() == Replay(message=message, since=1234.5)
+
+    def test_request_replay_when_the_queue_is_full(self, client, queue):
+        queue.put(mock.sentinel.other_work)
+        message = create_autospec(websocket.Message, instance=True)
+
+        client.request_replay(message, 1234.5)
+
+        message.reply.assert_called_once_with({"type": "replay", "complete": False})
+
+    def test_socket_sends_queued_frames(self, fake_environ, fake_socket_write):
+        fake_environ["h.ws.send_queue_size"] = 2
+        client = websocket.WebSocket(mock.sentinel.sock, environ=fake_environ)
+        client.opened()
+        client.send_frame(websocket.Frame(b"frame_1"))
+        client.send_frame(websocket.Frame(b"frame_2"))
+
+        gevent.sleep(0)
+
+        assert fake_socket_write.call_args_list == [
+            mock.call(client, websocket.Frame(b"frame_1").build()),
+            mock.call(client, websocket.Frame(b"frame_2").build()),
+        ]
+        assert not client.send_queue_depth
+
+    def test_opened_starts_heartbeats(self, client, heartbeat):
+        client.opened()
+
+        heartbeat.HEARTBEATS.add.assert_called_once_with(client)
+
+    def test_process_records_when_anything_was_received(self, client, monotonic):
+        monotonic.return_value = 1234
+
+        client.process(b"")
+
+        assert client.last_received == 1234
+
+    def test_writes_dont_interleave(self, fake_environ):
+        written = []
+
+        def sendall(data):
+            # Block partway through writing, as a slow client would make us
+            middle = len(data) // 2
+            written.append(data[:middle])
+            gevent.sleep(0)
+            written.append(data[middle:])
+
+        sock = mock.Mock(spec_set=["sendall"], sendall=sendall)
+        client = websocket.WebSocket(sock, environ=fake_environ)
+
+        gevent.joinall(
+            [
+                gevent.spawn(client._write, b"frame_1"),
+                gevent.spawn(client._write, b"frame_2"),
+            ]
+        )
+
+        assert b"".join(written) == b"frame_1frame_2"
+
+    def test_heartbeat_pings_the_client(self, client, fake_socket_write):
+        client.opened()
+
+        client.heartbeat()
+        gevent.sleep(0)
+
+        fake_socket_write.assert_called_once_with(client, websocket._PING)
+
+    def test_heartbeat_stops_sending_once_idle(self, fake_environ, fake_socket_write):
+        fake_environ["h.ws.send_queue_size"] = 3
+        client = websocket.WebSocket(mock.sentinel.sock, environ=fake_environ)
+        client.opened()
+        client.send_frame(websocket.Frame(b"frame"))
+        gevent.sleep(0)
+
+        # Something was sent since the last heartbeat
+        client.heartbeat()
+        gevent.sleep(0)
+        assert client._sender is not None
+
+        client.heartbeat()
+        gevent.sleep(0)
+
+        assert client._sender is None
+        assert client._send_queue is None
+        assert fake_socket_write.call_args_list[-1] == mock.call(
+            client, websocket._PING
+        )
+
+    def test_socket_sends_frames_queued_after_stopping(
+        self, fake_environ, fake_socket_write
+    ):
+        fake_environ["h.ws.send_queue_size"] = 3
+        client = websocket.WebSocket(mock.sentinel.sock, environ=fake_environ)
+        client.opened()
+        client.heartbeat()
+
+        client.send_frame(websocket.Frame(b"frame"))
+        gevent.sleep(0)
+
+        assert fake_socket_write.call_args_list == [
+            mock.call(client, websocket._PING),
+            mock.call(client, websocket.Frame(b"frame").build()),
+        ]
+        assert client._sender is None
+
+    def test_socket_restarts_sending_after_stopping(self, client, fake_socket_write):
+        client.opened()
+        client.heartbeat()
+        gevent.sleep(0)
+
+        client.send_frame(websocket.Frame(b"frame"))
+        gevent.sleep(0)
+
+        fake_socket_write.assert_called_with(client, websocket.Frame(b"frame").build())
+
+    def test_abort(self, client, fake_close_connection):
+        client.abort()
+
+        assert client.server_terminated
+        fake_close_connection.assert_called_once_with(client)
+
+    def test_close_queued(self, client, fake_socket_write):
+        client.opened()
+
+        client.close_queued(reason="Bye")
+        gevent.sleep(0)
+
+        assert client.server_terminated
+        fake_socket_write.assert_called_once_with(
+            client, CloseControlMessage(reason="Bye").single(mask=False)
+        )
+
+    def test_close_queued_doesnt_send_anything_else(self, client, fake_socket_write):
+        client.opened()
+        client.close_queued()
+
+        client.send_frame(websocket.Frame(b"frame"))
+        gevent.sleep(0)
+
+        fake_socket_write.assert_called_once()
+
+    def test_close_queued_drops_the_connection_if_called_twice(
+        self, client, fake_close_connection
+    ):
+        client.close_queued()
+        client.close_queued()
+
+        fake_close_connection.assert_called_once_with(client)
+
+    def test_close_queued_drops_the_connection_if_the_queue_is_full(
+        self, client, fake_close_connection
+    ):
+        client.send_frame(websocket.Frame(b"frame"))
+
+        client.close_queued()
+
+        fake_close_connection.assert_called_once_with(client)
+
+    def test_socket_waits_until_open_to_send(self, client, fake_socket_write):
+        client.send_frame(websocket.Frame(b"frame"))
+        gevent.sleep(0)
+        fake_socket_write.assert_not_called()
+
+        client.opened()
+        gevent.sleep(0)
+
+        fake_socket_write.assert_called_once_with(
+            client, websocket.Frame(b"frame").build()
+        )
+
+    def test_socket_stops_sending_when_the_connection_goes(
+        self, client, fake_socket_write
+    ):
+        fake_socket_write.side_effect = RuntimeError
+        client.opened()
+        client.send_frame(websocket.Frame(b"frame_1"))
+
+        gevent.sleep(0)
+        client.send_frame(websocket.Frame(b"frame_2"))
+        gevent.sleep(0)
+
+        fake_socket_write.assert_called_once_with(
+            client, websocket.Frame(b"frame_1").build()
+        )
+
+    def test_socket_stops_sending_when_closed(self, client, fake_socket_write):
+        client.opened()
+
+        client.closed(1000)
+        client.send_frame(websocket.Frame(b"frame"))
+        gevent.sleep(0)
+
+        fake_socket_write.assert_not_called()
+
+    def test_socket_drops_frames_when_the_send_queue_is_full(
+        self, fake_environ, fake_close_connection
+    ):
+        fake_environ["h.ws.send_queue_overflow"] = "drop"
+        client = websocket.WebSocket(mock.sentinel.sock, environ=fake_environ)
+
+        client.send_frame(websocket.Frame(b"frame_1"))
+        client.send_frame(websocket.Frame(b"frame_2"))
+
+        assert client.send_queue_depth == 1
+        assert websocket.WebSocket.send_queue_overflows["drop"] == 1
+        fake_close_connection.assert_not_called()
+
+    def test_socket_closes_when_the_send_queue_is_full(
+        self, fake_environ, fake_close_connection
+    ):
+        fake_environ["h.ws.send_queue_overflow"] = "close"
+        client = websocket.WebSocket(mock.sentinel.sock, environ=fake_environ)
+
+        client.send_frame(websocket.Frame(b"frame_1"))
+        client.send_frame(websocket.Frame(b"frame_2"))
+
+        assert websocket.WebSocket.send_queue_overflows["close"] == 1
+        assert client.server_terminated
+        fake_close_connection.assert_called_once_with(client)
 
     @pytest.fixture(autouse=True)
     def with_no_socket_instances(self):
@@ -160,6 +489,10 @@ class TestWebSocket:
         # created and can couple different tests together
         websocket.WebSocket.instances.clear()
 
+    @pytest.fixture(autouse=True)
+    def with_no_send_queue_overflows(self):
+        websocket.WebSocket.send_queue_overflows.clear()
+
     @pytest.fixture
     def client(self, fake_environ):
         sock = mock.Mock(spec_set=["sendall"])
@@ -167,7 +500,7 @@ class TestWebSocket:
 
     @pytest.fixture
     def queue(self):
-        return Queue()
+        return Queue(maxsize=1)
 
     @pytest.fixture
     def fake_environ(self, queue):
@@ -180,20 +513,120 @@ class TestWebSocket:
             ],
             "h.ws.registry": mock.sentinel.registry,
             "h.ws.streamer_work_queue": queue,
+            "h.ws.send_queue_size": 1,
+            "h.ws.send_queue_overflow": "close",
         }
 
+    @pytest.fixture
+    def SocketFilter(self, patch):
+        return patch("h.streamer.websocket.SocketFilter")
+
     @pytest.fixture
     def fake_socket_close(self, patch):
         return patch("h.streamer.websocket.WebSocket.close")
 
     @pytest.fixture
-    def fake_socket_send(self, patch):
-        return patch("h.streamer.websocket.WebSocket.send")
+    def fake_close_connection(self, patch):
+        return patch("h.streamer.websocket.WebSocket.close_connection")
+
+    @pytest.fixture
+    def fake_socket_write(self, patch):
+        return patch("h.streamer.websocket.WebSocket._write")
 
     @pytest.fixture
     def fake_socket_terminated(self, patch):
         return patch("h.streamer.websocket.WebSocket.terminated")
 
+    @pytest.fixture(autouse=True)
+    def heartbeat(self, patch):
+        return patch("h.streamer.websocket.heartbeat")
+
+    @pytest.fixture
+    def monotonic(self, patch):
+        return patch("h.streamer.websocket.monotonic")
+
+
+@pytest.mark.skip("Only of use during development")
+class TestWebSocketMemory:  # pragma: no cover
+    @pytest.mark.parametrize("connections", (1000, 10000))
+    def test_memory_per_idle_connection(self, environ, connections):
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+
+        sockets = []
+        for number in range(connections):
+            socket = websocket.WebSocket(FakeSock(), environ=dict(environ))
+            socket.opened()
+            SocketFilter.set_filter(
+                socket,
+                {
+                    "match_policy": "include_any",
+                    "actions": {},
+                    "clauses": [
+                        {
+                            "field": "/uri",
+                            "operator": "one_of",
+                            "value": [f"https://example.com/{number % 100}"],
+                        }
+                    ],
+                },
+            )
+            sockets.append(socket)
+        gevent.sleep(0)
+
+        memory = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+        print(f"{connections} connections: {memory / connections:.0f} bytes each")
+
+    @pytest.fixture
+    def environ(self):
+        # Something like the WSGI environ of a real websocket connection
+        environ = {f"HTTP_HEADER_{number}": "x" * 40 for number in range(20)}
+        environ.update(
+            {
+                "h.ws.authenticated_userid": None,
+                "h.ws.effective_principals": [security.Everyone],
+                "h.ws.streamer_work_queue": Queue(),
+            }
+        )
+        return environ
+
+
+class TestJSONFrame:
+    def test_it_builds_an_unmasked_text_frame(self):
+        frame = websocket.json_frame({"foo": "bar"})
+
+        # FIN bit and text opcode, then an unmasked 14 byte length
+        assert frame.build() == b"\x81\x0e" + b'{"foo": "bar"}'
+
+    def test_it_builds_a_compressed_text_frame(self):
+        frame = websocket.json_frame({"foo": "bar"})
+
+        compressed = frame.build(deflate_level=6)
+
+        # FIN bit, RSV1 for compression and text opcode
+        assert compressed[0] == 0xC1
+        assert compressed[2:] == deflate.deflate(b'{"foo": "bar"}', 6)
+
+    @pytest.mark.parametrize("deflate_level", (None, 6))
+    def test_it_builds_each_variant_once(self, deflate_level):
+        frame = websocket.json_frame({"foo": "bar"})
+
+        assert frame.build(deflate_level) is frame.build(deflate_level)
+
+
+class TestInternPrincipals:
+    def test_it_returns_a_shared_principal_set(self):
+        principals = websocket.intern_principals(["a", "b"])
+
+        assert isinstance(principals, websocket.PrincipalSet)
+        assert principals == {"a", "b"}
+        assert websocket.intern_principals(["b", "a", "a"]) is principals
+
+    def test_it_returns_different_sets_for_different_principals(self):
+        assert websocket.intern_principals(["a"]) != websocket.intern_principals(["b"])
+
 
 @pytest.mark.usefixtures("handlers")
 class TestHandleMessage:
@@ -285,6 +718,7 @@ class TestHandleFilterMessage:
         websocket.handle_filter_message(message)
 
         SocketFilter.set_filter.assert_called_once_with(socket, filter_)
+        assert socket.filter_received
 
     def test_missing_filter_error(self, socket):
         message = websocket.Message(socket=socket, payload={"type": "filter"})
@@ -306,6 +740,30 @@ class TestHandleFilterMessage:
 
         mock_reply.assert_called_once_with(Any.dict.containing(["error"]), ok=False)
 
+    def test_requests_a_replay(self, socket, SocketFilter):
+        message = websocket.Message(
+            socket=socket, payload={"filter": self.FILTER, "since": 1234.5}
+        )
+
+        websocket.handle_filter_message(message)
+
+        SocketFilter.set_filter.assert_called_once_with(socket, self.FILTER)
+        socket.request_replay.assert_called_once_with(message, 1234.5)
+
+    @pytest.mark.usefixtures("SocketFilter")
+    def test_invalid_since_error(self, socket):
+        message = websocket.Message(
+            socket=socket, payload={"filter": self.FILTER, "since": "yesterday"}
+        )
+
+        with mock.patch.object(websocket.Message, "reply") as mock_reply:
+            websocket.handle_filter_message(message)
+
+        mock_reply.assert_called_once_with(Any.dict.containing(["error"]), ok=False)
+        socket.request_replay.assert_not_called()
+
+    FILTER = {"actions": {}, "match_policy": "include_any", "clauses": []}
+
     @pytest.fixture
     def SocketFilter(self, patch):
         return patch("h.streamer.websocket.SocketFilter")
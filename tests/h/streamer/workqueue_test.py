@@ -0,0 +1,86 @@
+import gevent
+import pytest
+from gevent.queue import Empty, Full
+
+from h.streamer.workqueue import Lane, WorkQueue
+
+
+class TestWorkQueue:
+    def test_it_puts_messages_in_their_lanes(self, queue):
+        queue.put("a1")
+        queue.put_nowait("b1")
+        queue.put("b2")
+
+        assert queue.lanes["a"].qsize() == 1
+        assert queue.lanes["b"].qsize() == 2
+        assert queue.qsize() == 3
+        assert not queue.empty()
+
+    def test_put_raises_if_the_lane_is_full(self, queue):
+        queue.put("b1")
+        queue.put("b2")
+        queue.put("b3")
+
+        with pytest.raises(Full):
+            queue.put("b4", timeout=0.01)
+        with pytest.raises(Full):
+            queue.put_nowait("b4")
+
+        # The other lanes are separate
+        queue.put_nowait("a1")
+
+    def test_get_serves_the_lanes_by_weight(self, queue):
+        for message in ("b1", "b2", "b3", "a1", "a2", "a3", "a4", "a5"):
+            queue.put(message)
+
+        messages = [queue.get() for _ in range(8)]
+
+        assert messages == ["a1", "a2", "b1", "a3", "a4", "b2", "a5", "b3"]
+
+    def test_get_skips_empty_lanes(self, queue):
+        for message in ("b1", "b2", "b3"):
+            queue.put(message)
+
+        assert [queue.get_nowait() for _ in range(3)] == ["b1", "b2", "b3"]
+
+    def test_get_raises_if_there_are_no_messages(self, queue):
+        with pytest.raises(Empty):
+            queue.get_nowait()
+        with pytest.raises(Empty):
+            queue.get(timeout=0.01)
+
+        assert queue.empty()
+
+    def test_get_waits_for_a_message(self, queue):
+        getter = gevent.spawn(queue.get)
+        gevent.sleep(0)
+
+        queue.put("b1")
+
+        assert getter.get(timeout=1) == "b1"
+
+    def test_putting_waits_for_room_in_the_lane(self, queue):
+        for message in ("b1", "b2", "b3"):
+            queue.put(message)
+        putter = gevent.spawn(queue.put, "b4")
+        gevent.sleep(0)
+
+        queue.get()
+        putter.join(timeout=1)
+
+        assert list(queue.lanes["b"].queue) == ["b2", "b3", "b4"]
+
+    def test_it_iterates_over_the_messages(self, queue):
+        queue.put("a1")
+        queue.put("b1")
+
+        messages = iter(queue)
+
+        assert (next(messages), next(messages)) == ("a1", "b1")
+
+    @pytest.fixture
+    def queue(self):
+        return WorkQueue(
+            [Lane(name="a", maxsize=10, weight=2), Lane(name="b", maxsize=3, weight=1)],
+            lane_for=lambda message: message[0],
+        )
@@ -66,16 +66,41 @@ class TestAddRendererGlobals:
 
 
 class TestPublishAnnotationEvent:
-    def test_it_publishes_the_realtime_event(self, event):
+    def test_it_publishes_the_realtime_event(self, event, storage, pyramid_request):
         event.request.headers = {"X-Client-Id": "client_id"}
+        annotation = storage.fetch_annotation.return_value
 
         subscribers.publish_annotation_event(event)
 
+        storage.fetch_annotation.assert_called_once_with(
+            pyramid_request.db, event.annotation_id
+        )
+        storage.expand_uri.assert_called_once_with(
+            pyramid_request.db, annotation.target_uri, normalized=True
+        )
         event.request.realtime.publish_annotation.assert_called_once_with(
             {
                 "action": event.action,
                 "annotation_id": event.annotation_id,
                 "src_client_id": "client_id",
+                "group": annotation.groupid,
+                "uris": storage.expand_uri.return_value,
+                "references": annotation.references,
+            }
+        )
+
+    def test_it_publishes_without_routing_keys_for_missing_annotations(
+        self, event, storage
+    ):
+        storage.fetch_annotation.return_value = None
+
+        subscribers.publish_annotation_event(event)
+
+        event.request.realtime.publish_annotation.assert_called_once_with(
+            {
+                "action": event.action,
+                "annotation_id": event.annotation_id,
+                "src_client_id": None,
             }
         )
 
@@ -95,6 +120,7 @@ class TestPublishAnnotationEvent:
     @pytest.fixture
     def event(self, pyramid_request):
         pyramid_request.realtime = mock.Mock()
+        pyramid_request.tm = mock.MagicMock()
         event = AnnotationEvent(pyramid_request, "test_annotation_id", "create")
         return event
 
@@ -0,0 +1,60 @@
+from unittest import mock
+
+import pytest
+
+from h.util.cache import MemoryBackend
+
+
+class TestMemoryBackend:
+    def test_it_gets_and_sets_values(self, backend):
+        backend.set("key", "value")
+
+        assert backend.get("key") == "value"
+        assert backend.get("other_key") is None
+
+    def test_values_expire(self, backend, clock):
+        backend.set("key", "value", ttl=10)
+
+        clock.return_value = 109
+        assert backend.get("key") == "value"
+        clock.return_value = 110
+        assert backend.get("key") is None
+
+    def test_it_drops_the_least_recently_used_values(self, backend):
+        for key in ("key_1", "key_2", "key_3"):
+            backend.set(key, key)
+        backend.get("key_1")
+
+        backend.set("key_4", "key_4")
+
+        assert backend.get("key_2") is None
+        assert [backend.get(key) for key in ("key_1", "key_3", "key_4")] == [
+            "key_1",
+            "key_3",
+            "key_4",
+        ]
+
+    def test_it_deletes_values(self, backend):
+        backend.set("key_1", "value_1")
+        backend.set("key_2", "value_2")
+
+        backend.delete("key_1")
+        backend.delete("missing_key")
+
+        assert backend.get("key_1") is None
+        assert backend.get("key_2") == "value_2"
+
+    def test_it_clears_values(self, backend):
+        backend.set("key", "value")
+
+        backend.clear()
+
+        assert backend.get("key") is None
+
+    @pytest.fixture
+    def clock(self):
+        return mock.Mock(return_value=100)
+
+    @pytest.fixture
+    def backend(self, clock):
+        return MemoryBackend(maxsize=3, clock=clock)
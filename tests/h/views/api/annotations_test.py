@@ -5,6 +5,7 @@ from webob.multidict import MultiDict, NestedMultiDict
 
 from h.schemas import ValidationError
 from h.search.core import SearchResult
+from h.security import Permission
 from h.services.annotation_delete import AnnotationDeleteService
 from h.traversal import AnnotationContext
 from h.views.api import annotations as views
@@ -12,11 +13,21 @@ from h.views.api import annotations as views
 
 @pytest.mark.usefixtures("presentation_service", "search_lib")
 class TestSearch:
-    def test_it_searches(self, pyramid_request, search_lib):
+    @pytest.mark.parametrize("prefetch_replies", (True, False))
+    def test_it_searches(self, pyramid_request, search_lib, prefetch_replies):
+        pyramid_request.feature.flags["search_prefetch_replies"] = prefetch_replies
+
         views.search(pyramid_request)
 
         search = search_lib.Search.return_value
-        search_lib.Search.assert_called_with(pyramid_request, separate_replies=False)
+        search_lib.Search.assert_called_with(
+            pyramid_request,
+            separate_replies=False,
+            reply_cursors=False,
+            cache=True,
+            prefetch_replies=prefetch_replies,
+            profile=None,
+        )
 
         expected_params = MultiDict(
             [("sort", "updated"), ("limit", 20), ("order", "desc"), ("offset", 0)]
@@ -41,6 +52,17 @@ class TestSearch:
 
         assert views.search(pyramid_request) == expected
 
+    def test_it_returns_the_cursor(
+        self, pyramid_request, search_run, presentation_service
+    ):
+        search_run.return_value = SearchResult(
+            2, ["row-1", "row-2"], [], {}, cursor="abc"
+        )
+
+        result = views.search(pyramid_request)
+
+        assert result["cursor"] == "abc"
+
     def test_it_presents_replies(
         self, pyramid_request, search_run, presentation_service
     ):
@@ -65,6 +87,65 @@ class TestSearch:
 
         assert views.search(pyramid_request) == expected
 
+    def test_it_asks_for_reply_cursors(self, pyramid_request, search_lib):
+        pyramid_request.params = NestedMultiDict(
+            MultiDict({"_separate_replies": "1", "_reply_cursors": "1"})
+        )
+
+        views.search(pyramid_request)
+
+        assert search_lib.Search.call_args[1]["reply_cursors"]
+
+    def test_it_returns_reply_cursors(
+        self, pyramid_request, search_run, presentation_service
+    ):
+        pyramid_request.params = NestedMultiDict(MultiDict({"_separate_replies": "1"}))
+        search_run.return_value = SearchResult(
+            1, ["row-1"], ["reply-1"], {}, reply_cursors={"row-1": "abc"}
+        )
+
+        result = views.search(pyramid_request)
+
+        assert result["reply_cursors"] == {"row-1": "abc"}
+
+    def test_it_profiles_searches_for_staff(
+        self, pyramid_request, search_lib, presentation_service, SearchProfile
+    ):
+        pyramid_request.has_permission = mock.Mock(return_value=True)
+        pyramid_request.params = NestedMultiDict(
+            MultiDict({"_profile": "1", "_separate_replies": "1"})
+        )
+        profile = SearchProfile.return_value
+
+        result = views.search(pyramid_request)
+
+        pyramid_request.has_permission.assert_called_once_with(
+            Permission.AdminPage.INDEX
+        )
+        SearchProfile.assert_called_once_with(pyramid_request.db)
+        assert search_lib.Search.call_args[1]["profile"] == profile
+        assert profile.step.call_args_list == [
+            mock.call("present/annotations"),
+            mock.call("present/replies"),
+        ]
+        assert result["profile"] == profile.asdict.return_value
+
+    def test_it_doesnt_profile_searches_for_anyone_else(
+        self, pyramid_request, search_lib, SearchProfile
+    ):
+        pyramid_request.has_permission = mock.Mock(return_value=False)
+        pyramid_request.params = NestedMultiDict(MultiDict({"_profile": "1"}))
+
+        result = views.search(pyramid_request)
+
+        SearchProfile.assert_not_called()
+        assert search_lib.Search.call_args[1]["profile"] is None
+        assert "profile" not in result
+
+    @pytest.fixture
+    def SearchProfile(self, patch):
+        return patch("h.views.api.annotations.SearchProfile")
+
     @pytest.fixture
     def search_lib(self, patch):
         return patch("h.views.api.annotations.search_lib")
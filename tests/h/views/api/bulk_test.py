@@ -10,8 +10,13 @@ from h.views.api.bulk import bulk
 
 
 class TestBulk:
-    def test_it_calls_bulk_api_correctly(
-        self, pyramid_request, BulkAPI, bulk_executor, client_authority
+    def test_it_calls_bulk_api_correctly(  # pylint:disable=too-many-arguments
+        self,
+        pyramid_request,
+        BulkAPI,
+        bulk_executor,
+        client_authority,
+        readable_groups_cache,
     ):
         bulk(pyramid_request)
 
@@ -19,8 +24,11 @@ class TestBulk:
             pyramid_request.body_file, executor=bulk_executor.return_value
         )
 
+        readable_groups_cache.assert_called_once_with(pyramid_request)
         bulk_executor.assert_called_once_with(
-            pyramid_request.db, authority=client_authority.return_value
+            db=pyramid_request.db,
+            authority=client_authority.return_value,
+            readable_cache=readable_groups_cache.return_value,
         )
 
         client_authority.assert_called_once_with(pyramid_request)
@@ -80,6 +88,10 @@ class TestBulk:
 
         return BulkAPI
 
+    @pytest.fixture(autouse=True)
+    def readable_groups_cache(self, patch):
+        return patch("h.views.api.bulk.readable_groups_cache")
+
     @pytest.fixture(autouse=True)
     def bulk_executor(self, patch):
         return patch("h.views.api.bulk.BulkExecutor")